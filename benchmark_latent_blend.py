@@ -0,0 +1,89 @@
+"""
+Microbenchmark of the per-step overhead of the latent blend in `AttentionControlEdit.step_callback',
+against `EmptyControl' which returns the latents unchanged.
+The inverted store and the attention of the edit are random maps of the Stable Diffusion cross attention layers.
+
+python benchmark_latent_blend.py --pretrained_model_path ./ckpt/stable-diffusion-v1-4
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import CLIPTokenizer
+
+from video_diffusion.prompt_attention import attention_util
+from video_diffusion.prompt_attention.attention_store import AttentionStore
+
+# resolution of the recorded cross attention layers of each key
+LAYER_RESOLUTIONS = {'down_cross': [32, 32, 16, 16], 'mid_cross': [8], 'up_cross': [16, 16, 16, 32, 32, 32]}
+
+
+def make_maps(clip_length, heads, device, dtype):
+    return {key: [torch.rand(clip_length, heads, res * res, 77, device=device).softmax(-1).to(dtype)
+                  for res in resolutions]
+            for key, resolutions in LAYER_RESOLUTIONS.items()}
+
+
+def make_inverted_store(num_steps, latents, maps):
+    store = AttentionStore(save_self_attention=False)
+    for _ in range(num_steps):
+        for key, layers in maps.items():
+            for layer, attn in enumerate(layers):
+                store.attention_store_all_step.write(key, layer, attn)
+        store.attention_store_all_step.end_step()
+    store.latents_store = [latents.cpu() for _ in range(num_steps)]
+    return store
+
+
+def time_step_callback(controller, latents, num_steps, device):
+    "mean seconds of a step_callback call"
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        controller.step_callback(latents)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained_model_path', type=str, default='./ckpt/stable-diffusion-v1-4')
+    parser.add_argument('--num_steps', type=int, default=10)
+    parser.add_argument('--clip_length', type=int, default=8)
+    parser.add_argument('--heads', type=int, default=8)
+    args = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    dtype = torch.float16 if device.type == 'cuda' else torch.float32
+    tokenizer = CLIPTokenizer.from_pretrained(args.pretrained_model_path, subfolder='tokenizer')
+    prompts = ['a silver jeep driving down a curvy road', 'a Porsche car driving down a curvy road']
+
+    latents = torch.randn(1, 4, args.clip_length, 64, 64, device=device, dtype=dtype)
+    maps = make_maps(args.clip_length, args.heads, device, dtype)
+    inverted_store = make_inverted_store(args.num_steps, latents, maps)
+
+    def make_edit_controller():
+        controller = attention_util.make_controller(
+            tokenizer, prompts, is_replace_controller=False,
+            cross_replace_steps=0.8, self_replace_steps=0.6,
+            blend_words=[['jeep'], ['car']], additional_attention_store=inverted_store,
+            use_inversion_attention=True, NUM_DDIM_STEPS=args.num_steps,
+            blend_latents=True, save_self_attention=False, save_blend_mask=False)
+        # the attention of the edit accumulated by its forward
+        controller.attention_store = {key: [attn.clone() for attn in layers] for key, layers in maps.items()}
+        return controller
+
+    # warm up the kernels and the allocator
+    time_step_callback(make_edit_controller(), latents, args.num_steps, device)
+    empty_time = time_step_callback(attention_util.EmptyControl(), latents, args.num_steps, device)
+    blend_time = time_step_callback(make_edit_controller(), latents, args.num_steps, device)
+    print(f'EmptyControl step_callback: {empty_time * 1e3:.3f} ms / step')
+    print(f'latent blend step_callback: {blend_time * 1e3:.3f} ms / step')
+    print(f'latent blend overhead: {(blend_time - empty_time) * 1e3:.3f} ms / step')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Microbenchmark of the memory allocated by the text cross attention of one SpatioTemporalTransformerBlock,
+with the text key and value shared by the frames (`TextCrossAttention.text_attention')
+against the key and value copied to every frame (`TextCrossAttention.expand_to_frames').
+The layer has random weights, only the shapes matter.
+
+python benchmark_text_cross_attention.py --clip_length 8 --channels 320
+"""
+
+import argparse
+import time
+
+import torch
+
+from video_diffusion.models.attention import TextCrossAttention, compute_attention
+
+
+def expanded_attention(layer, hidden_states, encoder_hidden_states):
+    "the attention before the frames were folded into the query, one copy of key and value per frame"
+    key, value = layer.get_text_key_value(encoder_hidden_states)
+    repeat = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+    key = layer.expand_to_frames(key, repeat)
+    value = layer.expand_to_frames(value, repeat)
+    query = layer.reshape_heads_to_batch_dim(layer.to_q(hidden_states))
+    return compute_attention(layer, query, key, value)
+
+
+def get_cpu_allocated(fn):
+    "bytes allocated by one call on cpu, summed over the allocations"
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(event.self_cpu_memory_usage for event in prof.key_averages() if event.self_cpu_memory_usage > 0)
+
+
+def measure(fn, num_steps, device):
+    """mean seconds of a call, and the bytes of a call: the peak above the inputs on cuda,
+    all allocations on cpu
+    """
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated() if device.type == 'cuda' else 0
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / num_steps
+    if device.type == 'cuda':
+        return seconds, torch.cuda.max_memory_allocated() - base
+    return seconds, get_cpu_allocated(fn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_steps', type=int, default=20)
+    parser.add_argument('--clip_length', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=2, help='2 with classifier-free guidance')
+    parser.add_argument('--channels', type=int, default=320)
+    parser.add_argument('--resolution', type=int, default=64)
+    parser.add_argument('--heads', type=int, default=8)
+    args = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    dtype = torch.float16 if device.type == 'cuda' else torch.float32
+    layer = TextCrossAttention(query_dim=args.channels, cross_attention_dim=768, heads=args.heads,
+                               dim_head=args.channels // args.heads).to(device, dtype).eval()
+    hidden_states = torch.randn(args.batch_size * args.clip_length, args.resolution ** 2, args.channels,
+                                device=device, dtype=dtype)
+    encoder_hidden_states = torch.randn(args.batch_size, 77, 768, device=device, dtype=dtype)
+
+    with torch.no_grad():
+        copy_bytes = 2 * hidden_states.shape[0] * 77 * args.channels * hidden_states.element_size()
+        folded = measure(lambda: layer.text_attention(hidden_states, encoder_hidden_states), args.num_steps, device)
+        expanded = measure(lambda: expanded_attention(layer, hidden_states, encoder_hidden_states),
+                           args.num_steps, device)
+        error = (layer.text_attention(hidden_states, encoder_hidden_states)
+                 - expanded_attention(layer, hidden_states, encoder_hidden_states)).abs().max().item()
+
+    print(f'key and value copied to the frames: {copy_bytes / 2 ** 20:.2f} MB per layer call')
+    memory = 'peak' if device.type == 'cuda' else 'allocated'
+    for name, (seconds, nbytes) in [('folded frames', folded), ('expanded key and value', expanded)]:
+        print(f'{name}: {seconds * 1e3:.3f} ms, {memory} {nbytes / 2 ** 20:.2f} MB')
+    print(f'max abs difference: {error:.2e}')
+
+
+if __name__ == '__main__':
+    main()
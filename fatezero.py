@@ -28,6 +28,7 @@ from video_diffusion.common.logger import get_logger_config_path
 from video_diffusion.common.image_util import log_train_samples
 from video_diffusion.common.instantiate_from_config import instantiate_from_config
 from video_diffusion.pipelines.p2p_validation_loop import P2pSampleLogger
+from video_diffusion.prompt_attention.recording_plan import make_recording_plan
 
 
 # logger = get_logger(__name__)
@@ -115,7 +116,14 @@ def function_test(
             pretrained_model_path,
             subfolder="scheduler",
         ),
-        disk_store=kwargs.get('disk_store', False)
+        disk_store=kwargs.get('disk_store', False),
+        tier_budget=kwargs.get('tier_budget', None),
+        attention_codec=kwargs.get('attention_codec', 'none'),
+        codec_report=kwargs.get('attention_codec_report', False),
+        self_attention_rank=kwargs.get('self_attention_rank', None),
+        step_subset=kwargs.get('attention_step_subset', None),
+        max_recorded_query=kwargs.get('max_recorded_query', 32 ** 2),
+        spatial_tile=kwargs.get('spatial_tile', None)
     )
     pipeline.scheduler.set_timesteps(editing_config['num_inference_steps'])
     pipeline.set_progress_bar_config(disable=True)
@@ -213,6 +221,11 @@ def function_test(
         )
 
         use_inversion_attention = editing_config.get('use_inversion_attention', False)
+        recording_plan = None
+        if use_inversion_attention and kwargs.get('recording_plan', True):
+            # record only the attention consumed by the edits in editing_config
+            recording_plan = make_recording_plan(tokenizer, editing_config, dataset_config.prompt,
+                                                 max_query=kwargs.get('max_recorded_query', 32 ** 2))
         batch['latents_all_step'] = pipeline.prepare_latents_ddim_inverted(
             rearrange(batch["images"].to(dtype=weight_dtype), "b c f h w -> (b f) c h w"),
             batch_size=1,
@@ -221,7 +234,10 @@ def function_test(
             prompt=dataset_config.prompt,
             store_attention=use_inversion_attention,
             LOW_RESOURCE=True,  # not classifier-free guidance
-            save_path=logdir if verbose else None
+            save_path=logdir if verbose else None,
+            inversion_cache_dir=kwargs.get('inversion_cache_dir', None),
+            recording_plan=recording_plan,
+            model_path=pretrained_model_path
         )
 
         batch['ddim_init_latents'] = batch['latents_all_step'][-1].repeat(1,1,total_frame_num,1,1)
@@ -0,0 +1,386 @@
+"""
+CPU checks of the components behind the editing pipeline on random tensors and small layers.
+No checkpoint or GPU is needed.
+
+python -m pytest -q test_components.py
+or
+python test_components.py
+"""
+
+import os
+import tempfile
+
+import torch
+from diffusers.models.attention import CrossAttention
+from einops import rearrange
+
+from video_diffusion.pipelines.style_schedule import StyleSchedule, make_style_schedule
+from video_diffusion.pipelines.spatial_tiling import SpatialTiling
+from video_diffusion.models.frame_chunked_unet import FrameChunkedUNet
+from video_diffusion.models.attention import (TextCrossAttention, SparseCausalAttention, compute_attention,
+                                              get_sparse_causal_frames, get_sparse_causal_window_frames,
+                                              gather_sparse_causal_frames)
+from video_diffusion.prompt_attention.attention_codec import (encode_attention, decode_attention, encode_low_rank,
+                                                              decode_low_rank, is_low_rank, slice_attention_rows)
+from video_diffusion.prompt_attention.step_subset import StepSubset, interpolate_attention
+from video_diffusion.prompt_attention.recording_plan import RecordingPlan
+from video_diffusion.prompt_attention.attention_cache import (AttentionFileStore, AttentionCacheManager,
+                                                              AttentionTieredStore)
+from video_diffusion.prompt_attention.spatial_blend import MaskWriter
+
+
+def random_attention(*shape):
+    "softmax rows like the recorded maps"
+    generator = torch.Generator().manual_seed(0)
+    return (torch.randn(*shape, generator=generator) * 3).softmax(-1)
+
+
+def test_style_schedule():
+    # the default blend of the first release, (n - f) / (n - 1) of the source at step 40
+    original = make_style_schedule({})
+    assert original.get_steps(50) == [40]
+    weight = original.get_weight(40, 50, 0, 5, 5).flatten()
+    assert torch.allclose(weight, torch.tensor([1.25, 1.0, 0.75, 0.5, 0.25], dtype=weight.dtype))
+    assert torch.allclose(original.get_weight(40, 50, 0, 1, 1).flatten().float(), torch.tensor([1.0]))
+
+    schedule = make_style_schedule({'curve': 'linear', 'steps': [0.5, 45], 'strength': [0.5, 1.0]})
+    assert schedule.get_steps(50) == [25, 45]
+    assert schedule.get_weight(10, 50, 0, 8, 8) is None
+    weight = schedule.get_weight(45, 50, 0, 5, 5).flatten()
+    assert torch.allclose(weight, torch.tensor([1.0, 0.75, 0.5, 0.25, 0.0], dtype=weight.dtype))
+    # a stage takes the weights of its frames in the full clip
+    assert torch.allclose(schedule.get_weight(45, 50, 2, 4, 5).flatten(), weight[2:4])
+    assert torch.allclose(schedule.get_weight(25, 50, 0, 5, 5).flatten(), 0.5 * weight)
+
+    keyframe = StyleSchedule(curve='keyframe', keyframes=[(1.0, 0.0), (0.0, 1.0), (0.5, 1.0)])
+    assert torch.allclose(keyframe.get_frame_weight(0, 5, 5).float(), torch.tensor([1.0, 1.0, 1.0, 0.5, 0.0]))
+
+    latents, source_latents = torch.zeros(1, 4, 5, 8, 8), torch.ones(1, 4, 5, 8, 8)
+    blended = schedule(latents, source_latents, 45, 50, 0, 5, 5)
+    assert torch.allclose(blended[0, 0, :, 0, 0], weight.float())
+    assert schedule(latents, source_latents, 44, 50, 0, 5, 5) is latents
+
+
+def test_codec_round_trip():
+    attn = random_attention(2, 8, 64, 128)
+    max_errors = {'fp16': 1e-3, 'bf16': 1e-2}
+    for codec, max_error in max_errors.items():
+        decoded = decode_attention(encode_attention(attn, codec), dtype=torch.float32)
+        assert decoded.shape == attn.shape
+        assert ((decoded - attn).abs() <= max_error * attn.abs() + 1e-6).all(), codec
+
+    encoded = encode_attention(attn, 'uint8')
+    assert encoded.dtype == torch.uint8 and encoded.shape[-1] == attn.shape[-1] + 2
+    decoded = decode_attention(encoded)
+    # half a quantization step of the row max, plus the fp16 rounding of the row max
+    row_max = attn.amax(-1, keepdim=True)
+    assert ((decoded - attn).abs() <= row_max * (0.5 / 255 + 1e-3)).all()
+    assert torch.equal(decode_attention(encode_attention(attn, 'none')), attn)
+    assert decode_attention(None) is None
+
+
+def test_low_rank_packing():
+    frames, heads, num_query, num_key, rank = 2, 4, 64, 128, 8
+    generator = torch.Generator().manual_seed(0)
+    u = torch.randn(frames, heads, num_query, rank, generator=generator)
+    v = torch.randn(frames, heads, num_key, rank, generator=generator)
+    attn = torch.matmul(u, v.transpose(-1, -2))
+
+    packed = encode_low_rank(attn, rank)
+    assert packed.shape == (frames, heads, num_query + num_key, rank)
+    assert is_low_rank(packed, num_query)
+    assert torch.allclose(decode_low_rank(packed, num_query), attn, atol=1e-3, rtol=1e-3)
+    # the query rows of a block keep all V rows
+    block = slice_attention_rows(packed, 16, 32, num_query)
+    assert torch.allclose(decode_low_rank(block, 16), attn[..., 16:32, :], atol=1e-3, rtol=1e-3)
+    # too small to gain from the factorization
+    small = random_attention(1, 1, 4, 8)
+    assert not is_low_rank(encode_low_rank(small, rank), 4)
+
+    other_u = torch.randn(frames, heads, num_query, rank, generator=generator)
+    other_v = torch.randn(frames, heads, num_key, rank, generator=generator)
+    other = encode_low_rank(torch.matmul(other_u, other_v.transpose(-1, -2)), rank)
+    interpolated = interpolate_attention(packed, other, 0.25, low_rank=True)
+    assert interpolated.shape[-1] == 2 * rank
+    expected = 0.75 * decode_low_rank(packed, num_query) + 0.25 * decode_low_rank(other, num_query)
+    assert torch.allclose(decode_low_rank(interpolated, num_query), expected, atol=1e-3, rtol=1e-3)
+
+
+def test_step_subset_every():
+    step_subset = StepSubset(every=3)
+    kept = [step for step in range(10) if step_subset.keeps(step, 'down_self', 0, 1, lambda kept_step: 1.0)]
+    assert kept == [0, 3, 6, 9]
+    assert step_subset.get_neighbours(4, 'down_self', 0) == (3, 6)
+    assert step_subset.get_neighbours(7, 'down_self', 0) == (6, 9)
+    assert step_subset.get_neighbours(10, 'down_self', 0) == (9, None)
+    assert step_subset.get_neighbours(0, 'down_self', 1) == (None, None)
+
+
+def test_step_subset_threshold():
+    step_subset = StepSubset(threshold=0.1, report=True)
+    changes = {0: 0.0, 1: 0.05, 2: 0.2, 3: 0.01}
+    kept = [step for step in range(4) if step_subset.keeps(step, 'up_cross', 2, 10, lambda kept_step: changes[step])]
+    assert kept == [0, 2]
+    summary = step_subset.report.summary()
+    assert summary['kept_maps'] == 2 and summary['maps'] == 4
+    assert summary['memory_ratio'] == 0.5
+    assert abs(summary['max_hold_error'] - 0.05) < 1e-9
+
+
+def test_recording_plan():
+    plan = RecordingPlan(num_steps=10, self_steps=[0, 1], cross_steps=[5], blend_steps=[7], tokens=[0, 3, 5])
+    assert plan.records(1, 'down_self', 0) and not plan.records(2, 'down_self', 0)
+    assert plan.records(5, 'mid_cross', 0)
+    assert plan.records(7, 'down_cross', 2) and not plan.records(7, 'down_cross', 0)
+    assert plan.get_step_num('up_cross', 1) == 2
+
+    attn = random_attention(2, 4, 16, 77)
+    expanded = plan.expand_tokens(plan.select_tokens(attn))
+    assert torch.equal(expanded[..., [0, 3, 5]], attn[..., [0, 3, 5]])
+    assert expanded[..., 1].abs().sum() == 0
+    assert plan.get_signature() != RecordingPlan(num_steps=10).get_signature()
+
+
+def test_file_store_round_trip():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        path = os.path.join(cache_dir, 'attention.bin')
+        steps = [{'down_cross': [random_attention(2, 4, 16, 77), None],
+                  'up_self': [encode_attention(random_attention(2, 4, 16, 32), codec)]}
+                 for codec in ['none', 'bf16', 'uint8']]
+        file_store = AttentionFileStore(path)
+        for step in steps:
+            file_store.append(step)
+        file_store.flush()
+        assert len(file_store) == 3
+
+        reopened = AttentionFileStore.open(path)
+        assert len(reopened) == 3
+        for step, step_store in enumerate(steps):
+            read = reopened[step]
+            assert set(read.keys()) == set(step_store.keys())
+            assert read['down_cross'][1] is None
+            for key in step_store:
+                expected = step_store[key][0]
+                assert read[key][0].dtype == expected.dtype
+                assert torch.equal(read[key][0], expected), (step, key)
+        assert torch.equal(reopened.load_step(2)['up_self'][0], steps[2]['up_self'][0])
+
+
+def test_tiered_store_spills_to_disk():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        attn = random_attention(2, 4, 16, 32)
+        nbytes = attn.numel() * attn.element_size()
+        # one map in the device tier, one in the host tier, the others on disk
+        budget = {'device_gb': nbytes / 1024 ** 3, 'host_gb': nbytes / 1024 ** 3}
+        store = AttentionTieredStore(budget, AttentionCacheManager(cache_dir, quota_gb=None))
+        maps = [attn * (step + 1) for step in range(4)]
+        for step_attn in maps:
+            store.write('down_self', 0, step_attn, device=torch.device('cpu'))
+            store.end_step()
+        assert len(store) == 4
+        assert store.path is not None and os.path.isfile(store.path)
+        for step in [0, 3, 1, 2]:
+            assert torch.equal(store[step]['down_self'][0], maps[step])
+        # the writer thread is done before the folder is removed
+        store.file_store.flush()
+        store.cache_manager.release(store.path)
+
+
+def test_cache_manager_skips_locked_entries():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        manager = AttentionCacheManager(cache_dir, quota_gb=0)
+        used, unused = manager.new_path(), os.path.join(cache_dir, 'attention_cache_old.bin')
+        for path in [used, unused]:
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 1024)
+        manager.evict()
+        assert os.path.isfile(used) and not os.path.isfile(unused)
+        manager.release(used)
+        manager.evict()
+        assert not os.path.isfile(used)
+
+
+def test_spatial_tiling_weights():
+    tiling = SpatialTiling(tile_size=8, overlap=4)
+    assert tiling.get_starts(8) == [0]
+    assert tiling.get_starts(20) == [0, 4, 8, 12]
+    assert tiling.get_starts(18) == [0, 4, 8, 10]
+
+    latents = torch.randn(1, 4, 2, 14, 22)
+    ones = tiling.fuse(latents, lambda index, tile: torch.ones_like(tile))
+    assert torch.allclose(ones, torch.ones_like(latents))
+    # the tile weights sum to 1 at every pixel, so the identity is fused back exactly
+    assert torch.allclose(tiling.fuse(latents, lambda index, tile: tile), latents, atol=1e-6)
+
+    # the VAE decode outputs 8 pixels per latent pixel
+    images = tiling.fuse(latents, lambda index, tile: tile.repeat_interleave(8, -1).repeat_interleave(8, -2),
+                         out_scale=8)
+    assert images.shape[-2:] == (14 * 8, 22 * 8)
+    assert torch.allclose(images[..., ::8, ::8], latents, atol=1e-6)
+    tiles = []
+    tiling.fuse(latents, lambda index, tile: tiles.append(index) or tile)
+    assert tiles == list(range(len(tiling.get_tiles(14, 22))))
+
+
+class ScaleUNet:
+    "returns 2 * sample, a stand-in for the UNet"
+    def __call__(self, sample, timestep, encoder_hidden_states=None, return_dict=True):
+        return (2 * sample,)
+
+
+def test_frame_chunked_fusion():
+    chunked = FrameChunkedUNet(ScaleUNet(), window_frames=4, overlap=2, share_anchor=False)
+    assert chunked.get_windows(8) == [0, 2, 4]
+    assert chunked.get_windows(9) == [0, 2, 4, 5]
+    assert torch.allclose(chunked.get_frame_weight(0, 8), torch.tensor([1.0, 1.0, 2 / 3, 1 / 3]))
+    assert torch.allclose(chunked.get_frame_weight(5, 9), torch.tensor([1 / 3, 2 / 3, 1.0, 1.0]))
+
+    sample = torch.randn(1, 4, 9, 8, 8)
+    for fusion in ['linear', 'uniform', [1.0, 2.0, 2.0, 1.0]]:
+        chunked.fusion = fusion
+        fused = chunked(sample, 0, encoder_hidden_states=None, return_dict=False)[0]
+        assert torch.allclose(fused, 2 * sample, atol=1e-6), fusion
+
+    for fusion in [[1.0, 0.0, 1.0, 1.0], [1.0, 1.0]]:
+        try:
+            FrameChunkedUNet(ScaleUNet(), window_frames=4, overlap=2, fusion=fusion)
+        except ValueError:
+            continue
+        raise AssertionError(f'fusion {fusion} should be rejected')
+
+
+def test_text_key_value_cache():
+    torch.manual_seed(0)
+    layer = TextCrossAttention(query_dim=32, cross_attention_dim=16, heads=2, dim_head=8).eval()
+    encoder_hidden_states = torch.randn(2, 77, 16)
+    with torch.no_grad():
+        key, value = layer.get_text_key_value(encoder_hidden_states)
+        cached_key, cached_value = layer.get_text_key_value(encoder_hidden_states)
+        assert cached_key is key and cached_value is value
+        # the cache is keyed by the identity of the text embeddings
+        other_key, _ = layer.get_text_key_value(encoder_hidden_states.clone())
+        assert other_key is not key and torch.equal(other_key, key)
+
+        # the frames folded into the query attend to the text as with the text copied to every frame
+        hidden_states = torch.randn(2 * 3, 16, 32)
+        expected = CrossAttention.forward(layer, hidden_states, encoder_hidden_states.repeat_interleave(3, 0))
+        assert torch.allclose(layer(hidden_states, encoder_hidden_states), expected, atol=1e-5)
+    layer.clear_text_key_value_cache()
+    assert layer._text_key_value_cache is None
+    # training needs a new graph at every step
+    layer.get_text_key_value(encoder_hidden_states)
+    assert layer._text_key_value_cache is None
+
+
+def test_mask_writer_flush():
+    with tempfile.TemporaryDirectory() as save_dir:
+        writer = MaskWriter(max_pending_writes=2)
+        mask = torch.rand(1, 2, 8, 8)
+        for step in range(3):
+            writer.write(mask, os.path.join(save_dir, 'mask', f'{step}.png'))
+        writer.flush()
+        assert sorted(os.listdir(os.path.join(save_dir, 'mask'))) == ['0.png', '1.png', '2.png']
+
+        # a file in place of the folder, the error of the writer thread is raised by flush
+        open(os.path.join(save_dir, 'file'), 'w').close()
+        writer.write(mask, os.path.join(save_dir, 'file', '0.png'))
+        try:
+            writer.flush()
+        except OSError:
+            writer.flush()
+            return
+        raise AssertionError('the error of the mask writer should be raised by flush')
+
+
+def explicit_attention(layer, query, key, value, attention_mask=None):
+    "softmax(Q K^T * scale + mask) V of [(b h), n, dim_head], return [b, n, (h dim_head)]"
+    scores = torch.matmul(query.float(), key.float().transpose(-1, -2)) * layer.scale
+    if attention_mask is not None:
+        scores = scores + attention_mask
+    hidden_states = torch.matmul(scores.softmax(-1), value.float()).to(query.dtype)
+    return layer.reshape_batch_dim_to_heads(hidden_states)
+
+
+def test_compute_attention():
+    generator = torch.Generator().manual_seed(0)
+    for upcast_attention in [False, True]:
+        layer = CrossAttention(query_dim=32, heads=2, dim_head=16, upcast_attention=upcast_attention)
+        query, key, value = [torch.randn(2 * 2, n, 16, generator=generator) for n in [24, 40, 40]]
+        assert torch.allclose(compute_attention(layer, query, key, value),
+                              explicit_attention(layer, query, key, value), atol=1e-5)
+        attention_mask = torch.zeros(2 * 2, 1, 40)
+        attention_mask[..., 30:] = -10000.0
+        assert torch.allclose(compute_attention(layer, query, key, value, attention_mask),
+                              explicit_attention(layer, query, key, value, attention_mask), atol=1e-5)
+
+
+def get_baseline_frame_index(clip_length, SparseCausalAttention_index):
+    "frames attended by each frame, as in the first release of SparseCausalAttention"
+    frame_index_list = []
+    for index in SparseCausalAttention_index:
+        if index == 'first':
+            frame_index = [0] * clip_length
+        elif index == 'last':
+            frame_index = [clip_length - 1] * clip_length
+        elif index in ['mid', 'middle']:
+            frame_index = [int(clip_length - 1) // 2] * clip_length
+        else:
+            frame_index = (torch.arange(clip_length) + index).clip(0, clip_length - 1)
+        frame_index_list.append(frame_index)
+    return frame_index_list
+
+
+def test_sparse_causal_frames():
+    torch.manual_seed(0)
+    layer = SparseCausalAttention(query_dim=32, heads=2, dim_head=16).eval()
+    for clip_length in [1, 4]:
+        hidden_states = torch.randn(2 * clip_length, 16, 32)
+        for index in [[-1, 'first'], ['mid'], [0], ['first', 'first', -1]]:
+            # the recorded maps have the key layout of the first release, one entry per index
+            tensor = torch.randn(2 * clip_length, 16, 8)
+            frames = get_sparse_causal_frames(clip_length, index, dedupe=False)
+            expected = rearrange(tensor, "(b f) d c -> b f d c", f=clip_length)
+            expected = torch.cat([expected[:, frame_index] for frame_index in
+                                  get_baseline_frame_index(clip_length, index)], dim=2)
+            expected = rearrange(expected, "b f d c -> (b f) d c")
+            assert torch.equal(gather_sparse_causal_frames(tensor, clip_length, frames), expected), index
+
+            # the deduplicated and anchor-folded attention of the layer gives the same output
+            with torch.no_grad():
+                key = gather_sparse_causal_frames(layer.to_k(hidden_states), clip_length, frames)
+                value = gather_sparse_causal_frames(layer.to_v(hidden_states), clip_length, frames)
+                expected = explicit_attention(layer, layer.reshape_heads_to_batch_dim(layer.to_q(hidden_states)),
+                                              layer.reshape_heads_to_batch_dim(key),
+                                              layer.reshape_heads_to_batch_dim(value))
+                expected = layer.to_out[0](expected)
+                output = layer(hidden_states, clip_length=clip_length, SparseCausalAttention_index=index)
+            assert torch.allclose(output, expected, atol=1e-5), (clip_length, index)
+    # the previous and first frame of a single frame are attended once
+    assert get_sparse_causal_frames(1, [-1, 'first']) == [0]
+
+
+def test_sparse_causal_window():
+    frames = get_sparse_causal_window_frames(6, radius=1, anchor_every=4)
+    expected = [[0, 0, 1, 2, 3, 4], [0, 1, 2, 3, 4, 5], [1, 2, 3, 4, 5, 5], [0, 0, 0, 0, 4, 4]]
+    assert [frame.tolist() for frame in frames] == expected
+    causal = get_sparse_causal_window_frames(6, radius=1, anchor_every=4, causal=True)
+    assert [frame.tolist() for frame in causal] == [expected[0], expected[1], expected[3]]
+
+    # the chunks of query frames attend to the same key frames as the whole clip
+    torch.manual_seed(0)
+    layer = SparseCausalAttention(query_dim=32, heads=2, dim_head=16).eval()
+    hidden_states = torch.randn(2 * 6, 16, 32)
+    window = {'radius': 1, 'anchor_every': 4}
+    with torch.no_grad():
+        output = layer(hidden_states, clip_length=6, SparseCausalAttention_window=window)
+        for chunk_size in [1, 4]:
+            chunked = layer(hidden_states, clip_length=6,
+                            SparseCausalAttention_window=dict(window, chunk_size=chunk_size))
+            assert torch.allclose(chunked, output, atol=1e-5), chunk_size
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f'{name} passed')
@@ -0,0 +1,282 @@
+"""
+CPU checks of the editing pipeline on a tiny random UNet, VAE and text encoder,
+with a character-level CLIP tokenizer written to a temporary folder. No checkpoint or GPU is needed.
+
+python -m pytest -q test_edit_pipeline.py
+or
+python test_edit_pipeline.py
+"""
+
+import json
+import os
+import string
+import tempfile
+
+import torch
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from diffusers import AutoencoderKL, DDIMScheduler
+
+from video_diffusion.models.attention import TextCrossAttention, SparseCausalAttention
+from video_diffusion.models.unet_3d_condition import UNetPseudo3DConditionModel
+from video_diffusion.pipelines.p2p_ddim_spatial_temporal import P2pDDIMSpatioTemporalPipeline
+from video_diffusion.prompt_attention.recording_plan import make_recording_plan
+from video_diffusion.prompt_attention import attention_util
+
+NUM_STEPS = 10
+# enough cross attention layers for `SpatialBlender.BLEND_LAYERS'
+BLEND_UNET_CONFIG = dict(
+    block_out_channels=(32, 32, 64), layers_per_block=2,
+    down_block_types=("CrossAttnDownBlockPseudo3D", "CrossAttnDownBlockPseudo3D", "DownBlockPseudo3D"),
+    up_block_types=("UpBlockPseudo3D", "CrossAttnUpBlockPseudo3D", "CrossAttnUpBlockPseudo3D"))
+
+
+def make_tokenizer(folder):
+    "every lowercase letter is a token, so that any prompt of lowercase words can be encoded"
+    vocab = ['<|startoftext|>', '<|endoftext|>'] + list(string.ascii_lowercase) \
+        + [letter + '</w>' for letter in string.ascii_lowercase]
+    with open(os.path.join(folder, 'vocab.json'), 'w') as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(os.path.join(folder, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer(os.path.join(folder, 'vocab.json'), os.path.join(folder, 'merges.txt'),
+                         model_max_length=77, pad_token='<|endoftext|>')
+
+
+def make_pipeline(sample_size=16, **model_config):
+    torch.manual_seed(0)
+    unet_config = dict(
+        sample_size=sample_size, block_out_channels=(32, 64), layers_per_block=1, norm_num_groups=8,
+        down_block_types=("CrossAttnDownBlockPseudo3D", "DownBlockPseudo3D"),
+        up_block_types=("UpBlockPseudo3D", "CrossAttnUpBlockPseudo3D"),
+        cross_attention_dim=32, attention_head_dim=4)
+    unet_config.update(model_config)
+    unet = UNetPseudo3DConditionModel(**unet_config)
+    # one block, the latents have the resolution of the frames
+    vae = AutoencoderKL(block_out_channels=(32,), norm_num_groups=8, latent_channels=4,
+                        down_block_types=("DownEncoderBlock2D",), up_block_types=("UpDecoderBlock2D",))
+    text_encoder = CLIPTextModel(CLIPTextConfig(vocab_size=54, hidden_size=32, intermediate_size=64,
+                                                num_hidden_layers=1, num_attention_heads=2,
+                                                max_position_embeddings=77))
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                              clip_sample=False, set_alpha_to_one=False, steps_offset=1)
+    with tempfile.TemporaryDirectory() as folder:
+        tokenizer = make_tokenizer(folder)
+    return P2pDDIMSpatioTemporalPipeline(vae, text_encoder, tokenizer, unet, scheduler)
+
+
+def invert(pipeline, num_frames, prompt='a cat', store_attention=True, num_steps=NUM_STEPS, **kwargs):
+    "DDIM inversion of random frames, as in fatezero.py"
+    generator = torch.Generator().manual_seed(1)
+    size = pipeline.unet.config.sample_size
+    image = torch.rand(num_frames, 3, size, size, generator=generator) * 2 - 1
+    text_embeddings = pipeline._encode_prompt(prompt, 'cpu', 1, True, None)
+    pipeline.scheduler.set_timesteps(num_steps)
+    return pipeline.prepare_latents_ddim_inverted(image, 1, 1, text_embeddings, store_attention=store_attention,
+                                                  prompt=prompt, generator=generator, LOW_RESOURCE=True, **kwargs)
+
+
+def edit(pipeline, latents_all, num_frames, prompt='a dog', source_prompt='a cat', num_steps=NUM_STEPS, **kwargs):
+    "p2p edit of the inverted latents repeated to num_frames frames, as in P2pSampleLogger"
+    latents = latents_all[-1]
+    if latents.shape[2] != num_frames:
+        latents = latents.repeat(1, 1, num_frames, 1, 1)
+    edit_kwargs = dict(edit_type='swap', cross_replace_steps=0.5, self_replace_steps=0.5,
+                       use_inversion_attention=True, save_self_attention=False)
+    edit_kwargs.update(kwargs)
+    output = pipeline(prompt=prompt, source_prompt=source_prompt, image=None, num_inference_steps=num_steps,
+                      guidance_scale=7.5, latents=latents, latents_all=latents_all, total_frame_num=num_frames,
+                      output_type='np', **edit_kwargs)
+    if edit_kwargs['edit_type'] is None:
+        return output.images
+    return output['sdimage_output'].images
+
+
+def test_shared_frame():
+    for edit_type in [None, 'swap']:
+        # the inverted store of a pipeline keeps the steps of every inversion
+        pipeline = make_pipeline()
+        # the frames diverge at the style blend of step 40
+        latents_all = invert(pipeline, 1, store_attention=edit_type is not None, num_steps=45)
+        images = edit(pipeline, latents_all, 3, edit_type=edit_type, num_steps=45)
+        shared_images = edit(pipeline, latents_all, 3, edit_type=edit_type, num_steps=45, shared_frame=True)
+        assert images.shape == shared_images.shape == (1, 3, 16, 16, 3)
+        assert not torch.allclose(torch.from_numpy(images[0, 0]), torch.from_numpy(images[0, 2]))
+        assert torch.allclose(torch.from_numpy(shared_images), torch.from_numpy(images), atol=1e-4), edit_type
+
+
+def test_stages_match_one_pass():
+    # the group norms of the UNet mix the frames of a stage, the stages only match one pass while all frames
+    # are the same: a shared inverted frame and no style blend
+    no_blend = {'steps': []}
+    for edit_type in [None, 'swap']:
+        # the inverted store of a pipeline keeps the steps of every inversion
+        pipeline = make_pipeline()
+        latents_all = invert(pipeline, 1, store_attention=edit_type is not None)
+        images = edit(pipeline, latents_all, 5, edit_type=edit_type, style_schedule=no_blend)
+        sink_images = []
+        staged_images = edit(pipeline, latents_all, 5, edit_type=edit_type, style_schedule=no_blend,
+                             stage_frame_num=2,
+                             frame_sink=lambda stage_images, start_frame: sink_images.append((start_frame,
+                                                                                              stage_images)))
+        assert staged_images is None and [start_frame for start_frame, _ in sink_images] == [0, 2, 4]
+        staged_images = torch.cat([torch.from_numpy(stage_images) for _, stage_images in sink_images], dim=1)
+        assert torch.allclose(staged_images, torch.from_numpy(images), atol=1e-4), edit_type
+
+    # the inverted maps of several frames cannot be split by stage
+    pipeline = make_pipeline()
+    latents_all = invert(pipeline, 4)
+    try:
+        edit(pipeline, latents_all, 4, stage_frame_num=2)
+    except ValueError:
+        return
+    raise AssertionError('stages with the inverted attention of 4 frames should be rejected')
+
+
+def test_replaced_self_attention_matches_map_product():
+    # save_self_attention computes the edited self-attention probabilities and replaces them in `forward',
+    # without it the replaced layers multiply the inverted map with value and skip QK^T and softmax
+    pipeline = make_pipeline()
+    latents_all = invert(pipeline, 1)
+    images = edit(pipeline, latents_all, 3, self_replace_steps=1.0, save_self_attention=True)
+    replaced_images = edit(pipeline, latents_all, 3, self_replace_steps=1.0, save_self_attention=False)
+    assert torch.allclose(torch.from_numpy(replaced_images), torch.from_numpy(images), atol=1e-4)
+
+
+def test_cross_attention_value_edit_matches_map_edit():
+    pipeline = make_pipeline()
+    latents_all = invert(pipeline, 1)
+    # replace, refine and reweight controllers
+    for prompt, eq_params in [('a dog', None), ('a black cat', None), ('a black cat', {'words': ['black'],
+                                                                                          'values': [2.0]})]:
+        images = edit(pipeline, latents_all, 3, prompt=prompt, eq_params=eq_params)
+        value_images = edit(pipeline, latents_all, 3, prompt=prompt, eq_params=eq_params,
+                            cross_attention_value_edit=True)
+        assert torch.allclose(torch.from_numpy(value_images), torch.from_numpy(images), atol=1e-4), prompt
+
+
+def test_text_key_value_cache_released():
+    pipeline = make_pipeline()
+    latents_all = invert(pipeline, 1)
+    layers = [module for module in pipeline.unet.modules() if isinstance(module, TextCrossAttention)]
+    assert len(layers) > 0
+    assert all(getattr(layer, '_text_key_value_cache', None) is None for layer in layers)
+    edit(pipeline, latents_all, 2)
+    # the text embeddings of the call and their key and value are not kept by the UNet
+    assert all(getattr(layer, '_text_key_value_cache', None) is None for layer in layers)
+
+
+def test_recording_plan_is_exact():
+    source_prompt = 'a cat'
+    edits = [
+        # replace
+        ('a dog', {'cross_replace_steps': 0.5, 'self_replace_steps': 0.5}),
+        # refine with blended latents and self-attention, a subset of the token columns is recorded
+        ('a black cat', {'cross_replace_steps': 0.5, 'self_replace_steps': 0.5, 'blend_words': [['cat'], ['cat']],
+                         'blend_latents': True, 'blend_self_attention': True}),
+        # refine with only the blended self-attention, only the SpatialBlender layers of the blend words
+        ('a black cat', {'cross_replace_steps': 0.0, 'self_replace_steps': 0.5, 'blend_words': [['cat'], ['cat']],
+                         'blend_latents': False, 'blend_self_attention': True}),
+    ]
+    for prompt, p2p_config in edits:
+        editing_config = {'num_inference_steps': NUM_STEPS, 'prompt2prompt_edit': True,
+                          'editing_prompts': [prompt], 'p2p_config': [p2p_config]}
+        images = []
+        for use_plan in [False, True]:
+            # the inverted store of a pipeline keeps the steps of every inversion
+            pipeline = make_pipeline(**BLEND_UNET_CONFIG)
+            recording_plan = None
+            if use_plan:
+                recording_plan = make_recording_plan(pipeline.tokenizer, editing_config, source_prompt)
+                assert len(recording_plan.self_steps) < NUM_STEPS
+            latents_all = invert(pipeline, 2, prompt=source_prompt, recording_plan=recording_plan)
+            images.append(torch.from_numpy(edit(pipeline, latents_all, 2, prompt=prompt, source_prompt=source_prompt,
+                                                save_blend_mask=False, **p2p_config)))
+        # the unrecorded layers of the inversion use the fused attention, equal up to rounding
+        assert torch.allclose(images[1], images[0], atol=1e-4), (prompt, p2p_config)
+
+    # the saved inverted cross attention averages all steps and tokens
+    averages = []
+    for use_plan in [False, True]:
+        pipeline = make_pipeline(**BLEND_UNET_CONFIG)
+        recording_plan = make_recording_plan(pipeline.tokenizer, editing_config, source_prompt) if use_plan else None
+        # the averages that `show_cross_attention' would draw, without writing the video
+        pipeline.save_inverted_cross_attention = lambda prompt, save_path, store_controller=None: \
+            averages.append((store_controller or pipeline.store_controller).get_average_attention())
+        with tempfile.TemporaryDirectory() as save_path:
+            invert(pipeline, 2, prompt=source_prompt, recording_plan=recording_plan, save_path=save_path)
+    for key in ['down_cross', 'up_cross']:
+        assert len(averages[1][key]) == len(averages[0][key]) > 0
+        for average, planned_average in zip(averages[0][key], averages[1][key]):
+            assert torch.allclose(planned_average, average, atol=1e-4), key
+
+
+def test_one_frame_inversion_edits_longer_clips():
+    # the previous and first frames of SparseCausalAttention_index [-1, 'first'] are the same frame in a clip of one,
+    # the recorded self-attention still has the keys of both, as in the edits of longer clips
+    pipeline = make_pipeline()
+    latents_all = invert(pipeline, 1)
+    self_attention = pipeline.store_controller.get_step_attention(-1)['down_self'][0]
+    assert self_attention.shape[-1] == 2 * self_attention.shape[-2]
+    for num_frames in [2, 3]:
+        for shared_frame in [False, True]:
+            images = edit(pipeline, latents_all, num_frames, self_replace_steps=1.0, shared_frame=shared_frame)
+            assert images.shape == (1, num_frames, 16, 16, 3)
+
+
+def run_unet(unet, num_frames, batch_size=1):
+    "noise prediction of random latents and text embeddings"
+    generator = torch.Generator().manual_seed(2)
+    size = unet.config.sample_size
+    sample = torch.randn(batch_size, 4, num_frames, size, size, generator=generator)
+    text_embeddings = torch.randn(batch_size, 77, unet.config.cross_attention_dim, generator=generator)
+    with torch.no_grad():
+        return unet(sample, 10, encoder_hidden_states=text_embeddings).sample
+
+
+def test_controlled_attention_matches_plain():
+    # the controlled layers use `compute_attention' where no map is needed, the explicit softmax otherwise
+    pipeline = make_pipeline()
+    output = run_unet(pipeline.unet, 3, batch_size=2)
+    for controller in [attention_util.EmptyControl(), attention_util.AttentionStore()]:
+        attention_util.register_attention_control(pipeline, controller)
+        assert torch.allclose(run_unet(pipeline.unet, 3, batch_size=2), output, atol=1e-5), type(controller)
+        attention_util.register_attention_control(pipeline, None)
+    assert len(controller.step_store['down_self']) > 0 and len(controller.step_store['up_cross']) > 0
+
+
+def test_hires_attention_rows_are_chunked():
+    # 48x48 queries are recorded by blocks of QUERY_CHUNK_SIZE rows, one head attending to its own frame
+    pipeline = make_pipeline(sample_size=48, attention_head_dim=1, SparseCausalAttention_index=[0])
+    output = run_unet(pipeline.unet, 1)
+    layer = next(module for module in pipeline.unet.modules() if isinstance(module, SparseCausalAttention))
+    inputs = []
+    layer.register_forward_pre_hook(lambda module, args, kwargs: inputs.append(kwargs['hidden_states']),
+                                    with_kwargs=True)
+    controller = attention_util.AttentionStore(max_query=64 ** 2)
+    controller.LOW_RESOURCE = True
+    attention_util.register_attention_control(pipeline, controller)
+    assert torch.allclose(run_unet(pipeline.unet, 1), output, atol=1e-5)
+
+    with torch.no_grad():
+        query, key = layer.to_q(inputs[0]), layer.to_k(inputs[0])
+        expected = (torch.matmul(query, key.transpose(-1, -2)) * layer.scale).softmax(-1)
+    recorded = controller.step_store['down_hires_self'][0]
+    assert recorded.shape == (1, 1, 48 ** 2, 48 ** 2)
+    assert torch.allclose(recorded[:, 0], expected, atol=1e-6)
+
+
+def test_window_attention():
+    # the chunks of query frames and the controlled layers attend to the frames of the whole window
+    window = {'radius': 1, 'anchor_every': 2}
+    output = run_unet(make_pipeline(SparseCausalAttention_window=window).unet, 5)
+    pipeline = make_pipeline(SparseCausalAttention_window=dict(window, chunk_size=2))
+    assert torch.allclose(run_unet(pipeline.unet, 5), output, atol=1e-5)
+    attention_util.register_attention_control(pipeline, attention_util.EmptyControl())
+    assert torch.allclose(run_unet(pipeline.unet, 5), output, atol=1e-5)
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f'{name} passed')
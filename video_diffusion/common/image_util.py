@@ -117,6 +117,26 @@ def save_images_as_folder(
         else:
             cv2.imwrite(os.path.join(save_path, f"{index:05d}.png"), np.array(init_image))
 
+class FrameFolderSink:
+    """Write the frames of each generation stage to `save_path` as soon as the stage is decoded
+    Frames are named by their index in the whole video, and also appended to `save_path`.mp4
+    """
+    def __call__(self, images: np.ndarray, start_frame: int):
+        # images: [b f h w c] in [0, 1], only the first video is written
+        sequence = (images[0] * 255).round().astype("uint8")
+        for index, image in enumerate(sequence):
+            cv2.imwrite(os.path.join(self.save_path, f"{start_frame + index:05d}.png"), image[:, :, ::-1])
+            self.writer.append_data(image)
+
+    def close(self):
+        self.writer.close()
+
+    def __init__(self, save_path: str, fps: int = 10):
+        self.save_path = save_path
+        os.makedirs(save_path, exist_ok=True)
+        self.writer = imageio.get_writer(save_path.rstrip('/') + '.mp4', fps=fps)
+
+
 def log_train_samples(
     train_dataloader,
     save_path,
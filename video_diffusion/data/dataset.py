@@ -1,4 +1,6 @@
 import os
+import math
+from typing import List, Union
 
 import numpy as np
 from PIL import Image
@@ -23,7 +25,7 @@ class ImageSequenceDataset(Dataset):
         sampling_rate: int = 1,
         stride: int = -1, # only used during tuning to sample a long video
         image_mode: str = "RGB",
-        image_size: int = 512,
+        image_size: Union[int, List[int]] = 512, # or [height, width], e.g. with spatial_tile
         crop: str = "center",
                 
         class_data_root: str = None,
@@ -109,8 +111,16 @@ class ImageSequenceDataset(Dataset):
     def transform(self, frames):
         frames = self.tensorize_frames(frames)
         frames = offset_crop(frames, **self.offset)
-        frames = short_size_scale(frames, size=self.image_size)
-        frames = self.crop(frames, height=self.image_size, width=self.image_size)
+        if isinstance(self.image_size, int):
+            frames = short_size_scale(frames, size=self.image_size)
+            frames = self.crop(frames, height=self.image_size, width=self.image_size)
+        else:
+            height, width = self.image_size
+            # the scaled frames cover height x width before the crop
+            image_h, image_w = frames.shape[-2:]
+            scale = max(height / image_h, width / image_w)
+            frames = short_size_scale(frames, size=math.ceil(min(image_h, image_w) * scale))
+            frames = self.crop(frames, height=height, width=width)
         return frames
 
     @staticmethod
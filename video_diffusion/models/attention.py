@@ -4,6 +4,7 @@ from typing import Optional
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.modeling_utils import ModelMixin
@@ -27,6 +28,99 @@ if is_xformers_available():
 else:
     xformers = None
 
+# torch >= 2.0
+SDPA_AVAILABLE = hasattr(F, 'scaled_dot_product_attention')
+
+
+def compute_attention(attn: CrossAttention, query, key, value, attention_mask=None):
+    """Attention of the [(b h), n, dim_head] query, key and value of a CrossAttention layer, return [b, n, (h dim_head)].
+    The backend is xformers when enabled on the layer, then torch scaled_dot_product_attention,
+    then the eager baddbmm + softmax of diffusers, sliced if a slice size is set.
+    """
+    if attn._use_memory_efficient_attention_xformers:
+        hidden_states = attn._memory_efficient_attention_xformers(query, key, value, attention_mask)
+        # Some versions of xformers return output in fp32, cast it back to the dtype of the input
+        return hidden_states.to(query.dtype)
+    if SDPA_AVAILABLE:
+        dtype = query.dtype
+        if attn.upcast_attention:
+            query, key, value = query.float(), key.float(), value.float()
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(query.dtype)
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        return attn.reshape_batch_dim_to_heads(hidden_states.to(dtype))
+    if attn._slice_size is None or query.shape[0] // attn._slice_size == 1:
+        return attn._attention(query, key, value, attention_mask)
+    return attn._sliced_attention(query, key, value, query.shape[1], query.shape[-1] * attn.heads, attention_mask)
+
+
+def get_sparse_causal_frames(clip_length: int, SparseCausalAttention_index: list, dedupe: bool = True) -> list:
+    """Key frames of each entry of SparseCausalAttention_index: an int for an anchor frame shared by all frames,
+    a LongTensor [clip_length] for a relative offset.
+    With dedupe, repeated entries are kept once if all entries repeat equally often, the softmax is then unchanged.
+    Without it, there is one entry per index whatever clip_length, e.g. for the recorded attention maps,
+    whose keys must match between a 1-frame inversion and a multi-frame edit.
+    """
+    frames, counts = [], []
+    for index in SparseCausalAttention_index:
+        if isinstance(index, str):
+            if index == 'first':
+                frame = 0
+            elif index == 'last':
+                frame = clip_length - 1
+            elif (index == 'mid') or (index == 'middle'):
+                frame = int(clip_length - 1) // 2
+            else:
+                raise ValueError(f'unknown SparseCausalAttention_index {index}')
+        else:
+            assert isinstance(index, int), 'relative index must be int'
+            frame = (torch.arange(clip_length) + index).clip(0, clip_length - 1)
+            if (frame == frame[0]).all():
+                # e.g. a clip of one frame
+                frame = int(frame[0])
+        for i, other in enumerate(frames if dedupe else []):
+            if type(frame) == type(other) and (frame == other if isinstance(frame, int) else torch.equal(frame, other)):
+                counts[i] += 1
+                break
+        else:
+            frames.append(frame)
+            counts.append(1)
+    if len(set(counts)) > 1:
+        # the repeated frames weigh more in the softmax
+        return [frame for frame, count in zip(frames, counts) for _ in range(count)]
+    return frames
+
+
+def get_sparse_causal_window_frames(clip_length: int, radius: int = 1, anchor_every: int = 8, num_anchors: int = 1,
+                                    causal: bool = False) -> list:
+    """Key frames of the windowed sparse-causal attention, LongTensors [clip_length] as relative entries of
+    `get_sparse_causal_frames': the frames within radius (only the previous ones if causal),
+    and the last num_anchors frames at multiples of anchor_every up to each frame.
+    Every frame attends to the same number of frames, whatever the clip length.
+    """
+    frame_index = torch.arange(clip_length)
+    offsets = range(-radius, 1) if causal else range(-radius, radius + 1)
+    frames = [(frame_index + offset).clip(0, clip_length - 1) for offset in offsets]
+    anchor = frame_index // anchor_every * anchor_every
+    frames += [(anchor - i * anchor_every).clip(min=0) for i in range(num_anchors)]
+    return frames
+
+
+def gather_sparse_causal_frames(tensor: torch.Tensor, clip_length: int, frames: list) -> torch.Tensor:
+    """[(b f), d, c] key or value to the [(b f'), d * len(frames), c] of the frames attended by each frame,
+    f' is the length of the relative entries, e.g. a chunk of the clip, or clip_length.
+    Anchor frames are broadcast views, the only copy is the concatenation.
+    """
+    tensor = rearrange(tensor, "(b f) d c -> b f d c", f=clip_length)
+    gathered = []
+    for frame in frames:
+        if isinstance(frame, int):
+            gathered.append(tensor[:, frame:frame + 1].expand(-1, clip_length, -1, -1))
+        else:
+            gathered.append(tensor[:, frame.to(tensor.device)])
+    tensor = torch.cat(gathered, dim=2) if len(gathered) > 1 else gathered[0]
+    return rearrange(tensor, "b f d c -> (b f) d c")
+
 
 class SpatioTemporalTransformerModel(ModelMixin, ConfigMixin):
     @register_to_config
@@ -101,11 +195,8 @@ class SpatioTemporalTransformerModel(ModelMixin, ConfigMixin):
         if is_video:
             clip_length = hidden_states.shape[2]
             hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
-            encoder_hidden_states = encoder_hidden_states.repeat_interleave(clip_length, 0)
-        else:
-            # To adapt to classifier-free guidance where encoder_hidden_states=2
-            batch_size = hidden_states.shape[0]//encoder_hidden_states.shape[0]
-            encoder_hidden_states = encoder_hidden_states.repeat_interleave(batch_size, 0)
+        # encoder_hidden_states is not repeated for frames (or classifier-free guidance where encoder_hidden_states=2),
+        # TextCrossAttention broadcasts its key and value to the batch of hidden_states
         *_, h, w = hidden_states.shape
         residual = hidden_states
 
@@ -171,6 +262,7 @@ class SpatioTemporalTransformerBlock(nn.Module):
         if 'least_sc_channel' in model_config:
             if dim< model_config['least_sc_channel']:
                 self.model_config['SparseCausalAttention_index'] = []
+                self.model_config['SparseCausalAttention_window'] = None
         
         self.temporal_attention_position = temporal_attention_position
         temporal_attention_positions = ["after_spatial", "after_cross", "after_feedforward"]
@@ -196,7 +288,7 @@ class SpatioTemporalTransformerBlock(nn.Module):
 
         # 2. Cross-Attn
         if cross_attention_dim is not None:
-            self.attn2 = CrossAttention(
+            self.attn2 = TextCrossAttention(
                 query_dim=dim,
                 cross_attention_dim=cross_attention_dim,
                 heads=num_attention_heads,
@@ -286,11 +378,14 @@ class SpatioTemporalTransformerBlock(nn.Module):
             attention_mask=attention_mask,
         )
         if self.only_cross_attention:
-            kwargs.update(encoder_hidden_states=encoder_hidden_states)
+            repeat = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+            kwargs.update(encoder_hidden_states=encoder_hidden_states.repeat_interleave(repeat, 0))
         if self.use_sparse_causal_attention:
             kwargs.update(clip_length=clip_length)
         if 'SparseCausalAttention_index' in self.model_config.keys():
             kwargs.update(SparseCausalAttention_index = self.model_config['SparseCausalAttention_index'])
+        if self.model_config.get('SparseCausalAttention_window', None) is not None:
+            kwargs.update(SparseCausalAttention_window = self.model_config['SparseCausalAttention_window'])
         
         hidden_states = hidden_states + self.attn1(**kwargs)
 
@@ -337,6 +432,91 @@ class SpatioTemporalTransformerBlock(nn.Module):
         return hidden_states
 
 
+class TextCrossAttention(CrossAttention):
+    """
+    Cross attention to the text embeddings shared by all frames of a video.
+    encoder_hidden_states has shape [b, 77, 768] while hidden_states has shape [(b f), d, c].
+    The text key and value are projected once, cached across denoising steps by the identity of encoder_hidden_states,
+    and shared by the frames, which are folded into the query sequence.
+    """
+    def get_text_key_value(self, encoder_hidden_states):
+        "Return key and value of shape [(b heads), 77, dim_head]"
+        cache = getattr(self, '_text_key_value_cache', None)
+        if cache is not None and cache[0] is encoder_hidden_states and not torch.is_grad_enabled():
+            _, key, value = cache
+        else:
+            key = self.reshape_heads_to_batch_dim(self.to_k(encoder_hidden_states))
+            value = self.reshape_heads_to_batch_dim(self.to_v(encoder_hidden_states))
+            # Only cache in inference, training needs a new graph at every step
+            self._text_key_value_cache = None if torch.is_grad_enabled() else (encoder_hidden_states, key, value)
+        return key, value
+
+    def clear_text_key_value_cache(self):
+        "Release the cached encoder_hidden_states and its key and value, e.g. when a pipeline call returns"
+        self._text_key_value_cache = None
+
+    def expand_to_frames(self, tensor, repeat: int):
+        """[(b heads), 77, dim_head] -> [(b repeat heads), 77, dim_head], a copy per frame,
+        only used where the attention maps of each frame are needed, e.g. an attention mask or a controller
+        """
+        if repeat == 1:
+            return tensor
+        tensor = rearrange(tensor, "(b h) n d -> b 1 h n d", h=self.heads)
+        tensor = tensor.expand(-1, repeat, -1, -1, -1)
+        return rearrange(tensor, "b f h n d -> (b f h) n d")
+
+    def text_attention(self, hidden_states, encoder_hidden_states):
+        """Attention of the [(b f), d, c] frames to the [b, 77, 768] text, return [(b f), d, (heads dim_head)].
+        The frames are folded into the query sequence, so the key and value are never copied per frame.
+        """
+        key, value = self.get_text_key_value(encoder_hidden_states)
+        clip_length = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+        hidden_states = rearrange(hidden_states, "(b f) d c -> b (f d) c", f=clip_length)
+        query = self.reshape_heads_to_batch_dim(self.to_q(hidden_states))
+        hidden_states = compute_attention(self, query, key, value)
+        return rearrange(hidden_states, "b (f d) c -> (b f) d c", f=clip_length)
+
+    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
+        if (
+            self.added_kv_proj_dim is not None
+            or encoder_hidden_states is None
+        ):
+            if encoder_hidden_states is not None:
+                repeat = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+                encoder_hidden_states = encoder_hidden_states.repeat_interleave(repeat, 0)
+            return super().forward(hidden_states, encoder_hidden_states, attention_mask)
+
+        batch_size, sequence_length, _ = hidden_states.shape
+        if self.group_norm is not None:
+            hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        if attention_mask is None:
+            hidden_states = self.text_attention(hidden_states, encoder_hidden_states)
+        else:
+            # the mask is given per frame
+            query = self.to_q(hidden_states)
+            query = self.reshape_heads_to_batch_dim(query)
+
+            key, value = self.get_text_key_value(encoder_hidden_states)
+            repeat = batch_size // encoder_hidden_states.shape[0]
+            key = self.expand_to_frames(key, repeat)
+            value = self.expand_to_frames(value, repeat)
+
+            if attention_mask.shape[-1] != query.shape[1]:
+                target_length = query.shape[1]
+                attention_mask = F.pad(attention_mask, (0, target_length), value=0.0)
+                attention_mask = attention_mask.repeat_interleave(self.heads, dim=0)
+
+            hidden_states = compute_attention(self, query, key, value, attention_mask)
+
+        # linear proj
+        hidden_states = self.to_out[0](hidden_states)
+
+        # dropout
+        hidden_states = self.to_out[1](hidden_states)
+        return hidden_states
+
+
 class SparseCausalAttention(CrossAttention):
     def forward(
         self,
@@ -344,8 +524,13 @@ class SparseCausalAttention(CrossAttention):
         encoder_hidden_states=None,
         attention_mask=None,
         clip_length: int = None,
-        SparseCausalAttention_index: list = [-1, 'first']
+        SparseCausalAttention_index: list = [-1, 'first'],
+        SparseCausalAttention_window: dict = None
     ):
+        """SparseCausalAttention_window, e.g. {radius: 1, anchor_every: 8, chunk_size: 8}, replaces
+        SparseCausalAttention_index with the frames of `get_sparse_causal_window_frames',
+        the queries are processed by chunks of chunk_size frames.
+        """
         if (
             self.added_kv_proj_dim is not None
             or encoder_hidden_states is not None
@@ -356,63 +541,67 @@ class SparseCausalAttention(CrossAttention):
         if self.group_norm is not None:
             hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = self.to_q(hidden_states)
-        dim = query.shape[-1]
-        query = self.reshape_heads_to_batch_dim(query)
-
-        key = self.to_k(hidden_states)
-        value = self.to_v(hidden_states)
-
-        if clip_length is not None:
-            key = rearrange(key, "(b f) d c -> b f d c", f=clip_length)
-            value = rearrange(value, "(b f) d c -> b f d c", f=clip_length)
+        frames = None
+        if clip_length is not None and SparseCausalAttention_window is not None:
+            window = dict(SparseCausalAttention_window)
+            chunk_size = window.pop('chunk_size', None) or clip_length
+            frames = get_sparse_causal_window_frames(clip_length, **window)
+        elif clip_length is not None and len(SparseCausalAttention_index) > 0:
+            frames = get_sparse_causal_frames(clip_length, SparseCausalAttention_index)
+
+        if SparseCausalAttention_window is not None and frames is not None:
+            # memory of the gathered key and value and of the scores grows with chunk_size, not clip_length
+            query = rearrange(self.to_q(hidden_states), "(b f) d c -> b f d c", f=clip_length)
+            key = self.to_k(hidden_states)
+            value = self.to_v(hidden_states)
+            hidden_states = []
+            for start in range(0, clip_length, chunk_size):
+                chunk_frames = [frame[start:start + chunk_size] for frame in frames]
+                chunk_query = rearrange(query[:, start:start + chunk_size], "b f d c -> (b f) d c")
+                chunk_key = gather_sparse_causal_frames(key, clip_length, chunk_frames)
+                chunk_value = gather_sparse_causal_frames(value, clip_length, chunk_frames)
+                hidden_states.append(rearrange(
+                    compute_attention(self, self.reshape_heads_to_batch_dim(chunk_query),
+                                      self.reshape_heads_to_batch_dim(chunk_key),
+                                      self.reshape_heads_to_batch_dim(chunk_value)),
+                    "(b f) d c -> b f d c", f=len(chunk_frames[0])))
+            hidden_states = rearrange(torch.cat(hidden_states, dim=1), "b f d c -> (b f) d c")
+        elif frames is not None and all(isinstance(frame, int) for frame in frames):
+            # every frame attends to the same anchor frames, e.g. ['mid']:
+            # project key and value of the anchors only and fold the frames into the query sequence
+            hidden_states = rearrange(hidden_states, "(b f) d c -> b f d c", f=clip_length)
+            query = self.reshape_heads_to_batch_dim(self.to_q(rearrange(hidden_states, "b f d c -> b (f d) c")))
+            # set by FrameChunkedUNet, the windows of a clip share the key and value of its anchor frames
+            shared_anchor = getattr(self, 'shared_anchor', None)
+            if shared_anchor is not None and shared_anchor.key_value is not None:
+                key, value = shared_anchor.key_value
+            else:
+                if shared_anchor is not None:
+                    frames = shared_anchor.frames
+                anchors = rearrange(hidden_states[:, frames], "b k d c -> b (k d) c")
+                key = self.reshape_heads_to_batch_dim(self.to_k(anchors))
+                value = self.reshape_heads_to_batch_dim(self.to_v(anchors))
+                if shared_anchor is not None:
+                    shared_anchor.key_value = key, value
+            hidden_states = compute_attention(self, query, key, value)
+            hidden_states = rearrange(hidden_states, "b (f d) c -> (b f) d c", f=clip_length)
+        else:
+            query = self.to_q(hidden_states)
+            query = self.reshape_heads_to_batch_dim(query)
 
+            key = self.to_k(hidden_states)
+            value = self.to_v(hidden_states)
 
             #  *********************** Start of Spatial-temporal attention **********
-            frame_index_list = []
-            # print(f'SparseCausalAttention_index {str(SparseCausalAttention_index)}')
-            if len(SparseCausalAttention_index) > 0:
-                for index in SparseCausalAttention_index:
-                    if isinstance(index, str):
-                        if index == 'first':
-                            frame_index = [0] * clip_length
-                        if index == 'last':
-                            frame_index = [clip_length-1] * clip_length
-                        if (index == 'mid') or (index == 'middle'):
-                            frame_index = [int(clip_length-1)//2] * clip_length
-                    else:
-                        assert isinstance(index, int), 'relative index must be int'
-                        frame_index = torch.arange(clip_length) + index
-                        frame_index = frame_index.clip(0, clip_length-1)
-                        
-                    frame_index_list.append(frame_index)
-                
-                key = torch.cat([   key[:, frame_index] for frame_index in frame_index_list
-                                    ], dim=2)
-                value = torch.cat([ value[:, frame_index] for frame_index in frame_index_list
-                                    ], dim=2)
+            if frames is not None:
+                key = gather_sparse_causal_frames(key, clip_length, frames)
+                value = gather_sparse_causal_frames(value, clip_length, frames)
+            #  *********************** End of Spatial-temporal attention **********
 
+            key = self.reshape_heads_to_batch_dim(key)
+            value = self.reshape_heads_to_batch_dim(value)
 
-            #  *********************** End of Spatial-temporal attention **********
-            key = rearrange(key, "b f d c -> (b f) d c", f=clip_length)
-            value = rearrange(value, "b f d c -> (b f) d c", f=clip_length)
-        
-        
-        key = self.reshape_heads_to_batch_dim(key)
-        value = self.reshape_heads_to_batch_dim(value)
-        
-        
-        if self._use_memory_efficient_attention_xformers:
-            hidden_states = self._memory_efficient_attention_xformers(query, key, value, attention_mask)
-            # Some versions of xformers return output in fp32, cast it back to the dtype of the input
-            hidden_states = hidden_states.to(query.dtype)
-        else:
-            if self._slice_size is None or query.shape[0] // self._slice_size == 1:
-                hidden_states = self._attention(query, key, value, attention_mask)
-            else:
-                hidden_states = self._sliced_attention(
-                    query, key, value, hidden_states.shape[1], dim, attention_mask
-                )
+            hidden_states = compute_attention(self, query, key, value, attention_mask)
 
         # linear proj
         hidden_states = self.to_out[0](hidden_states)
@@ -0,0 +1,137 @@
+"""
+Frame-chunked inference of UNetPseudo3DConditionModel.
+The clip is split into overlapping temporal windows denoised one at a time, the noise predictions of the overlapping
+frames are fused with per-frame weights, so the peak memory is bounded by the window size instead of the clip length.
+Used by `P2pDDIMSpatioTemporalPipeline.sd_ddim_pipeline` with `frame_chunk` in p2p_config.
+"""
+
+from typing import List, Sequence, Union
+
+import torch
+
+from .attention import SpatioTemporalTransformerBlock, SparseCausalAttention, get_sparse_causal_frames
+from .unet_3d_condition import UNetPseudo3DConditionModel, UNetPseudo3DConditionOutput
+
+
+class SharedAnchorKeyValue:
+    """Key and value of the anchor frames of a SparseCausalAttention layer, projected in the first window
+    and reused by the other windows, so that all windows attend to the same anchor frames of the clip.
+
+    Args:
+        frames (List[int]): anchor frames in the first window
+    """
+    def __init__(self, frames: List[int]):
+        self.frames = frames
+        self.key_value = None
+
+
+class FrameChunkedUNet:
+    """Call a UNetPseudo3DConditionModel on overlapping windows of window_frames frames.
+
+    Args:
+        unet (UNetPseudo3DConditionModel):
+        window_frames (int, optional): frames of a window. Defaults to 16.
+        overlap (int, optional): frames shared by adjacent windows. Defaults to 4.
+        fusion (Union[str, Sequence[float]], optional): weight of each frame of a window in the fused prediction,
+            `linear' ramps over the overlapping frames, `uniform' averages them, or a list of window_frames positive weights.
+            Defaults to 'linear'.
+        share_anchor (bool, optional): the anchor frames of `SparseCausalAttention_index', e.g. ['mid'],
+            are the ones of the full clip in every window. Defaults to True.
+    """
+    FUSIONS = ['linear', 'uniform']
+
+    def get_windows(self, num_frames: int) -> List[int]:
+        "start frame of each window, the last window ends at the last frame"
+        stride = self.window_frames - self.overlap
+        starts = list(range(0, num_frames - self.window_frames + 1, stride))
+        if starts[-1] + self.window_frames < num_frames:
+            starts.append(num_frames - self.window_frames)
+        return starts
+
+    def get_frame_weight(self, start: int, num_frames: int) -> torch.Tensor:
+        "[window_frames] fusion weight of the window at start, frames at the clip borders are never ramped"
+        if not isinstance(self.fusion, str):
+            return torch.tensor(self.fusion, dtype=torch.float32)
+        weight = torch.ones(self.window_frames)
+        if self.fusion == 'linear' and self.overlap > 0:
+            ramp = torch.arange(1, self.overlap + 1, dtype=torch.float32) / (self.overlap + 1)
+            if start > 0:
+                weight[:self.overlap] = ramp
+            if start + self.window_frames < num_frames:
+                weight[-self.overlap:] = ramp.flip(0)
+        return weight
+
+    def get_shared_anchors(self, num_frames: int, starts: List[int]):
+        """[(layer, SharedAnchorKeyValue)] of the layers whose frames are only anchors,
+        and the start of the window holding all anchor frames of the clip, None if no window holds them
+        """
+        anchor_layers, anchor_frames = [], set()
+        for block in self.unet.modules():
+            if not isinstance(block, SpatioTemporalTransformerBlock) or not isinstance(block.attn1, SparseCausalAttention):
+                continue
+            if block.model_config.get('SparseCausalAttention_window', None) is not None:
+                continue
+            index = block.model_config.get('SparseCausalAttention_index', [-1, 'first'])
+            if len(index) == 0:
+                continue
+            frames = get_sparse_causal_frames(num_frames, index)
+            if not all(isinstance(frame, int) for frame in frames):
+                # relative frames are within the window anyway
+                continue
+            anchor_layers.append((block.attn1, frames))
+            anchor_frames.update(frames)
+        for start in starts:
+            if all(start <= frame < start + self.window_frames for frame in anchor_frames):
+                return [(layer, SharedAnchorKeyValue([frame - start for frame in frames]))
+                        for layer, frames in anchor_layers], start
+        return [], None
+
+    def __call__(self, sample: torch.FloatTensor, timestep, encoder_hidden_states: torch.Tensor, **kwargs):
+        num_frames = sample.shape[2]
+        if num_frames <= self.window_frames:
+            return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, **kwargs)
+        starts = self.get_windows(num_frames)
+        shared_anchors, anchor_start = self.get_shared_anchors(num_frames, starts) if self.share_anchor else ([], None)
+        if anchor_start is not None:
+            # the window of the anchor frames projects their key and value first
+            starts.remove(anchor_start)
+            starts.insert(0, anchor_start)
+
+        fused, weight_sum = None, torch.zeros(num_frames, device=sample.device)
+        try:
+            for layer, shared_anchor in shared_anchors:
+                layer.shared_anchor = shared_anchor
+            for start in starts:
+                end = start + self.window_frames
+                noise_pred = self.unet(sample[:, :, start:end], timestep,
+                                       encoder_hidden_states=encoder_hidden_states, **kwargs)[0]
+                if fused is None:
+                    fused = torch.zeros(*noise_pred.shape[:2], num_frames, *noise_pred.shape[3:],
+                                        device=noise_pred.device, dtype=torch.float32)
+                weight = self.get_frame_weight(start, num_frames).to(sample.device)
+                fused[:, :, start:end] += noise_pred.float() * weight[:, None, None]
+                weight_sum[start:end] += weight
+        finally:
+            for layer, _ in shared_anchors:
+                layer.shared_anchor = None
+        fused = (fused / weight_sum[:, None, None]).to(sample.dtype)
+        if not kwargs.get('return_dict', True):
+            return (fused,)
+        return UNetPseudo3DConditionOutput(sample=fused)
+
+    def __init__(self, unet: UNetPseudo3DConditionModel, window_frames: int = 16, overlap: int = 4,
+                 fusion: Union[str, Sequence[float]] = 'linear', share_anchor: bool = True):
+        if not 0 <= overlap < window_frames:
+            raise ValueError(f"overlap must be in [0, window_frames), not {overlap}")
+        if isinstance(fusion, str) and fusion not in self.FUSIONS:
+            raise ValueError(f"fusion must be one of {self.FUSIONS} or a list of weights, not {fusion}")
+        if not isinstance(fusion, str) and len(fusion) != window_frames:
+            raise ValueError(f"fusion needs {window_frames} weights, not {len(fusion)}")
+        if not isinstance(fusion, str) and min(fusion) <= 0:
+            # a frame covered only by zero weights would be divided by 0
+            raise ValueError(f"fusion weights must be positive, not {list(fusion)}")
+        self.unet = unet
+        self.window_frames = window_frames
+        self.overlap = overlap
+        self.fusion = fusion
+        self.share_anchor = share_anchor
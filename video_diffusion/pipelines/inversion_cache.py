@@ -0,0 +1,131 @@
+"""
+Persistent cache of DDIM inversion used in `P2pDDIMSpatioTemporalPipeline.prepare_latents_ddim_inverted`
+An entry holds `latents_all_step' and the inverted AttentionStore, addressed by a hash of
+the input frames, source prompt embedding, checkpoint files, UNet and attention config, scheduler config, step count, recording plan, storage codec, kept steps and largest recorded resolution.
+Edits of the same source clip with other target prompts or p2p_config skip the inversion.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from typing import List, Optional
+
+import torch
+
+from video_diffusion.prompt_attention.attention_cache import AttentionFileStore, AttentionCacheManager
+
+
+def update_tensor_hash(hasher, tensor: torch.Tensor):
+    "Feed the shape, dtype and raw bytes of a tensor to a hashlib object"
+    tensor = tensor.detach().contiguous().cpu()
+    hasher.update(f'{tuple(tensor.shape)}{tensor.dtype}'.encode())
+    hasher.update(tensor.reshape(-1).view(torch.uint8).numpy())
+
+
+def update_checkpoint_hash(hasher, model_path: str):
+    "Feed the relative path, size and mtime of every file of a checkpoint folder, instead of reading the weights"
+    for root, _, files in sorted(os.walk(model_path)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            hasher.update(f'{os.path.relpath(path, model_path)}_{stat.st_size}_{stat.st_mtime_ns}'.encode())
+
+
+def update_model_config_hash(hasher, unet: torch.nn.Module):
+    """Feed the config of the UNet and the model_config of each of its modules, e.g. SparseCausalAttention_index
+    after least_sc_channel, which change the inversion without changing the weights
+    """
+    hasher.update(json.dumps(dict(getattr(unet, 'config', {})), sort_keys=True, default=str).encode())
+    for name, module in unet.named_modules():
+        model_config = getattr(module, 'model_config', None)
+        if isinstance(model_config, dict):
+            hasher.update(f'{name}{json.dumps(model_config, sort_keys=True, default=str)}'.encode())
+
+
+class InversionCache:
+    """Content-addressed cache of DDIM inversion in `cache_dir/inversion_<key>'
+
+    Args:
+        cache_dir (str, optional): Defaults to './trash/inversion_cache'.
+        quota_gb (float, optional): byte budget, least recently used entries are evicted. Defaults to 20.
+    """
+    def get_key(self, image: torch.Tensor, text_embeddings: torch.Tensor, prompt: str,
+                unet: torch.nn.Module, scheduler, store_attention: bool, recording_plan=None,
+                attention_codec: str = 'none', self_attention_rank: Optional[int] = None,
+                step_subset=None, max_query: int = 32 ** 2, model_path: Optional[str] = None) -> str:
+        """model_path is the checkpoint folder the weights were loaded from, hashed by file sizes and mtimes.
+        Without it, e.g. for weights changed in memory, the UNet weights are hashed.
+        """
+        hasher = hashlib.blake2b(digest_size=20)
+        update_tensor_hash(hasher, image)
+        update_tensor_hash(hasher, text_embeddings)
+        hasher.update(str(prompt).encode())
+        if model_path is not None:
+            update_checkpoint_hash(hasher, model_path)
+        else:
+            for name, tensor in unet.state_dict().items():
+                hasher.update(name.encode())
+                update_tensor_hash(hasher, tensor)
+        update_model_config_hash(hasher, unet)
+        hasher.update(json.dumps(dict(scheduler.config), sort_keys=True, default=str).encode())
+        hasher.update(f'{len(scheduler.timesteps)}_{store_attention}'.encode())
+        if recording_plan is not None:
+            hasher.update(recording_plan.get_signature().encode())
+        hasher.update(f'{attention_codec}_{self_attention_rank}'.encode())
+        if step_subset is not None:
+            hasher.update(step_subset.get_signature().encode())
+        if max_query != 32 ** 2:
+            hasher.update(f'max_query_{max_query}'.encode())
+        return hasher.hexdigest()
+
+    def get_entry(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'inversion_{key}')
+
+    def load(self, key: str, store_controller=None, device=None) -> Optional[List[torch.Tensor]]:
+        """Return the cached latents_all_step and restore store_controller if given, None on a cache miss"""
+        entry = self.get_entry(key)
+        attention_path = os.path.join(entry, 'attention.bin')
+        # the attention file is memory-mapped for the rest of the run, other runs must not evict the entry
+        self.manager.acquire(entry)
+        if not os.path.isdir(entry) or (store_controller is not None and not os.path.isfile(attention_path)):
+            self.manager.release(entry)
+            return None
+        state = torch.load(os.path.join(entry, 'latents.pt'), map_location='cpu')
+        if store_controller is not None:
+            store_controller.load_inverted_state(state['store'], AttentionFileStore.open(attention_path), device)
+        # mark as recently used for the eviction
+        os.utime(entry)
+        return [latents.to(device) for latents in state['latents_all_step']]
+
+    def save(self, key: str, latents_all_step: List[torch.Tensor], store_controller=None):
+        entry = self.get_entry(key)
+        if os.path.isdir(entry):
+            return
+        self.manager.evict()
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp_entry, exist_ok=True)
+        state = {'latents_all_step': [latents.cpu() for latents in latents_all_step]}
+        if store_controller is not None:
+            state['store'] = store_controller.get_inverted_state()
+            attention_store_all_step = store_controller.attention_store_all_step
+            attention_path = os.path.join(tmp_entry, 'attention.bin')
+            if isinstance(attention_store_all_step, AttentionFileStore):
+                attention_store_all_step.flush()
+                shutil.copyfile(attention_store_all_step.path, attention_path)
+                shutil.copyfile(attention_store_all_step.path + '.json', attention_path + '.json')
+            else:
+                file_store = AttentionFileStore(attention_path)
+                for step in range(len(attention_store_all_step)):
+                    file_store.append(attention_store_all_step[step])
+                file_store.flush()
+        torch.save(state, os.path.join(tmp_entry, 'latents.pt'))
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # another process saved the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def __init__(self, cache_dir: str = './trash/inversion_cache', quota_gb: float = 20):
+        self.cache_dir = cache_dir
+        self.manager = AttentionCacheManager(cache_dir, quota_gb=quota_gb, prefix='inversion')
@@ -2,6 +2,7 @@
 
 from typing import Callable, List, Optional, Union
 import os, sys
+import json
 import PIL
 import torch
 import numpy as np
@@ -23,8 +24,14 @@ from diffusers.schedulers import (
 )
 
 from ..models.unet_3d_condition import UNetPseudo3DConditionModel
+from ..models.frame_chunked_unet import FrameChunkedUNet
 from .stable_diffusion import SpatioTemporalStableDiffusionPipeline
+from .style_schedule import StyleSchedule, make_style_schedule
+from .inversion_cache import InversionCache
+from .spatial_tiling import SpatialTiling, TileControllers
 from video_diffusion.prompt_attention import attention_util
+from video_diffusion.prompt_attention.recording_plan import RecordingPlan
+from video_diffusion.common.image_util import FrameFolderSink
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
@@ -36,10 +43,25 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
         tokenizer: CLIPTokenizer,
         unet: UNetPseudo3DConditionModel,
         scheduler: Union[DDIMScheduler, PNDMScheduler, LMSDiscreteScheduler, EulerDiscreteScheduler, EulerAncestralDiscreteScheduler, DPMSolverMultistepScheduler,],
-        disk_store: bool=False
+        disk_store: bool=False,
+        tier_budget: Optional[Union[str, dict]]=None,
+        attention_codec: str='none',
+        codec_report: bool=False,
+        self_attention_rank: Optional[int]=None,
+        step_subset: Optional[dict]=None,
+        max_recorded_query: int=32**2,
+        spatial_tile: Optional[dict]=None
         ):
         super().__init__(vae, text_encoder, tokenizer, unet, scheduler)
-        self.store_controller = attention_util.AttentionStore(disk_store=disk_store)
+        self.store_kwargs = dict(disk_store=disk_store, tier_budget=tier_budget,
+                                 attention_codec=attention_codec, codec_report=codec_report,
+                                 self_attention_rank=self_attention_rank,
+                                 step_subset=step_subset,
+                                 max_query=max_recorded_query)
+        self.store_controller = attention_util.AttentionStore(**self.store_kwargs)
+        # {tile_size, overlap} of SpatialTiling, the inversion then records one store per tile
+        self.spatial_tiling = SpatialTiling(**spatial_tile) if spatial_tile is not None else None
+        self.tile_store_controllers = None
         self.empty_controller = attention_util.EmptyControl()
     r"""
     Pipeline for text-to-video generation using Spatio-Temporal Stable Diffusion.
@@ -71,10 +93,42 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
                                         store_attention=False, prompt=None,
                                         generator=None,
                                         LOW_RESOURCE = True,
-                                        save_path = None
+                                        save_path = None,
+                                        inversion_cache_dir: Optional[str] = None,
+                                        recording_plan: Optional[RecordingPlan] = None,
+                                        model_path: Optional[str] = None
                                       ):
+        """DDIM inversion of image, record the attention of all steps in self.store_controller if store_attention.
+        With inversion_cache_dir, the inversion of the same frames, prompt, unet and scheduler is loaded from
+        the cache instead of computed. model_path, the checkpoint folder of the weights, keys the cache
+        without hashing the weights.
+        With recording_plan, only the attention consumed by the later edits is recorded, and all the cross
+        attention if it is saved under save_path.
+        """
         self.prepare_before_train_loop()
-        if store_attention:
+        if recording_plan is not None and store_attention and save_path is not None:
+            # the saved cross attention is averaged over all steps and tokens, not only the consumed ones
+            recording_plan = recording_plan.with_all_cross_attention()
+        self.store_controller.recording_plan = recording_plan
+        inversion_cache = None
+        if self.spatial_tiling is not None and inversion_cache_dir is not None:
+            print('The inversion cache holds a single attention store, it is not used with spatial tiles')
+            inversion_cache_dir = None
+        if inversion_cache_dir is not None:
+            inversion_cache = InversionCache(inversion_cache_dir)
+            cache_key = inversion_cache.get_key(image, text_embeddings, prompt, self.unet, self.scheduler, store_attention,
+                                                recording_plan, self.store_controller.attention_codec,
+                                                self.store_controller.self_attention_rank,
+                                                self.store_controller.step_subset,
+                                                self.store_controller.max_query, model_path)
+            ddim_latents_all_step = inversion_cache.load(cache_key, self.store_controller if store_attention else None,
+                                                         device=image.device)
+            if ddim_latents_all_step is not None:
+                print(f'Load DDIM inversion from cache {inversion_cache.get_entry(cache_key)}')
+                if store_attention and (save_path is not None):
+                    self.save_inverted_cross_attention(prompt, save_path)
+                return ddim_latents_all_step
+        if store_attention and self.spatial_tiling is None:
             attention_util.register_attention_control(self, self.store_controller)
         resource_default_value = self.store_controller.LOW_RESOURCE
         self.store_controller.LOW_RESOURCE = LOW_RESOURCE  # in inversion, no CFG, record all latents attention
@@ -90,6 +144,11 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
                 self.vae.encode(image[i : i + 1]).latent_dist.sample(generator[i]) for i in range(batch_size)
             ]
             init_latents = torch.cat(init_latents, dim=0)
+        elif self.spatial_tiling is not None:
+            # the VAE encodes the pixels of the latent tiles
+            init_latents = self.spatial_tiling.fuse(
+                image, lambda index, tile: self.vae.encode(tile).latent_dist.sample(generator),
+                in_scale=self.vae_scale_factor)
         else:
             init_latents = self.vae.encode(image).latent_dist.sample(generator)
 
@@ -115,18 +174,54 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
 
         # get latents
         init_latents_bcfhw = rearrange(init_latents, "(b f) c h w -> b c f h w", b=batch_size)
-        ddim_latents_all_step = self.ddim_clean2noisy_loop(init_latents_bcfhw, text_embeddings, self.store_controller)
+        store_controller = self.store_controller
+        if self.spatial_tiling is not None and store_attention:
+            # one store per tile, each records the attention of its own UNet call at every step
+            tiles = self.spatial_tiling.get_tiles(*init_latents.shape[-2:])
+            self.tile_store_controllers = [attention_util.AttentionStore(**self.store_kwargs) for _ in tiles]
+            for tile_store_controller in self.tile_store_controllers:
+                tile_store_controller.recording_plan = recording_plan
+                tile_store_controller.LOW_RESOURCE = LOW_RESOURCE
+            store_controller = TileControllers(self.tile_store_controllers, self.spatial_tiling)
+            attention_util.register_attention_control(self, store_controller)
+        if store_attention:
+            store_controller.reserve_steps(len(self.scheduler.timesteps))
+        ddim_latents_all_step = self.ddim_clean2noisy_loop(init_latents_bcfhw, text_embeddings, store_controller)
+        self.clear_text_key_value_cache()
+        # the reports of the first tile with spatial tiles
+        report_controller = store_controller.controllers[0] if isinstance(store_controller, TileControllers) \
+            else store_controller
         if store_attention and (save_path is not None) :
-            os.makedirs(save_path+'/cross_attention')
-            attention_output = attention_util.show_cross_attention(self.tokenizer, prompt, 
-                                                                   self.store_controller, 16, ["up", "down"],
-                                                                   save_path = save_path+'/cross_attention')
-
-            # Detach the controller for safety
-            attention_util.register_attention_control(self, self.empty_controller)
+            self.save_inverted_cross_attention(prompt, save_path, report_controller)
+        if store_attention and report_controller.codec_report is not None:
+            codec_report = report_controller.codec_report.summary()
+            print(f'Reconstruction error of attention codecs: {codec_report}')
+            if save_path is not None:
+                with open(os.path.join(save_path, 'attention_codec_report.json'), 'w') as f:
+                    json.dump(codec_report, f, indent=2)
+        step_subset = report_controller.step_subset
+        if store_attention and step_subset is not None and step_subset.report is not None:
+            step_subset_report = step_subset.report.summary()
+            print(f'Memory and error of the kept attention steps: {step_subset_report}')
+            if save_path is not None:
+                with open(os.path.join(save_path, 'attention_step_subset_report.json'), 'w') as f:
+                    json.dump(step_subset_report, f, indent=2)
         self.store_controller.LOW_RESOURCE = resource_default_value
+        if inversion_cache is not None:
+            inversion_cache.save(cache_key, ddim_latents_all_step, self.store_controller if store_attention else None)
         
         return ddim_latents_all_step
+
+    def save_inverted_cross_attention(self, prompt, save_path, store_controller=None):
+        if store_controller is None:
+            store_controller = self.store_controller
+        os.makedirs(save_path+'/cross_attention')
+        attention_output = attention_util.show_cross_attention(self.tokenizer, prompt, 
+                                                               store_controller, 16, ["up", "down"],
+                                                               save_path = save_path+'/cross_attention')
+
+        # Detach the controller for safety
+        attention_util.detach_attention_control(self)
     
     @torch.no_grad()
     def ddim_clean2noisy_loop(self, latent, text_embeddings, controller:attention_util.AttentionControl=None):
@@ -139,7 +234,7 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
             t = self.scheduler.timesteps[len(self.scheduler.timesteps) - i - 1]
             
             # [1, 4, 8, 64, 64] ->  [1, 4, 8, 64, 64])
-            noise_pred = self.unet(latent, t, encoder_hidden_states=cond_embeddings)["sample"]
+            noise_pred = self.predict_noise(self.unet, latent, t, cond_embeddings, controller)
             
             latent = self.next_clean2noise_step(noise_pred, t, latent)
             if controller is not None: controller.step_callback(latent)
@@ -147,6 +242,25 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
         
         return all_latent
     
+    def predict_noise(self, unet, latents, t, text_embeddings, controller=None):
+        """Noise prediction of the UNet, blended over the spatial tiles if any.
+        The TileControllers of the tiles switch to the controller of each tile before its UNet call.
+        """
+        if self.spatial_tiling is None:
+            return unet(latents, t, encoder_hidden_states=text_embeddings).sample
+
+        def predict_tile(index, tile):
+            if isinstance(controller, TileControllers):
+                controller.set_tile(index)
+            return unet(tile, t, encoder_hidden_states=text_embeddings).sample
+        return self.spatial_tiling.fuse(latents, predict_tile)
+
+    def vae_decode(self, latents):
+        if self.spatial_tiling is None:
+            return super().vae_decode(latents)
+        return self.spatial_tiling.fuse(latents, lambda index, tile: self.vae.decode(tile).sample,
+                                        out_scale=self.vae_scale_factor)
+
     def next_clean2noise_step(self, model_output: Union[torch.FloatTensor, np.ndarray], timestep: int, sample: Union[torch.FloatTensor, np.ndarray]):
         """
         Assume the eta in DDIM=0
@@ -177,24 +291,39 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
         len_target = {len(kwargs['prompt'].split(' '))}
         equal_length = (len_source == len_target)
         print(f" len_source: {len_source}, len_target: {len_target}, equal_length: {equal_length}")
-        edit_controller = attention_util.make_controller(
-                            self.tokenizer, 
-                            [ kwargs['source_prompt'], kwargs['prompt']],
-                            NUM_DDIM_STEPS = kwargs['num_inference_steps'],
-                            is_replace_controller=kwargs.get('is_replace_controller', True) and equal_length,
-                            cross_replace_steps=kwargs['cross_replace_steps'], 
-                            self_replace_steps=kwargs['self_replace_steps'], 
-                            blend_words=kwargs.get('blend_words', None),
-                            equilizer_params=kwargs.get('eq_params', None),
-                            additional_attention_store=self.store_controller,
-                            use_inversion_attention = kwargs['use_inversion_attention'],
-                            blend_th = kwargs.get('blend_th', (0.3, 0.3)),
-                            blend_self_attention = kwargs.get('blend_self_attention', None),
-                            blend_latents=kwargs.get('blend_latents', None),
-                            save_path=kwargs.get('save_path', None),
-                            save_self_attention = kwargs.get('save_self_attention', True),
-                            disk_store = kwargs.get('disk_store', False)
-                            )
+        def make_edit_controller(additional_attention_store):
+            return attention_util.make_controller(
+                                self.tokenizer, 
+                                [ kwargs['source_prompt'], kwargs['prompt']],
+                                NUM_DDIM_STEPS = kwargs['num_inference_steps'],
+                                is_replace_controller=kwargs.get('is_replace_controller', True) and equal_length,
+                                cross_replace_steps=kwargs['cross_replace_steps'], 
+                                self_replace_steps=kwargs['self_replace_steps'], 
+                                blend_words=kwargs.get('blend_words', None),
+                                equilizer_params=kwargs.get('eq_params', None),
+                                additional_attention_store=additional_attention_store,
+                                use_inversion_attention = kwargs['use_inversion_attention'],
+                                blend_th = kwargs.get('blend_th', (0.3, 0.3)),
+                                blend_self_attention = kwargs.get('blend_self_attention', None),
+                                blend_latents=kwargs.get('blend_latents', None),
+                                save_path=kwargs.get('save_path', None),
+                                save_self_attention = kwargs.get('save_self_attention', True),
+                                disk_store = kwargs.get('disk_store', False),
+                                cross_attention_value_edit = kwargs.get('cross_attention_value_edit', False),
+                                save_blend_mask = kwargs.get('save_blend_mask', True)
+                                )
+        if self.tile_store_controllers is not None:
+            # each tile is edited with the attention inverted on the same tile
+            edit_controller = TileControllers([make_edit_controller(tile_store_controller)
+                                               for tile_store_controller in self.tile_store_controllers],
+                                              self.spatial_tiling)
+        elif self.spatial_tiling is not None:
+            # no inverted attention, each tile still needs its own step count
+            tiles = self.spatial_tiling.get_tiles(*kwargs['latents'].shape[-2:])
+            edit_controller = TileControllers([make_edit_controller(self.store_controller) for _ in tiles],
+                                              self.spatial_tiling)
+        else:
+            edit_controller = make_edit_controller(self.store_controller)
         
         attention_util.register_attention_control(self, edit_controller)
         
@@ -204,6 +333,11 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
             controller = edit_controller, 
             # target_prompt = kwargs['prompts'][1],
             **kwargs)
+        # the blend masks are written in the background
+        edit_controller.flush_masks()
+        if isinstance(edit_controller, TileControllers):
+            # masks and attention of the first tile, like the inversion reports
+            edit_controller.set_tile(0)
         if hasattr(edit_controller.latent_blend, 'mask_list'):
             mask_list = edit_controller.latent_blend.mask_list
         else:
@@ -218,7 +352,7 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
                 "attention_output" : attention_output,
                 "mask_list" : mask_list,
             }
-        attention_util.register_attention_control(self, self.empty_controller)
+        attention_util.detach_attention_control(self)
         return dict_output
 
     
@@ -232,6 +366,8 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
             return self.sd_ddim_pipeline(controller = None, **kwargs)
 
         if edit_type == 'save':
+            if self.spatial_tiling is not None:
+                raise ValueError("spatial_tile edits with the inverted attention of each tile, set use_inversion_attention")
             del self.store_controller
             self.store_controller = attention_util.AttentionStore()
             attention_util.register_attention_control(self, self.store_controller)
@@ -249,7 +385,7 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
             }
 
             # Detach the controller for safety
-            attention_util.register_attention_control(self, self.empty_controller)
+            attention_util.detach_attention_control(self)
             return dict_output
         
         if edit_type == 'swap':
@@ -279,6 +415,11 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
         controller: attention_util.AttentionControl = None,
         latents_all=None,
         total_frame_num=None,
+        shared_frame: bool = False,
+        style_schedule: Optional[Union[dict, StyleSchedule]] = None,
+        stage_frame_num: Optional[int] = None,
+        frame_sink: Optional[Union[str, Callable[[np.ndarray, int], None]]] = None,
+        frame_chunk: Optional[dict] = None,
         **args
     ):
         r"""
@@ -336,6 +477,28 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            shared_frame (`bool`, *optional*, defaults to False):
+                If all frames of `latents` are identical (e.g. one inverted frame repeated `total_frame_num` times),
+                denoise a single frame until the per-frame style blend starts and only then broadcast it to the full
+                clip. Exact for a UNet inflated from a 2D checkpoint; tuned temporal convolutions see zero padding at
+                the clip borders, so there it is an approximation.
+            style_schedule (`dict` or `StyleSchedule`, *optional*):
+                Per-step, per-frame weight of the inverted latents in the source to target blend. Defaults to the
+                original blend over the frames at step 40. See `video_diffusion.pipelines.style_schedule`.
+            stage_frame_num (`int`, *optional*):
+                Number of frames denoised together in one stage. The `total_frame_num` frames are generated in
+                windows of `stage_frame_num` frames, so the peak memory is bounded by the stage size. Defaults to
+                `total_frame_num`, i.e. a single stage. Several stages need a controller whose inverted attention
+                comes from a single shared frame, since the maps of a multi-frame inversion are not split by stage.
+            frame_sink (`str` or `Callable`, *optional*):
+                Called as `frame_sink(images, start_frame)` with the decoded `b f h w c` frames of each stage as soon
+                as the stage finishes. A `str` is the folder of a `FrameFolderSink`. When given, the frames are not
+                kept and the returned `images` is None.
+            frame_chunk (`dict`, *optional*):
+                Arguments of `FrameChunkedUNet`, e.g. `{window_frames: 16, overlap: 4}`. The UNet is called on
+                overlapping windows of each stage and their noise predictions are fused, so the peak memory of the
+                UNet is bounded by the window size. Not supported with an attention controller, whose layer
+                counters assume one UNet call per step; use `stage_frame_num` there.
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -384,11 +547,31 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
 
         # 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+        unet = self.unet
+        if frame_chunk is not None:
+            if controller is not None:
+                raise ValueError("frame_chunk is not supported with an attention controller, use stage_frame_num")
+            unet = FrameChunkedUNet(self.unet, **frame_chunk)
 
         # 7. Denoising loop
         interpolate_method=2
-        stage_num=1
+        if stage_frame_num is None:
+            stage_frame_num = total_frame_num
+        stage_num = int(np.ceil(total_frame_num / stage_frame_num))
+        inverted_store = getattr(controller, 'additional_attention_store', None)
+        if stage_num > 1 and inverted_store is not None and len(inverted_store.latents_store) > 0 \
+                and inverted_store.latents_store[0].shape[2] > 1:
+            # the inverted maps of all frames cannot be matched to the frames of a stage
+            raise ValueError(f"stage_frame_num {stage_frame_num} < total_frame_num {total_frame_num} is not supported "
+                             f"with the inverted attention of {inverted_store.latents_store[0].shape[2]} frames")
+        if isinstance(frame_sink, str):
+            frame_sink = FrameFolderSink(frame_sink)
+        style_schedule = make_style_schedule(style_schedule)
+        blend_steps = style_schedule.get_steps(num_inference_steps)
         init_latents=latents
+        if shared_frame and self.is_frame_shared(latents):
+            # all frames are the same until the blend, only keep one of them
+            init_latents = latents[:, :, :1]
         interpolate_latents_list=[]
         output_latents_list=[]
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
@@ -397,39 +580,42 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
         #7.2 直接生成
 
         for stage in tqdm(range(stage_num),desc="Stage-divided Sample"):
-            latents=init_latents
-            all_frame_num=stage_num*total_frame_num
-            start_frame=stage*total_frame_num
-            end_frame=start_frame+total_frame_num
-            controller.cur_step=0
+            all_frame_num=total_frame_num
+            start_frame=stage*stage_frame_num
+            end_frame=min(start_frame+stage_frame_num, all_frame_num)
+            stage_frame=end_frame-start_frame
+            # a shared frame is used by all stages, otherwise each stage only takes its own window
+            latents=init_latents if init_latents.shape[2] == 1 else init_latents[:, :, start_frame:end_frame]
+            if controller is not None:
+                if stage > 0:
+                    # drop the attention of the previous stage to keep memory bounded by the stage size
+                    controller.reset()
+                controller.cur_step=0
+                if hasattr(controller, 'reserve_steps'):
+                    controller.reserve_steps(len(timesteps))
             with self.progress_bar(total=num_inference_steps) as progress_bar:
                 for i, t in enumerate(tqdm(timesteps)):
                     # expand the latents if we are doing classifier free guidance
 
-                    if i == 40:
-                        #num_frame=latents.size(2)
+                    if i in blend_steps:
+                        if latents.shape[2] != stage_frame:
+                            # broadcast the shared frame to the full clip before the frames diverge
+                            latents = latents.expand(-1, -1, stage_frame, -1, -1)
                         #latents维度（1，4，6，64，64）（其中6是frame_number）
                         #latents_all是保存了invert过程不同timestep的latents列表
-                        #source_latents_list = torch.split(latents_all[-(i + 1)], 1, dim=2)
                         source_latents = latents_all[-(i+1)]
-                        target_latents_list = torch.split(latents, 1, dim=2)
-                        new_latents=[]
-                        for index,frame in enumerate(range(start_frame,end_frame)):
-                            source_rate=1.0*(all_frame_num-frame)/(all_frame_num-1.)
-                            #source_latents=source_latents_list[frame]
-                            target_latents=target_latents_list[index]
-                            edited_latents=source_rate*source_latents+(1.0-source_rate)*target_latents
-                            new_latents.append(edited_latents)
-
-                        latents=torch.cat(new_latents,dim=2)
+                        if source_latents.shape[2] > 1:
+                            source_latents = source_latents[:, :, start_frame:end_frame]
+                        latents = style_schedule(latents, source_latents, i, num_inference_steps,
+                                                 start_frame, end_frame, all_frame_num)
 
                     latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
                     latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                     # predict the noise residual
-                    noise_pred = self.unet(
-                        latent_model_input, t, encoder_hidden_states=text_embeddings
-                    ).sample.to(dtype=latents_dtype)
+                    noise_pred = self.predict_noise(
+                        unet, latent_model_input, t, text_embeddings, controller
+                    ).to(dtype=latents_dtype)
 
                     # perform guidance
                     if do_classifier_free_guidance:
@@ -454,7 +640,22 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
                         if callback is not None and i % callback_steps == 0:
                             callback(i, t, latents)
                     torch.cuda.empty_cache()
-            output_latents_list.append(latents)
+            if latents.shape[2] != stage_frame:
+                latents = latents.expand(-1, -1, stage_frame, -1, -1)
+            if frame_sink is not None:
+                # stream the frames of this stage out instead of keeping them until the end
+                frame_sink(self.decode_latents(latents), start_frame)
+            else:
+                output_latents_list.append(latents)
+        self.clear_text_key_value_cache()
+
+        if frame_sink is not None:
+            if hasattr(frame_sink, 'close'):
+                frame_sink.close()
+            torch.cuda.empty_cache()
+            if not return_dict:
+                return (None, None)
+            return StableDiffusionPipelineOutput(images=None, nsfw_content_detected=None)
 
         # 8. Post-processing
         latents=torch.cat(output_latents_list,dim=2)
@@ -472,6 +673,13 @@ class P2pDDIMSpatioTemporalPipeline(SpatioTemporalStableDiffusionPipeline):
         torch.cuda.empty_cache()
         return StableDiffusionPipelineOutput(images=image, nsfw_content_detected=has_nsfw_concept)
 
+    @staticmethod
+    def is_frame_shared(latents):
+        """Whether all frames of a `b c f h w` latent are identical"""
+        if latents is None or latents.dim() != 5 or latents.shape[2] == 1:
+            return False
+        return torch.equal(latents, latents[:, :, :1].expand_as(latents))
+
     def print_pipeline(self, logger):
         print('Overview function of pipeline: ')
         print(self.__class__)
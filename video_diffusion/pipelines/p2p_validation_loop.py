@@ -131,12 +131,17 @@ class P2pSampleLogger:
                     **p2p_config_now,
                 )
                 if self.prompt2prompt_edit:
-                    sequence = sequence_return['sdimage_output'].images[0]
+                    sequence = sequence_return['sdimage_output'].images
+                    sequence = None if sequence is None else sequence[0]
                     attention_output = sequence_return['attention_output']
                     
                 else:
-                    sequence = sequence_return.images[0]
+                    sequence = sequence_return.images
+                    sequence = None if sequence is None else sequence[0]
                 torch.cuda.empty_cache()
+                if sequence is None:
+                    # frames are already written stage by stage through `frame_sink`
+                    continue
 
                 if self.annotate:
                     images = [
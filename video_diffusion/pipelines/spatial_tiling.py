@@ -0,0 +1,129 @@
+"""
+Spatial tiling of `P2pDDIMSpatioTemporalPipeline` for videos above 512x512.
+The latents are split into overlapping tiles of the UNet resolution, the noise predictions of the tiles are blended
+with ramp weights over the overlap (MultiDiffusion), and the VAE encodes and decodes the same tiles.
+Each tile has its own attention controller, see `TileControllers'.
+"""
+
+from typing import Callable, List, Tuple
+
+import torch
+
+
+class SpatialTiling:
+    """Overlapping tiles over the last two dims of latents, in latent pixels.
+
+    Args:
+        tile_size (int, optional): side of a tile, 64 is the 512x512 resolution of Stable Diffusion. Defaults to 64.
+        overlap (int, optional): pixels shared by adjacent tiles. Defaults to 16.
+    """
+    def get_starts(self, length: int) -> List[int]:
+        if length <= self.tile_size:
+            return [0]
+        stride = self.tile_size - self.overlap
+        starts = list(range(0, length - self.tile_size + 1, stride))
+        if starts[-1] + self.tile_size < length:
+            starts.append(length - self.tile_size)
+        return starts
+
+    def get_tiles(self, height: int, width: int) -> List[Tuple[int, int]]:
+        "(top, left) of each tile, row by row"
+        return [(top, left) for top in self.get_starts(height) for left in self.get_starts(width)]
+
+    def get_ramp(self, start: int, size: int, length: int, scale: int) -> torch.Tensor:
+        "[size * scale] weight of a tile along one axis, ramped over the overlap unless at the border"
+        weight = torch.ones(size * scale)
+        overlap = min(self.overlap, size) * scale
+        if overlap > 0:
+            ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+            if start > 0:
+                weight[:overlap] = ramp
+            if start + size < length:
+                weight[-overlap:] = ramp.flip(0)
+        return weight
+
+    def fuse(self, x: torch.Tensor, fn: Callable[[int, torch.Tensor], torch.Tensor],
+             in_scale: int = 1, out_scale: int = 1) -> torch.Tensor:
+        """Blend fn(tile_index, tile of x) over the tiles of x.
+        x and the outputs are in_scale and out_scale times the latent resolution, e.g. 8 for the pixels of the VAE.
+        """
+        height, width = x.shape[-2] // in_scale, x.shape[-1] // in_scale
+        tile_height, tile_width = min(self.tile_size, height), min(self.tile_size, width)
+        fused, weight_sum = None, None
+        for index, (top, left) in enumerate(self.get_tiles(height, width)):
+            tile = fn(index, x[..., top * in_scale:(top + tile_height) * in_scale,
+                               left * in_scale:(left + tile_width) * in_scale])
+            if fused is None:
+                fused = torch.zeros(*tile.shape[:-2], height * out_scale, width * out_scale,
+                                    device=tile.device, dtype=torch.float32)
+                weight_sum = torch.zeros(height * out_scale, width * out_scale, device=tile.device)
+            weight = self.get_ramp(top, tile_height, height, out_scale)[:, None] \
+                * self.get_ramp(left, tile_width, width, out_scale)[None, :]
+            weight = weight.to(tile.device)
+            rows = slice(top * out_scale, (top + tile_height) * out_scale)
+            columns = slice(left * out_scale, (left + tile_width) * out_scale)
+            fused[..., rows, columns] += tile.float() * weight
+            weight_sum[rows, columns] += weight
+        return (fused / weight_sum).to(tile.dtype)
+
+    def __init__(self, tile_size: int = 64, overlap: int = 16):
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"overlap must be in [0, tile_size), not {overlap}")
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+
+class TileControllers:
+    """Attention controllers of the tiles, registered as one controller by `register_attention_control'.
+    The registered attention calls the controller of the current tile, set by the UNet call of each tile,
+    so that every controller sees one UNet call per step, like without tiles.
+    """
+    OWN_ATTRIBUTES = ['controllers', 'tiling', 'tile']
+
+    def set_tile(self, tile: int):
+        self.tile = tile
+
+    def __getattr__(self, name):
+        if name in self.OWN_ATTRIBUTES:
+            # not initialized yet, e.g. while copied
+            raise AttributeError(name)
+        return getattr(self.controllers[self.tile], name)
+
+    def __setattr__(self, name, value):
+        "attributes set by the pipeline and the register, e.g. cur_step or num_att_layers, are set on every tile"
+        if name in self.OWN_ATTRIBUTES:
+            object.__setattr__(self, name, value)
+            return
+        for controller in self.controllers:
+            setattr(controller, name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.controllers[self.tile](*args, **kwargs)
+
+    def step_callback(self, x_t):
+        "step_callback of each controller on its tile, e.g. the latent blend, blended as the noise predictions"
+        return self.tiling.fuse(x_t, lambda index, tile: self.controllers[index].step_callback(tile))
+
+    def reserve_steps(self, num_steps: int):
+        for controller in self.controllers:
+            if hasattr(controller, 'reserve_steps'):
+                controller.reserve_steps(num_steps)
+
+    def reset_layer_plans(self):
+        for controller in self.controllers:
+            if hasattr(controller, 'reset_layer_plans'):
+                controller.reset_layer_plans()
+
+    def reset(self):
+        for controller in self.controllers:
+            controller.reset()
+
+    def flush_masks(self):
+        for controller in self.controllers:
+            if hasattr(controller, 'flush_masks'):
+                controller.flush_masks()
+
+    def __init__(self, controllers: list, tiling: SpatialTiling):
+        self.controllers = controllers
+        self.tiling = tiling
+        self.tile = 0
@@ -25,6 +25,7 @@ from diffusers.utils import deprecate, logging
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 
 from ..models.unet_3d_condition import UNetPseudo3DConditionModel
+from ..models.attention import TextCrossAttention
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -294,6 +295,16 @@ class SpatioTemporalStableDiffusionPipeline(DiffusionPipeline):
 
         return text_embeddings
 
+    def clear_text_key_value_cache(self):
+        "Release the text key and value cached by the cross attention layers of the UNet, at the end of a call"
+        for module in self.unet.modules():
+            if isinstance(module, TextCrossAttention):
+                module.clear_text_key_value_cache()
+
+    def vae_decode(self, latents):
+        "images of [b, c, h, w] scaled latents"
+        return self.vae.decode(latents).sample
+
     def decode_latents(self, latents):
         is_video = (latents.dim() == 5)
         b = latents.shape[0]
@@ -303,7 +314,7 @@ class SpatioTemporalStableDiffusionPipeline(DiffusionPipeline):
             latents = rearrange(latents, "b c f h w -> (b f) c h w") # torch.Size([70, 4, 64, 64])
 
         latents_split = torch.split(latents, 16, dim=0)
-        image = torch.cat([self.vae.decode(l).sample for l in latents_split], dim=0)
+        image = torch.cat([self.vae_decode(l) for l in latents_split], dim=0)
         
         # image_full = self.vae.decode(latents).sample
         # RuntimeError: upsample_nearest_nhwc only supports output tensors with less than INT_MAX elements
@@ -547,6 +558,7 @@ class SpatioTemporalStableDiffusionPipeline(DiffusionPipeline):
                     progress_bar.update()
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
+        self.clear_text_key_value_cache()
 
         # 8. Post-processing
         image = self.decode_latents(latents)
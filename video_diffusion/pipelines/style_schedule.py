@@ -0,0 +1,101 @@
+"""
+Per-step, per-frame schedule of the source -> target style blend used in `P2pDDIMSpatioTemporalPipeline.sd_ddim_pipeline`
+Provide a API `make_style_schedule' to build a StyleSchedule from the `style_schedule' block in p2p_config.
+"""
+
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class StyleSchedule:
+    """Weight of the inverted (source) latents for every frame at the blend steps.
+
+    At a blend step the latents are updated with one vectorized lerp over the frame axis
+    `latents = lerp(latents, source_latents, weight)`, where weight has shape [1, 1, f, 1, 1].
+
+    Args:
+        curve (str, optional): shape of the target share along the video, one of
+            `original`, `linear`, `ease_in`, `ease_out`, `ease_in_out`, `keyframe`. `original` is the blend of
+            the first FateZero release, source weight (n - f) / (n - 1) for frame f of n, from n / (n - 1)
+            down to 1 / (n - 1); `linear` goes from 1 at the first frame to 0 at the last. Defaults to 'original'.
+        steps (List[Union[int, float]], optional): denoising steps where the blend is applied.
+            int is an absolute step index, float is a ratio of num_inference_steps. Defaults to [40].
+        strength (List[float], optional): scale of the source weight at each blend step,
+            used to build multi-step ramps. Defaults to 1.0 for every step.
+        keyframes (List[Tuple[float, float]], optional): (relative position in video, source weight) pairs
+            for curve `keyframe`, linearly interpolated between keyframes.
+    """
+    CURVES = ['original', 'linear', 'ease_in', 'ease_out', 'ease_in_out', 'keyframe']
+
+    def get_steps(self, num_inference_steps: int) -> List[int]:
+        "absolute step index of every blend step"
+        return [int(step * num_inference_steps) if isinstance(step, float) else int(step)
+                for step in self.steps]
+
+    def get_frame_weight(self, start_frame: int, end_frame: int, all_frame_num: int) -> torch.Tensor:
+        "source weight of frames in [start_frame, end_frame), shape [end_frame - start_frame]"
+        frame = np.arange(start_frame, end_frame, dtype=np.float64)
+        if self.curve == 'original':
+            return torch.from_numpy((all_frame_num - frame) / max(all_frame_num - 1, 1))
+        x = frame / max(all_frame_num - 1, 1)
+        if self.curve == 'keyframe':
+            position, weight = zip(*self.keyframes)
+            return torch.from_numpy(np.interp(x, position, weight))
+        if self.curve == 'linear':
+            target_share = x
+        elif self.curve == 'ease_in':
+            target_share = x ** 2
+        elif self.curve == 'ease_out':
+            target_share = 1 - (1 - x) ** 2
+        elif self.curve == 'ease_in_out':
+            target_share = 3 * x ** 2 - 2 * x ** 3
+        return torch.from_numpy(1.0 - target_share)
+
+    def get_weight(self, step: int, num_inference_steps: int,
+                   start_frame: int, end_frame: int, all_frame_num: int) -> Optional[torch.Tensor]:
+        """Return the source weight in shape [1, 1, f, 1, 1] to broadcast with b c f h w latents,
+        None if no blend at this step
+        """
+        steps = self.get_steps(num_inference_steps)
+        if step not in steps:
+            return None
+        strength = self.strength[steps.index(step)]
+        weight = strength * self.get_frame_weight(start_frame, end_frame, all_frame_num)
+        return weight.reshape(1, 1, -1, 1, 1)
+
+    def __call__(self, latents, source_latents, step: int, num_inference_steps: int,
+                 start_frame: int, end_frame: int, all_frame_num: int):
+        weight = self.get_weight(step, num_inference_steps, start_frame, end_frame, all_frame_num)
+        if weight is None:
+            return latents
+        source_latents = source_latents.to(device=latents.device, dtype=latents.dtype)
+        weight = weight.to(device=latents.device, dtype=latents.dtype)
+        return torch.lerp(latents, source_latents, weight)
+
+    def __init__(self, curve: str = 'original',
+                 steps: Sequence[Union[int, float]] = (40,),
+                 strength: Optional[Sequence[float]] = None,
+                 keyframes: Optional[Sequence[Tuple[float, float]]] = None):
+        assert curve in self.CURVES, f"curve must be one of {self.CURVES}, not {curve}"
+        self.curve = curve
+        self.steps = list(steps)
+        if strength is None:
+            strength = [1.0] * len(self.steps)
+        assert len(strength) == len(self.steps), "strength must have one value for each blend step"
+        self.strength = [float(s) for s in strength]
+        if curve == 'keyframe':
+            assert keyframes is not None and len(keyframes) > 0, "keyframe curve needs keyframes"
+            self.keyframes = sorted((float(p), float(w)) for p, w in keyframes)
+        else:
+            self.keyframes = None
+
+
+def make_style_schedule(style_schedule=None) -> StyleSchedule:
+    "Build a StyleSchedule from None (the original step-40 blend), a config dict or a StyleSchedule"
+    if style_schedule is None:
+        return StyleSchedule()
+    if isinstance(style_schedule, StyleSchedule):
+        return style_schedule
+    return StyleSchedule(**style_schedule)
@@ -0,0 +1,433 @@
+"""
+Disk backend of AttentionStore when disk_store=True.
+All attention maps of a run are appended to one binary file, a json header maps (step, key, layer) to offset/shape/dtype.
+Reading a step returns zero-copy tensor views of a memory map of the file.
+Writes run on a background thread while the next step computes, and the next step to read can be prefetched.
+AttentionTieredStore keeps the maps in byte-budgeted device, pinned host and disk tiers.
+AttentionCacheManager keeps the cache directory under a byte quota.
+"""
+
+import os
+import json
+import fcntl
+import itertools
+import glob
+import shutil
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from video_diffusion.common.util import get_time_string
+
+# bfloat16 is not supported by numpy, it is stored as int16 and viewed back
+TORCH_TO_NUMPY_DTYPE = {
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.bfloat16: np.int16,
+    torch.uint8: np.uint8,
+}
+ALIGNMENT = 64
+
+
+class AttentionFileStep:
+    """Attention maps of one step in AttentionFileStore, {key: [views of each layer]}
+    Views are only built for the keys that are read.
+    """
+    def __getitem__(self, key: str) -> List[torch.Tensor]:
+        return [None if entry is None else self.file_store.get_tensor(entry) for entry in self.entries.get(key, [])]
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __init__(self, file_store, entries: Dict[str, list]):
+        self.file_store = file_store
+        self.entries = entries
+
+
+class AttentionFileStore:
+    """Append-only single-file store of attention maps of all steps.
+    `len()' and step indexing behave like AttentionStepBuffer.
+
+    Args:
+        path (str): path of the binary file, the header is written to path + '.json'
+        max_pending_writes (int, optional): steps queued for the writer before `append' blocks. Defaults to 2.
+        prefetch_size (int, optional): steps kept in memory by `prefetch'. Defaults to 2.
+    """
+    def append(self, step_store: Dict[str, List[torch.Tensor]]):
+        "Queue the maps of a step to the background writer, the step is readable at once"
+        while len(self.pending_writes) >= self.max_pending_writes:
+            self.pending_writes.popleft().result()
+        self.pending_writes.append(self.write_executor.submit(self.write_step, step_store))
+        self.length += 1
+
+    def flush(self):
+        "Wait for all queued writes"
+        while len(self.pending_writes) > 0:
+            self.pending_writes.popleft().result()
+
+    def write_step(self, step_store: Dict[str, List[torch.Tensor]]):
+        "Append all maps of a step, then rewrite the header"
+        step_entries = {}
+        nbytes = self.nbytes
+        with open(self.path, 'ab') as f:
+            for key, tensors in step_store.items():
+                step_entries[key] = []
+                for tensor in tensors:
+                    if tensor is None:
+                        # not recorded by the RecordingPlan
+                        step_entries[key].append(None)
+                        continue
+                    tensor = tensor.detach().contiguous().cpu()
+                    array = tensor.view(torch.int16).numpy() if tensor.dtype == torch.bfloat16 else tensor.numpy()
+                    padding = (-nbytes) % ALIGNMENT
+                    f.write(b'\0' * padding)
+                    nbytes += padding
+                    step_entries[key].append((nbytes, list(tensor.shape), str(tensor.dtype).replace('torch.', '')))
+                    array.tofile(f)
+                    nbytes += array.nbytes
+        # readers only see the step once its bytes are in the file
+        with self.lock:
+            self.nbytes = nbytes
+            self.index.append(step_entries)
+        self.write_header()
+
+    def write_header(self):
+        header_path = self.path + '.json'
+        with open(header_path + '.tmp', 'w') as f:
+            json.dump({'nbytes': self.nbytes, 'index': self.index}, f)
+        os.replace(header_path + '.tmp', header_path)
+
+    def get_memmap(self):
+        # (re)map the file if it has grown since the last read
+        with self.lock:
+            if self.memmap is None or self.memmap.shape[0] < self.nbytes:
+                self.memmap = np.memmap(self.path, dtype=np.uint8, mode='c', shape=(self.nbytes,))
+            return self.memmap
+
+    def get_tensor(self, entry) -> torch.Tensor:
+        "Zero-copy view of one stored map"
+        offset, shape, dtype = entry
+        torch_dtype = getattr(torch, dtype)
+        numpy_dtype = TORCH_TO_NUMPY_DTYPE[torch_dtype]
+        count = int(np.prod(shape))
+        array = np.frombuffer(self.get_memmap(), dtype=numpy_dtype, count=count, offset=offset).reshape(shape)
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        return tensor
+
+    def load_step(self, step: int) -> Dict[str, List[torch.Tensor]]:
+        "Read all maps of a step into memory"
+        file_step = AttentionFileStep(self, self.index[step])
+        return {key: [None if tensor is None else tensor.clone() for tensor in file_step[key]]
+                for key in file_step.keys()}
+
+    def prefetch(self, step: int):
+        "Load a step in the background, so that the following `store[step]' does not wait for the disk"
+        if not 0 <= step < self.length or step in self.prefetched:
+            return
+        self.flush()
+        self.prefetched[step] = self.read_executor.submit(self.load_step, step)
+        while len(self.prefetched) > self.prefetch_size:
+            self.prefetched.popitem(last=False)[1].cancel()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, step: int):
+        if step < 0:
+            step += self.length
+        if not 0 <= step < self.length:
+            raise IndexError(f"step {step} out of range of {self.length} stored steps")
+        if step in self.prefetched:
+            return self.prefetched[step].result()
+        if step >= len(self.index):
+            self.flush()
+        return AttentionFileStep(self, self.index[step])
+
+    @classmethod
+    def open(cls, path: str):
+        "Open a store written before, e.g. by another process"
+        with open(path + '.json') as f:
+            header = json.load(f)
+        store = cls(path, create=False)
+        store.nbytes = header['nbytes']
+        store.index = [{key: [None if entry is None else tuple(entry) for entry in entries] for key, entries in step.items()}
+                       for step in header['index']]
+        store.length = len(store.index)
+        return store
+
+    def __init__(self, path: str, create: bool = True, max_pending_writes: int = 2, prefetch_size: int = 2):
+        self.path = path
+        self.index = []
+        self.nbytes = 0
+        self.length = 0
+        self.memmap = None
+        self.lock = threading.Lock()
+        # one writer keeps the file append-only and ordered
+        self.write_executor = ThreadPoolExecutor(max_workers=1)
+        self.read_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = deque()
+        self.max_pending_writes = max_pending_writes
+        self.prefetched = OrderedDict()
+        self.prefetch_size = prefetch_size
+        if create:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            open(path, 'wb').close()
+            self.write_header()
+
+
+class AttentionCacheManager:
+    """Lifecycle of attention cache files in cache_dir.
+    New files are registered as in use; before a new file is created, the least recently used files
+    (and folders with the same prefix, e.g. legacy per-step `attention_cache_*' folders) are deleted until the directory fits the quota.
+    A file in use holds a shared flock on its `.lock' sidecar, so that the eviction of other processes sharing
+    cache_dir skips it; the lock is released by `release' or when the process exits.
+
+    Args:
+        cache_dir (str, optional): Defaults to './trash'.
+        quota_gb (float, optional): byte budget of cache_dir in GB, None for no limit. Defaults to 20.
+        prefix (str, optional): name prefix of the managed files and folders. Defaults to 'attention_cache'.
+    """
+    # absolute path -> open lock file, shared by all managers of the process
+    in_use = {}
+    path_counter = itertools.count()
+
+    def new_path(self) -> str:
+        self.evict()
+        path = os.path.join(self.cache_dir, f'{self.prefix}_{get_time_string()}_{os.getpid()}_{next(self.path_counter)}.bin')
+        self.acquire(path)
+        return path
+
+    def acquire(self, path: str):
+        "Mark a file or folder as used by this process, it is not evicted by any process until `release'"
+        path = os.path.abspath(path)
+        if path in self.in_use:
+            return
+        lock_file = open(path + '.lock', 'a')
+        # waits while another process evicts the entry, the caller then checks that it still exists
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        self.in_use[path] = lock_file
+
+    def release(self, path: str):
+        "Mark a file as no longer used by this process, it can be evicted"
+        lock_file = self.in_use.pop(os.path.abspath(path), None)
+        if lock_file is not None:
+            lock_file.close()
+
+    @staticmethod
+    def lock_for_eviction(path: str):
+        "Open lock file of an entry no process uses, None if it is in use"
+        lock_file = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def get_size(path: str) -> int:
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(path) for f in files)
+        size = os.path.getsize(path)
+        if os.path.isfile(path + '.json'):
+            size += os.path.getsize(path + '.json')
+        return size
+
+    def list_entries(self) -> List[str]:
+        "Cache files and legacy cache folders, least recently used first"
+        entries = [path for path in glob.glob(os.path.join(self.cache_dir, f'{self.prefix}_*'))
+                   if not path.endswith(('.json', '.tmp', '.lock'))]
+        return sorted(entries, key=os.path.getmtime)
+
+    def evict(self):
+        if self.quota_bytes is None:
+            return
+        entries = self.list_entries()
+        total = sum(self.get_size(path) for path in entries)
+        for path in entries:
+            if total <= self.quota_bytes:
+                break
+            if os.path.abspath(path) in self.in_use:
+                continue
+            lock_file = self.lock_for_eviction(path)
+            if lock_file is None:
+                # memory-mapped by another process
+                continue
+            try:
+                size = self.get_size(path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+                    if os.path.isfile(path + '.json'):
+                        os.remove(path + '.json')
+                os.remove(path + '.lock')
+            finally:
+                lock_file.close()
+            total -= size
+            print(f'Evict attention cache {path} of {size / 1024 ** 3:.2f} GB')
+
+    def __init__(self, cache_dir: str = './trash', quota_gb: float = 20, prefix: str = 'attention_cache'):
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        os.makedirs(cache_dir, exist_ok=True)
+        self.quota_bytes = None if quota_gb is None else int(quota_gb * 1024 ** 3)
+
+
+def make_tier_budget(tier_budget='auto') -> Dict[str, int]:
+    """Byte budget of the device and host tiers of AttentionTieredStore.
+    `auto' takes 30% of the free GPU memory and 50% of the available RAM at the first write,
+    a dict gives `device_gb' and `host_gb' explicitly.
+    """
+    if tier_budget == 'auto':
+        device_bytes = torch.cuda.mem_get_info()[0] * 0.3 if torch.cuda.is_available() else 0
+        host_bytes = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 0.5
+        return {'device': int(device_bytes), 'host': int(host_bytes)}
+    return {'device': int(tier_budget.get('device_gb', 0) * 1024 ** 3),
+            'host': int(tier_budget.get('host_gb', 0) * 1024 ** 3)}
+
+
+class AttentionTieredStep:
+    "Attention maps of one step in AttentionTieredStore, layers are promoted to the device tier when read"
+    def __getitem__(self, key: str) -> List[torch.Tensor]:
+        # every step lists all layers of the key, unwritten ones are None
+        entry_keys = [(self.step, key, layer) for layer in range(self.tiered_store.key_layer_num.get(key, 0))]
+        return [self.tiered_store.get(entry_key) if entry_key in self.tiered_store.tier_of else None
+                for entry_key in entry_keys]
+
+    def keys(self):
+        return self.tiered_store.layer_num[self.step].keys()
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __contains__(self, key):
+        return key in self.tiered_store.layer_num[self.step]
+
+    def __init__(self, tiered_store, step: int):
+        self.tiered_store = tiered_store
+        self.step = step
+
+
+class AttentionTieredStore:
+    """Attention maps of all steps in byte-budgeted tiers: device -> pinned host memory -> disk.
+    New maps are written to the device tier. When a tier is full, its least recently used maps spill
+    to the next tier, and maps are promoted back to the device tier when read.
+    `len()' and step indexing behave like AttentionStepBuffer.
+
+    Args:
+        tier_budget (Union[str, dict]): budget of the `device' and `host' tiers, see `make_tier_budget'
+        cache_manager (AttentionCacheManager): gives the path of the disk tier file at the first spill to disk
+    """
+    TIERS = ['device', 'host', 'disk']
+
+    def write(self, key: str, layer: int, attn: torch.Tensor, device=None):
+        "Store a copy of attn at the current step and return it"
+        if self.device is None:
+            self.device = device if device is not None else attn.device
+            self.budget = make_tier_budget(self.tier_budget)
+        layer_num = self.layer_num[self.length]
+        layer_num[key] = max(layer_num.get(key, 0), layer + 1)
+        self.key_layer_num[key] = max(self.key_layer_num.get(key, 0), layer + 1)
+        entry_key = (self.length, key, layer)
+        stored = self.put(entry_key, attn.detach(), 'device')
+        # attn is edited in place after recording
+        return stored if self.tier_of[entry_key] != 'disk' else attn.detach().clone()
+
+    def end_step(self, layer_num: dict = None):
+        "layer_num is {key: number of layers} of the step, the layers never written read as None"
+        for key, num in (layer_num or {}).items():
+            self.layer_num[self.length][key] = max(self.layer_num[self.length].get(key, 0), num)
+            self.key_layer_num[key] = max(self.key_layer_num.get(key, 0), num)
+        self.length += 1
+        self.layer_num.append({})
+
+    @staticmethod
+    def get_nbytes(tensor: torch.Tensor) -> int:
+        return tensor.numel() * tensor.element_size()
+
+    def move(self, tensor: torch.Tensor, tier: str):
+        "Copy tensor to a tier, the disk tier returns the index of the map in the file store"
+        if tier == 'device':
+            return tensor.to(self.device, copy=True)
+        if tier == 'host':
+            host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self.pin_memory)
+            host_tensor.copy_(tensor)
+            return host_tensor
+        if self.file_store is None:
+            self.file_store = AttentionFileStore(self.cache_manager.new_path())
+        self.file_store.append({'attn': [tensor]})
+        return len(self.file_store) - 1
+
+    def make_room(self, tier: str, nbytes: int):
+        "Spill the least recently used maps of a tier to the next tier until nbytes fit"
+        entries = self.entries[tier]
+        while self.used[tier] + nbytes > self.budget[tier] and len(entries) > 0:
+            entry_key, (tensor, tensor_nbytes) = entries.popitem(last=False)
+            self.used[tier] -= tensor_nbytes
+            self.put(entry_key, tensor, self.TIERS[self.TIERS.index(tier) + 1])
+
+    def put(self, entry_key, tensor: torch.Tensor, tier: str):
+        "Store tensor in the first tier from `tier' that can hold it, return the stored tensor"
+        nbytes = self.get_nbytes(tensor)
+        for tier in self.TIERS[self.TIERS.index(tier):]:
+            if tier == 'disk' or nbytes <= self.budget[tier]:
+                break
+        if tier != 'disk':
+            self.make_room(tier, nbytes)
+            self.used[tier] += nbytes
+        stored = self.move(tensor, tier)
+        self.entries[tier][entry_key] = (stored, nbytes)
+        self.tier_of[entry_key] = tier
+        return stored if tier != 'disk' else tensor
+
+    def get(self, entry_key) -> torch.Tensor:
+        tier = self.tier_of[entry_key]
+        if tier == 'device':
+            self.entries[tier].move_to_end(entry_key)
+            return self.entries[tier][entry_key][0]
+        stored, nbytes = self.entries[tier].pop(entry_key)
+        if tier == 'disk':
+            tensor = self.file_store[stored]['attn'][0]
+        else:
+            self.used[tier] -= nbytes
+            tensor = stored
+        return self.put(entry_key, tensor, 'device')
+
+    @property
+    def path(self):
+        return None if self.file_store is None else self.file_store.path
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, step: int) -> AttentionTieredStep:
+        if step < 0:
+            step += self.length
+        if not 0 <= step < self.length:
+            raise IndexError(f"step {step} out of range of {self.length} stored steps")
+        return AttentionTieredStep(self, step)
+
+    def __init__(self, tier_budget, cache_manager: AttentionCacheManager):
+        self.tier_budget = tier_budget
+        self.budget = None
+        self.cache_manager = cache_manager
+        self.device = None
+        self.pin_memory = torch.cuda.is_available()
+        self.entries = {tier: OrderedDict() for tier in self.TIERS}
+        self.used = {tier: 0 for tier in self.TIERS}
+        self.tier_of = {}
+        self.file_store = None
+        self.length = 0
+        self.layer_num = [{}]
+        self.key_layer_num = {}
@@ -0,0 +1,127 @@
+"""
+Storage codec of the attention maps recorded by AttentionStore.
+Encoded maps are plain tensors, so every store backend keeps them as is, and consumers call `decode_attention'
+right before use, on the device and dtype of the computation.
+Self-attention maps can also be stored as a truncated factorization, see `encode_low_rank'.
+"""
+
+from typing import Dict, Optional, Tuple
+
+import torch
+
+CODECS = ['none', 'fp16', 'bf16', 'uint8']
+# an uint8 row stores 255 * attn / row_max, followed by the fp16 row max in 2 bytes
+SCALE_BYTES = 2
+
+
+def encode_attention(attn: torch.Tensor, codec: str = 'none') -> torch.Tensor:
+    if codec == 'none':
+        return attn
+    if codec == 'fp16':
+        return attn.to(torch.float16)
+    if codec == 'bf16':
+        return attn.to(torch.bfloat16)
+    if codec == 'uint8':
+        # rows are softmax-normalized, the row max keeps the resolution of small rows
+        attn = attn.float()
+        scale = attn.amax(dim=-1, keepdim=True).clamp(min=1e-6).to(torch.float16)
+        quantized = (attn / scale.float() * 255).round_().clamp_(0, 255).to(torch.uint8)
+        return torch.cat([quantized, scale.view(torch.uint8)], dim=-1)
+    raise ValueError(f"codec must be one of {CODECS}, not {codec}")
+
+
+def decode_attention(attn: Optional[torch.Tensor], device=None, dtype=None) -> Optional[torch.Tensor]:
+    "Decode an encoded map on device in dtype, other maps are only moved"
+    if attn is None:
+        return None
+    if dtype is None:
+        dtype = torch.float32 if attn.dtype == torch.uint8 else attn.dtype
+    if attn.dtype != torch.uint8:
+        return attn.to(device, dtype=dtype)
+    # move the 1-byte values first, then dequantize on device
+    attn = attn.to(device)
+    scale = attn[..., -SCALE_BYTES:].contiguous().view(torch.float16)
+    return attn[..., :-SCALE_BYTES].to(dtype) * (scale.to(dtype) / 255)
+
+
+def encode_low_rank(attn: torch.Tensor, rank: int, codec: str = 'none') -> torch.Tensor:
+    """Truncated randomized SVD of the [res, res*k] map of each frame and head,
+    packed as [frames, heads, res + res*k, rank]: U * S in the first res rows, V in the others.
+    Maps too small to gain from the factorization are only encoded with codec.
+    """
+    num_query, num_key = attn.shape[-2:]
+    if rank * (num_query + num_key) >= num_query * num_key:
+        return encode_attention(attn, codec)
+    factors = []
+    # one frame at a time bounds the fp32 copy of the map
+    for frame_attn in attn.detach():
+        u, s, v = torch.svd_lowrank(frame_attn.float(), q=rank, niter=2)
+        factors.append(torch.cat([u * s.unsqueeze(-2), v], dim=-2))
+    # the factors are signed, they cannot use the uint8 codec of softmax rows
+    return encode_attention(torch.stack(factors), 'fp16' if codec == 'uint8' else codec)
+
+
+def is_low_rank(attn: Optional[torch.Tensor], num_query: int) -> bool:
+    "A packed factorization has res + res*k rows instead of the num_query rows of the map"
+    return attn is not None and attn.shape[-2] != num_query
+
+
+def split_low_rank(attn: torch.Tensor, num_query: int, device=None, dtype=None) -> Tuple[torch.Tensor, torch.Tensor]:
+    "U * S [..., res, rank] and V [..., res*k, rank] of a packed factorization, the map is (U * S) V^T"
+    attn = decode_attention(attn, device, dtype)
+    return attn[..., :num_query, :], attn[..., num_query:, :]
+
+
+def decode_low_rank(attn: Optional[torch.Tensor], num_query: int, device=None, dtype=None) -> Optional[torch.Tensor]:
+    "Dense map of num_query rows, from a packed factorization or an encoded map"
+    if not is_low_rank(attn, num_query):
+        return decode_attention(attn, device, dtype)
+    us, v = split_low_rank(attn, num_query, device, dtype)
+    return torch.matmul(us, v.transpose(-1, -2))
+
+
+def slice_attention_rows(attn: Optional[torch.Tensor], start: int, stop: int, num_query: int) -> Optional[torch.Tensor]:
+    "Query rows start:stop of an encoded map of num_query rows, a packed factorization keeps all its V rows"
+    if attn is None:
+        return None
+    if is_low_rank(attn, num_query):
+        return torch.cat([attn[..., start:stop, :], attn[..., num_query:, :]], dim=-2)
+    return attn[..., start:stop, :]
+
+
+class CodecErrorReport:
+    """Reconstruction error of every codec on the maps recorded by an AttentionStore,
+    updated at each recorded map when `codec_report' is on.
+    """
+    def update(self, attn: torch.Tensor):
+        attn = attn.detach().float()
+        for codec in CODECS[1:]:
+            encoded = encode_attention(attn, codec)
+            error = (decode_attention(encoded, dtype=torch.float32) - attn).abs()
+            stats = self.stats[codec]
+            stats['bytes'] += encoded.numel() * encoded.element_size()
+            stats['fp32_bytes'] += attn.numel() * 4
+            stats['max_abs_error'] = max(stats['max_abs_error'], error.max().item())
+            stats['abs_error_sum'] += error.sum().item()
+            stats['squared_error_sum'] += error.pow(2).sum().item()
+            stats['squared_sum'] += attn.pow(2).sum().item()
+            stats['count'] += attn.numel()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        "compression ratio against fp32, max / mean absolute error and relative Frobenius error of each codec"
+        summary = {}
+        for codec, stats in self.stats.items():
+            if stats['count'] == 0:
+                continue
+            summary[codec] = {
+                'compression': stats['fp32_bytes'] / stats['bytes'],
+                'max_abs_error': stats['max_abs_error'],
+                'mean_abs_error': stats['abs_error_sum'] / stats['count'],
+                'relative_error': (stats['squared_error_sum'] / max(stats['squared_sum'], 1e-12)) ** 0.5,
+            }
+        return summary
+
+    def __init__(self):
+        self.stats = {codec: {'bytes': 0, 'fp32_bytes': 0, 'max_abs_error': 0.0, 'abs_error_sum': 0.0,
+                              'squared_error_sum': 0.0, 'squared_sum': 0.0, 'count': 0}
+                      for codec in CODECS[1:]}
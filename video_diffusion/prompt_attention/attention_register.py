@@ -6,21 +6,29 @@ Most of spatial_temporal_forward is directly copy from `video_diffusion/models/a
 TODO FIXME: merge redundant code with attention.py
 """
 
+import weakref
+
 from einops import rearrange
 import torch
 import torch.nn.functional as F
 
+from video_diffusion.models.attention import (compute_attention, get_sparse_causal_frames,
+                                              get_sparse_causal_window_frames, gather_sparse_causal_frames)
+from video_diffusion.prompt_attention.attention_codec import (decode_attention, is_low_rank, split_low_rank,
+                                                              slice_attention_rows)
+from video_diffusion.prompt_attention.attention_store import QUERY_CHUNK_SIZE
+
 
 def register_attention_control(model, controller):
-    "Connect a model with a controller"
-    def attention_controlled_forward(self, place_in_unet, attention_type='cross'):
+    "Connect a model with a controller, None detaches the controller"
+    def attention_controlled_forward(self, place_in_unet, attention_type='cross', layer_id=None):
         to_out = self.to_out
         if type(to_out) is torch.nn.modules.container.ModuleList:
             to_out = self.to_out[0]
         else:
             to_out = self.to_out
         
-        def _attention( query, key, value, is_cross, attention_mask=None):
+        def _attention_probs(query, key, dtype, attention_mask=None):
             if self.upcast_attention:
                 query = query.float()
                 key = key.float()
@@ -42,17 +50,102 @@ def register_attention_control(model, controller):
             attention_probs = attention_scores.softmax(dim=-1)
 
             # cast back to the original dtype
-            attention_probs = attention_probs.to(value.dtype)
-
-            # START OF CORE FUNCTION
-            # Record during inversion and edit the attention probs during editing
-            attention_probs = controller(reshape_batch_dim_to_temporal_heads(attention_probs), 
-                                         is_cross, place_in_unet)
-            attention_probs = reshape_temporal_heads_to_batch_dim(attention_probs)
-            # END OF CORE FUNCTION
-            
-            # compute attention output
-            hidden_states = torch.bmm(attention_probs, value)
+            return attention_probs.to(dtype)
+
+        def _replaced_attention(query, key, value, attention_base):
+            """
+            The edited batch uses the stored attention map directly, skip its QK^T and softmax
+            attention_base: [frames, heads, res, res*k] of the inverted store, broadcast over the edited frames,
+                or its packed low-rank factors, applied as U (V^T value) without the dense map
+            The rows of attention_base are decoded by blocks of QUERY_CHUNK_SIZE queries
+            """
+            batch = query.shape[0] // self.heads
+            edit_batch = batch if controller.LOW_RESOURCE else batch // 2
+            uncond_rows = (batch - edit_batch) * self.heads
+            num_query = query.shape[1]
+
+            edit_value = rearrange(value[uncond_rows:], "(b h) t d -> b h t d", h=self.heads)
+            low_rank = is_low_rank(attention_base, num_query)
+            if low_rank:
+                us, v = split_low_rank(attention_base, num_query, value.device, value.dtype)
+                v_value = torch.matmul(v.transpose(-1, -2), edit_value)
+            hidden_states = []
+            for start in range(0, num_query, QUERY_CHUNK_SIZE):
+                stop = min(start + QUERY_CHUNK_SIZE, num_query)
+                if low_rank:
+                    block = torch.matmul(us[..., start:stop, :], v_value)
+                else:
+                    block_base = decode_attention(attention_base[..., start:stop, :], value.device, value.dtype)
+                    block = torch.matmul(block_base, edit_value)
+                block = rearrange(block, "b h s d -> (b h) s d")
+
+                if uncond_rows > 0:
+                    # classifier-free guidance: the unconditional half is not edited by the controller
+                    uncond_probs = _attention_probs(query[:uncond_rows, start:stop], key[:uncond_rows], value.dtype)
+                    block = torch.cat([torch.bmm(uncond_probs, value[:uncond_rows]), block], dim=0)
+                hidden_states.append(block)
+            return torch.cat(hidden_states, dim=1) if len(hidden_states) > 1 else hidden_states[0]
+
+        def _value_edited_attention(attention_probs, value, cross_value_edit):
+            """
+            The cross attention edit of the controller is folded into value:
+            attention_base @ (value_mapper @ value) + attention_probs @ (value_scale * value)
+            the [words, words] mapper is applied on [words, dim] value, independent of the spatial resolution
+            """
+            attention_base, value_mapper, value_scale = cross_value_edit
+            batch = attention_probs.shape[0] // self.heads
+            edit_batch = batch if controller.LOW_RESOURCE else batch // 2
+            uncond_rows = (batch - edit_batch) * self.heads
+
+            edit_value = rearrange(value[uncond_rows:], "(b h) t d -> b h t d", h=self.heads)
+            edit_probs = rearrange(attention_probs[uncond_rows:], "(b h) s t -> b h s t", h=self.heads)
+            attention_base = decode_attention(attention_base, value.device, value.dtype)
+            value_mapper = value_mapper.to(value.device, dtype=value.dtype)
+            value_scale = value_scale.to(value.device, dtype=value.dtype)
+
+            hidden_states = torch.matmul(edit_probs, value_scale[:, None] * edit_value) \
+                + torch.matmul(attention_base, torch.matmul(value_mapper, edit_value))
+            hidden_states = rearrange(hidden_states, "b h s d -> (b h) s d")
+            if uncond_rows > 0:
+                hidden_states = torch.cat([torch.bmm(attention_probs[:uncond_rows], value[:uncond_rows]), hidden_states], dim=0)
+            return hidden_states
+
+        def _attention( query, key, value, is_cross, attention_mask=None):
+            get_replaced_attention = getattr(controller, 'get_replaced_self_attention', None)
+            if get_replaced_attention is not None and attention_mask is None:
+                attention_base = get_replaced_attention(is_cross, place_in_unet, query.shape[1], layer_id)
+                if attention_base is not None:
+                    hidden_states = _replaced_attention(query, key, value, attention_base)
+                    return self.reshape_batch_dim_to_heads(hidden_states)
+
+            bypass_attention = getattr(controller, 'bypass_attention', None)
+            if bypass_attention is not None and bypass_attention(is_cross, place_in_unet, query.shape[1], layer_id):
+                # neither recorded nor edited at this step, no probabilities are needed
+                return compute_attention(self, query, key, value, attention_mask)
+
+            num_query = query.shape[1]
+            # the [b*heads, 4096, 4096*k] scores of the 64x64 layers are never materialized,
+            # the controller records and edits them by blocks of query rows
+            chunk_size = QUERY_CHUNK_SIZE if attention_mask is None else num_query
+            hidden_states = []
+            for start in range(0, num_query, chunk_size):
+                attention_probs = _attention_probs(query[:, start:start + chunk_size], key, value.dtype, attention_mask)
+
+                # START OF CORE FUNCTION
+                # Record during inversion and edit the attention probs during editing
+                attention_probs = controller(reshape_batch_dim_to_temporal_heads(attention_probs),
+                                             is_cross, place_in_unet, layer_id, row_offset=start, num_query=num_query)
+                attention_probs = reshape_temporal_heads_to_batch_dim(attention_probs)
+                # END OF CORE FUNCTION
+
+                # compute attention output
+                pop_cross_value_edit = getattr(controller, 'pop_cross_value_edit', None)
+                cross_value_edit = pop_cross_value_edit() if pop_cross_value_edit is not None else None
+                if cross_value_edit is not None:
+                    hidden_states.append(_value_edited_attention(attention_probs, value, cross_value_edit))
+                else:
+                    hidden_states.append(torch.bmm(attention_probs, value))
+            hidden_states = torch.cat(hidden_states, dim=1) if len(hidden_states) > 1 else hidden_states[0]
 
             # reshape hidden_states
             hidden_states = self.reshape_batch_dim_to_heads(hidden_states)
@@ -78,6 +171,14 @@ def register_attention_control(model, controller):
             if self.group_norm is not None:
                 hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
+            text_attention = is_cross and self.added_kv_proj_dim is None and hasattr(self, 'text_attention')
+            bypass_attention = getattr(controller, 'bypass_attention', None)
+            if text_attention and attention_mask is None and bypass_attention is not None \
+                    and bypass_attention(is_cross, place_in_unet, hidden_states.shape[1], layer_id):
+                # neither recorded nor edited at this step, the frames share the text key and value,
+                # see TextCrossAttention
+                return to_out(self.text_attention(hidden_states, encoder_hidden_states))
+
             query = self.to_q(hidden_states)
             query = self.reshape_heads_to_batch_dim(query)
 
@@ -94,6 +195,12 @@ def register_attention_control(model, controller):
 
                 key = torch.concat([encoder_hidden_states_key_proj, key], dim=1)
                 value = torch.concat([encoder_hidden_states_value_proj, value], dim=1)
+            elif text_attention:
+                # text key and value are cached across steps, the maps of each frame need them per frame
+                key, value = self.get_text_key_value(encoder_hidden_states)
+                repeat = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+                key = self.expand_to_frames(key, repeat)
+                value = self.expand_to_frames(value, repeat)
             else:
                 encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
                 key = self.to_k(encoder_hidden_states)
@@ -109,16 +216,8 @@ def register_attention_control(model, controller):
                     attention_mask = attention_mask.repeat_interleave(self.heads, dim=0)
 
 
-            if self._use_memory_efficient_attention_xformers and query.shape[-2] > 32 ** 2:
-                # for large attention map of 64X64, use xformers to save memory
-                hidden_states = self._memory_efficient_attention_xformers(query, key, value, attention_mask)
-                # Some versions of xformers return output in fp32, cast it back to the dtype of the input
-                hidden_states = hidden_states.to(query.dtype)
-            else:
-            
-                hidden_states = _attention(query, key, value, is_cross=is_cross, attention_mask=attention_mask)
-                # else:
-                #     hidden_states = self._sliced_attention(query, key, value, sequence_length, dim, attention_mask)
+            # the 64x64 layers that are neither recorded nor edited use xformers through `compute_attention'
+            hidden_states = _attention(query, key, value, is_cross=is_cross, attention_mask=attention_mask)
 
             # linear proj
             hidden_states = to_out(hidden_states)
@@ -133,7 +232,8 @@ def register_attention_control(model, controller):
             encoder_hidden_states=None,
             attention_mask=None,
             clip_length: int = None,
-            SparseCausalAttention_index: list = [-1, 'first']
+            SparseCausalAttention_index: list = [-1, 'first'],
+            SparseCausalAttention_window: dict = None
         ):
             """
             Most of spatial_temporal_forward is directly copy from `video_diffusion.models.attention.SparseCausalAttention'
@@ -159,56 +259,27 @@ def register_attention_control(model, controller):
             key = self.to_k(hidden_states)
             value = self.to_v(hidden_states)
 
-            if clip_length is not None:
-                key = rearrange(key, "(b f) d c -> b f d c", f=clip_length)
-                value = rearrange(value, "(b f) d c -> b f d c", f=clip_length)
-
-
+            if clip_length is not None and (SparseCausalAttention_window is not None
+                                            or len(SparseCausalAttention_index) > 0):
                 #  *********************** Start of Spatial-temporal attention **********
-                frame_index_list = []
-                
-                if len(SparseCausalAttention_index) > 0:
-                    for index in SparseCausalAttention_index:
-                        if isinstance(index, str):
-                            if index == 'first':
-                                frame_index = [0] * clip_length
-                            if index == 'last':
-                                frame_index = [clip_length-1] * clip_length
-                            if (index == 'mid') or (index == 'middle'):
-                                frame_index = [int((clip_length-1)//2)] * clip_length
-                        else:
-                            assert isinstance(index, int), 'relative index must be int'
-                            frame_index = torch.arange(clip_length) + index
-                            frame_index = frame_index.clip(0, clip_length-1)
-                            
-                        frame_index_list.append(frame_index)
-                    key = torch.cat([   key[:, frame_index] for frame_index in frame_index_list
-                                        ], dim=2)
-                    value = torch.cat([ value[:, frame_index] for frame_index in frame_index_list
-                                        ], dim=2)
-
-
+                # the controller records and edits the maps of each frame, the anchor frames are gathered
+                # for every frame instead of folded into the query as in `SparseCausalAttention'
+                if SparseCausalAttention_window is not None:
+                    # the recorded maps of each frame have the same number of key frames as without chunks
+                    window = {k: v for k, v in SparseCausalAttention_window.items() if k != 'chunk_size'}
+                    frames = get_sparse_causal_window_frames(clip_length, **window)
+                else:
+                    # one entry per index, the keys of the maps do not depend on clip_length
+                    frames = get_sparse_causal_frames(clip_length, SparseCausalAttention_index, dedupe=False)
+                key = gather_sparse_causal_frames(key, clip_length, frames)
+                value = gather_sparse_causal_frames(value, clip_length, frames)
                 #  *********************** End of Spatial-temporal attention **********
-                key = rearrange(key, "b f d c -> (b f) d c", f=clip_length)
-                value = rearrange(value, "b f d c -> (b f) d c", f=clip_length)
-            
+
             key = self.reshape_heads_to_batch_dim(key)
             value = self.reshape_heads_to_batch_dim(value)
 
-            if self._use_memory_efficient_attention_xformers and query.shape[-2] > 32 ** 2:
-                # FIXME there should be only one variable to control whether use xformers
-                # if self._use_memory_efficient_attention_xformers:
-                # for large attention map of 64X64, use xformers to save memory
-                hidden_states = self._memory_efficient_attention_xformers(query, key, value, attention_mask)
-                # Some versions of xformers return output in fp32, cast it back to the dtype of the input
-                hidden_states = hidden_states.to(query.dtype)
-            else:
-            # if self._slice_size is None or query.shape[0] // self._slice_size == 1:
-                hidden_states = _attention(query, key, value, attention_mask=attention_mask, is_cross=False)
-            # else:
-            #     hidden_states = self._sliced_attention(
-            #         query, key, value, hidden_states.shape[1], dim, attention_mask
-            #     )
+            # the 64x64 layers that are neither recorded nor edited use xformers through `compute_attention'
+            hidden_states = _attention(query, key, value, attention_mask=attention_mask, is_cross=False)
 
             # linear proj
             hidden_states = to_out(hidden_states)
@@ -216,43 +287,67 @@ def register_attention_control(model, controller):
             # dropout
             # hidden_states = self.to_out[1](hidden_states)
             return hidden_states
-        if attention_type == 'CrossAttention':
+        if attention_type in ['CrossAttention', 'TextCrossAttention']:
             return forward
         elif attention_type == "SparseCausalAttention":
             return spatial_temporal_forward
 
-    class DummyController:
-
-        def __call__(self, *args):
-            return args[0]
-
-        def __init__(self):
-            self.num_att_layers = 0
-
     if controller is None:
-        controller = DummyController()
-    
-    def register_recr(net_, count, place_in_unet):
-        if net_[1].__class__.__name__ == 'CrossAttention' \
-            or net_[1].__class__.__name__ == 'SparseCausalAttention':
-            net_[1].forward = attention_controlled_forward(net_[1], place_in_unet, attention_type = net_[1].__class__.__name__)
-            return count + 1
+        detach_attention_control(model)
+        return
+
+    if hasattr(controller, 'reset_layer_plans'):
+        controller.reset_layer_plans()
+    attention_layers = get_attention_layers(model.unet)
+    for layer_id, (module, place_in_unet) in enumerate(attention_layers):
+        if module not in native_forwards:
+            # an instance-level forward patched before the first registration, None for the class forward
+            native_forwards[module] = module.__dict__.get('forward')
+        # the registration order is the static ID of the layer in the plans of the controller
+        module.forward = attention_controlled_forward(module, place_in_unet, attention_type = module.__class__.__name__,
+                                                      layer_id=layer_id)
+    print(f"Number of attention layer registered {len(attention_layers)}")
+    controller.num_att_layers = len(attention_layers)
+
+
+# model.unet -> [(attention module, place_in_unet)], found once per UNet
+attention_layers_cache = weakref.WeakKeyDictionary()
+# attention module -> its forward before the registration
+native_forwards = weakref.WeakKeyDictionary()
+
+
+def get_attention_layers(unet):
+    "Attention layers controlled by `register_attention_control' with their place in the UNet, in registration order"
+    if unet in attention_layers_cache:
+        return attention_layers_cache[unet]
+    attention_layers = []
+
+    def register_recr(net_, place_in_unet):
+        if net_[1].__class__.__name__ in ['CrossAttention', 'TextCrossAttention', 'SparseCausalAttention']:
+            attention_layers.append((net_[1], place_in_unet))
         elif hasattr(net_[1], 'children'):
             for net in net_[1].named_children():
                 if net[0] !='attn_temporal':
+                    register_recr(net, place_in_unet)
 
-                    count = register_recr(net, count, place_in_unet)
-
-        return count
-
-    cross_att_count = 0
-    sub_nets = model.unet.named_children()
-    for net in sub_nets:
+    for net in unet.named_children():
         if "down" in net[0]:
-            cross_att_count += register_recr(net, 0, "down")
+            register_recr(net, "down")
         elif "up" in net[0]:
-            cross_att_count += register_recr(net, 0, "up")
+            register_recr(net, "up")
         elif "mid" in net[0]:
-            cross_att_count += register_recr(net, 0, "mid")
-    print(f"Number of attention layer registered {cross_att_count}")
-    controller.num_att_layers = cross_att_count
+            register_recr(net, "mid")
+    attention_layers_cache[unet] = attention_layers
+    return attention_layers
+
+
+def detach_attention_control(model):
+    "Restore the native forward of the attention layers, the memory-efficient kernels included"
+    for module, _ in get_attention_layers(model.unet):
+        if module not in native_forwards:
+            continue
+        native_forward = native_forwards.pop(module)
+        if native_forward is None:
+            module.__dict__.pop('forward', None)
+        else:
+            module.forward = native_forward
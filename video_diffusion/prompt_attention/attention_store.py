@@ -4,10 +4,32 @@ Code of attention storer AttentionStore, which is a base class for attention edi
 """
 
 import abc
-import os
-import copy
+from collections import namedtuple
+
 import torch
-from video_diffusion.common.util import get_time_string
+from video_diffusion.prompt_attention.attention_cache import (AttentionFileStore, AttentionCacheManager,
+                                                              AttentionTieredStore)
+from video_diffusion.prompt_attention.attention_codec import (encode_attention, decode_attention, encode_low_rank,
+                                                              decode_low_rank, CodecErrorReport)
+from video_diffusion.prompt_attention.step_subset import (StepSubset, SubsetLayers, get_relative_change,
+                                                          interpolate_attention)
+
+# Static plan of a registered attention layer, compiled at its first call:
+# key in the stores, position among the layers of the key in the consumed store (None if not stored)
+LayerPlan = namedtuple('LayerPlan', ['key', 'is_cross', 'num_query', 'position'])
+
+# layers with more queries compute their controlled attention by blocks of query rows, see attention_register.py
+QUERY_CHUNK_SIZE = 32 ** 2
+
+
+def get_layer_key(place_in_unet: str, is_cross: bool, num_query: int) -> str:
+    """Key of a layer in the stores. The 64x64 layers are kept under `<place>_hires_<type>',
+    so that the positions of the other layers, e.g. `SpatialBlender.BLEND_LAYERS', do not depend on max_query
+    """
+    if num_query > QUERY_CHUNK_SIZE:
+        return f"{place_in_unet}_hires_{'cross' if is_cross else 'self'}"
+    return f"{place_in_unet}_{'cross' if is_cross else 'self'}"
+
 
 class AttentionControl(abc.ABC):
     
@@ -31,20 +53,77 @@ class AttentionControl(abc.ABC):
         # return self.num_att_layers if config_dict['LOW_RESOURCE'] else 0
         return 0
     
+    def get_position_max_query(self) -> int:
+        "layers with more queries have no position in the consumed store"
+        return 32 ** 2
+
+    def get_layer_plan(self, layer_id: int, is_cross: bool, place_in_unet: str, num_query: int) -> LayerPlan:
+        """Plan of the layer with the static ID given by `register_attention_control',
+        compiled at its first call, so that the layers of a key get their positions in the call order.
+        """
+        if layer_id is None:
+            layer_id = self.cur_att_layer
+        layer_plan = self.layer_plans.get(layer_id)
+        if layer_plan is not None and layer_plan.num_query == num_query and layer_plan.is_cross == is_cross:
+            return layer_plan
+        if layer_plan is not None:
+            # the resolution changed, compile all layers again from this call
+            self.reset_layer_plans()
+        key = get_layer_key(place_in_unet, is_cross, num_query)
+        position = None
+        if num_query <= self.get_position_max_query():
+            position = self.layer_num.get(key, 0)
+            self.layer_num[key] = position + 1
+        layer_plan = self.layer_plans[layer_id] = LayerPlan(key, is_cross, num_query, position)
+        return layer_plan
+
+    def needs_attention_probs(self, layer_plan: LayerPlan) -> bool:
+        "whether `forward' reads or edits the attention probabilities of the layer at the current step"
+        return True
+
+    def skip_layer(self, layer_plan: LayerPlan):
+        "what `forward' does for a layer whose probabilities are not needed"
+        return
+
+    def bypass_attention(self, is_cross: bool, place_in_unet: str, num_query: int, layer_id: int = None) -> bool:
+        """Called by the registered attention before computing QK^T.
+        If the probabilities of the layer are not needed at this step, advance the layer counter as `__call__` does
+        and return True, the attention is then computed by a fused kernel, see `compute_attention'.
+        """
+        if self.cur_att_layer >= self.num_uncond_att_layers:
+            layer_plan = self.get_layer_plan(layer_id, is_cross, place_in_unet, num_query)
+            if self.needs_attention_probs(layer_plan):
+                return False
+            self.skip_layer(layer_plan)
+        self.cur_att_layer += 1
+        return True
+
+    def reset_layer_plans(self):
+        self.layer_plans = {}
+        self.layer_num = {}
+
     @abc.abstractmethod
-    def forward (self, attn, is_cross: bool, place_in_unet: str):
+    def forward (self, attn, is_cross: bool, place_in_unet: str, layer_plan: LayerPlan = None, row_offset: int = 0):
         raise NotImplementedError
 
-    def __call__(self, attn, is_cross: bool, place_in_unet: str):
+    def __call__(self, attn, is_cross: bool, place_in_unet: str, layer_id: int = None,
+                 row_offset: int = 0, num_query: int = None):
+        """attn is the block of query rows row_offset:row_offset + attn.shape[-2] of a layer with num_query rows,
+        the whole map by default. The layer counter advances after its last block.
+        """
+        if num_query is None:
+            num_query = attn.shape[-2]
         if self.cur_att_layer >= self.num_uncond_att_layers:
+            layer_plan = self.get_layer_plan(layer_id, is_cross, place_in_unet, num_query)
             if self.LOW_RESOURCE:
                 # For inversion without null text file 
-                attn = self.forward(attn, is_cross, place_in_unet)
+                attn = self.forward(attn, is_cross, place_in_unet, layer_plan, row_offset)
             else:
                 # For classifier-free guidance scale!=1
                 h = attn.shape[0]
-                attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet)
-        self.cur_att_layer += 1
+                attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet, layer_plan, row_offset)
+        if row_offset + attn.shape[-2] >= num_query:
+            self.cur_att_layer += 1
 
         return attn
     
@@ -58,6 +137,9 @@ class AttentionControl(abc.ABC):
         self.cur_step = 0
         self.num_att_layers = -1
         self.cur_att_layer = 0
+        # layer_id -> LayerPlan
+        self.layer_plans = {}
+        self.layer_num = {}
 
 
 class AttentionStore(AttentionControl):
@@ -71,67 +153,403 @@ class AttentionStore(AttentionControl):
     @staticmethod
     def get_empty_store():
         return {"down_cross": [], "mid_cross": [], "up_cross": [],
-                "down_self": [],  "mid_self": [],  "up_self": []}
+                "down_self": [],  "mid_self": [],  "up_self": [],
+                "down_hires_cross": [], "up_hires_cross": [],
+                "down_hires_self": [], "up_hires_self": []}
 
     @staticmethod
     def get_empty_cross_store():
         return {"down_cross": [], "mid_cross": [], "up_cross": [],
                 }
 
-    def forward(self, attn, is_cross: bool, place_in_unet: str):
-        key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-        if attn.shape[-2] <= 32 ** 2:  # avoid memory overhead
-            # print(f"Store attention map {key} of shape {attn.shape}")
-            if is_cross or self.save_self_attention:
-                if attn.shape[-2] == 32**2:
-                    append_tensor = attn.cpu().detach()
-                else:
-                    append_tensor = attn
-                self.step_store[key].append(copy.deepcopy(append_tensor))
-                # FIXME: Are these deepcopy all necessary?
-                # self.step_store[key].append(append_tensor)
+    def get_max_query(self) -> int:
+        "maps with more queries are not recorded"
+        return self.recording_plan.max_query if self.recording_plan is not None else self.max_query
+
+    def get_position_max_query(self) -> int:
+        return self.get_max_query()
+
+    def get_record_device(self, num_query: int, attn: torch.Tensor):
+        "maps of 32x32 and more queries are kept on cpu, unless the tiered store places them"
+        if num_query >= 32 ** 2 and self.tier_budget is None:
+            return torch.device('cpu')
+        return attn.device
+
+    def forward(self, attn, is_cross: bool, place_in_unet: str, layer_plan: LayerPlan = None, row_offset: int = 0):
+        """Record attn of [frames, heads, res, words or res*k].
+        The layers above QUERY_CHUNK_SIZE queries are called with blocks of their query rows starting at row_offset,
+        each block is encoded and moved to the record device, and the map is stored after its last block.
+        """
+        if layer_plan is None:
+            layer_plan = self.get_layer_plan(None, is_cross, place_in_unet, attn.shape[-2])
+        if not self.records_layer(layer_plan):  # avoid memory overhead
+            return attn
+        key = layer_plan.key
+        layer = len(self.step_store[key])
+        # print(f"Store attention map {key} of shape {attn.shape}")
+        if attn.shape[-2] < layer_plan.num_query:
+            self.record_rows(key, layer, attn, row_offset, layer_plan.num_query)
+            return attn
+        if self.recording_plan is not None:
+            if not self.recording_plan.records(self.cur_step, key, layer):
+                # not consumed by any edit, keep the layer position
+                self.step_store[key].append(None)
+                return attn
+            record_attn = self.recording_plan.select_tokens(attn.detach())
+        else:
+            record_attn = attn.detach()
+        if self.step_subset is not None and not self.keeps_step(key, layer, record_attn):
+            # held or interpolated from the kept steps when read
+            self.step_store[key].append(None)
+            return attn
+        if self.codec_report is not None:
+            self.codec_report.update(record_attn)
+        if not is_cross and self.self_attention_rank is not None:
+            record_attn = encode_low_rank(record_attn, self.self_attention_rank, self.attention_codec)
+        else:
+            record_attn = encode_attention(record_attn, self.attention_codec)
+        # attn is edited in place after recording, so it is always copied once
+        self.append_attention(key, layer, record_attn, self.get_record_device(attn.shape[-2], attn), copy=True)
         return attn
 
-    def between_steps(self):
-        if len(self.attention_store) == 0:
-            self.attention_store = self.step_store
+    def record_rows(self, key: str, layer: int, attn: torch.Tensor, row_offset: int, num_query: int):
+        """Record a block of query rows of a chunked layer, the full map is never materialized on the device.
+        The low-rank factorization needs the full map, chunked self-attention is stored with the codec only.
+        """
+        if row_offset == 0:
+            self.records_rows = self.recording_plan is None or self.recording_plan.records(self.cur_step, key, layer)
+            # encoded blocks on the record device, [squared change, squared norm] from the last kept step
+            self.row_blocks, self.row_change, self.row_numel = [], [0.0, 0.0], 0
+            # every k-th step is decided before the first block, a threshold after the last one
+            self.rows_kept = None
+            step_subset = self.step_subset
+            if self.records_rows and step_subset is not None and step_subset.threshold is None \
+                    and step_subset.report is None:
+                self.rows_kept = self.records_rows = step_subset.keeps(self.cur_step, key, layer, 0, None)
+        last_rows = row_offset + attn.shape[-2] >= num_query
+        if not self.records_rows:
+            if last_rows:
+                self.step_store[key].append(None)
+            return
+        record_attn = attn.detach()
+        if self.recording_plan is not None:
+            record_attn = self.recording_plan.select_tokens(record_attn)
+        if self.codec_report is not None:
+            self.codec_report.update(record_attn)
+        step_subset = self.step_subset
+        if step_subset is not None and (step_subset.threshold is not None or step_subset.report is not None):
+            kept_steps = step_subset.get_kept_steps(key, layer)
+            if len(kept_steps) > 0:
+                # the change is accumulated by blocks, against the same rows of the last kept step
+                kept_rows = self.attention_store_all_step[kept_steps[-1]][key][layer]
+                kept_rows = decode_attention(kept_rows[..., row_offset:row_offset + attn.shape[-2], :],
+                                             attn.device, torch.float32)
+                self.row_change[0] += (record_attn.float() - kept_rows).pow(2).sum().item()
+                self.row_change[1] += kept_rows.pow(2).sum().item()
+        self.row_numel += record_attn.numel()
+        record_attn = encode_attention(record_attn, self.attention_codec)
+        self.row_blocks.append(record_attn.to(self.get_record_device(num_query, attn), copy=True))
+        if not last_rows:
+            return
+        record_attn = torch.cat(self.row_blocks, dim=-2)
+        self.row_blocks = []
+        if step_subset is not None and self.rows_kept is None:
+            def get_change(kept_step):
+                return (self.row_change[0] / max(self.row_change[1], 1e-24)) ** 0.5
+            if not step_subset.keeps(self.cur_step, key, layer, self.row_numel, get_change):
+                self.step_store[key].append(None)
+                return
+        # the blocks are already copies
+        self.append_attention(key, layer, record_attn, record_attn.device, copy=False)
+
+    def append_attention(self, key: str, layer: int, record_attn: torch.Tensor, device, copy: bool = True):
+        "Append an encoded map to step_store, written in the store of all steps unless it is on disk"
+        if self.disk_store:
+            append_tensor = record_attn.to(device, copy=copy)
         else:
-            for key in self.attention_store:
-                for i in range(len(self.attention_store[key])):
-                    self.attention_store[key][i] += self.step_store[key][i]
+            append_tensor = self.attention_store_all_step.write(key, layer, record_attn, device)
+        self.step_store[key].append(append_tensor)
+
+    def keeps_step(self, key: str, layer: int, attn: torch.Tensor) -> bool:
+        "whether the step subset keeps the map of (key, layer) at the current step"
+        def get_change(kept_step):
+            kept_attn = self.attention_store_all_step[kept_step][key][layer]
+            kept_attn = decode_low_rank(kept_attn, attn.shape[-2], attn.device, torch.float32)
+            return get_relative_change(attn, kept_attn)
+        return self.step_subset.keeps(self.cur_step, key, layer, attn.numel(), get_change)
+
+    def get_skipped_attention(self, step: int, key: str, layer: int):
+        "map of (key, layer) at a step out of the step subset, held or interpolated from the kept steps"
+        if self.recording_plan is not None and not self.recording_plan.records(step, key, layer):
+            return None
+        previous, following = self.step_subset.get_neighbours(step, key, layer)
+        if previous is None or following is None:
+            nearest = previous if following is None else following
+        elif self.step_subset.interpolation == 'hold':
+            nearest = previous if step - previous <= following - step else following
+        else:
+            previous_attn = decode_attention(self.attention_store_all_step[previous][key][layer])
+            following_attn = decode_attention(self.attention_store_all_step[following][key][layer],
+                                              previous_attn.device)
+            # self maps packed by `encode_low_rank' have more rows than columns,
+            # dense self maps attend to at least as many keys as queries
+            low_rank = key.endswith('self') and previous_attn.shape[-2] > previous_attn.shape[-1]
+            weight = (step - previous) / (following - previous)
+            return interpolate_attention(previous_attn, following_attn, weight, low_rank)
+        return None if nearest is None else self.attention_store_all_step[nearest][key][layer]
+
+    def records_layer(self, layer_plan: LayerPlan) -> bool:
+        "whether `forward' appends the map of the layer to step_store, recorded or as a None placeholder"
+        return layer_plan.num_query <= self.get_max_query() and (layer_plan.is_cross or self.save_self_attention)
+
+    def needs_attention_probs(self, layer_plan: LayerPlan) -> bool:
+        if not self.records_layer(layer_plan):
+            return False
+        if self.recording_plan is not None:
+            return self.recording_plan.records(self.cur_step, layer_plan.key, len(self.step_store[layer_plan.key]))
+        return True
+
+    def skip_layer(self, layer_plan: LayerPlan):
+        if self.records_layer(layer_plan):
+            # not recorded by the plan, keep the layer position
+            self.step_store[layer_plan.key].append(None)
+
+    def get_step_attention(self, step: int):
+        "{key: [maps of each layer]} of a stored step, None for maps not recorded by the plan"
+        step_store = self.attention_store_all_step[step]
+        if self.step_subset is not None:
+            if step < 0:
+                step += len(self.attention_store_all_step)
+            step_store = {key: SubsetLayers(step_store[key] if key in step_store else [], self, step, key)
+                          for key in self.get_empty_store()}
+        if self.recording_plan is not None:
+            step_store = self.recording_plan.wrap_step(step_store)
+        return step_store
+
+    def between_steps(self):
+        for key in self.step_store:
+            if '_hires_' in key:
+                # the 64x64 maps are neither visualized nor blended, their sum would be another copy of them
+                continue
+            attention_list = self.attention_store.setdefault(key, [])
+            for i, step_attention in enumerate(self.step_store[key]):
+                step_attention = decode_attention(step_attention)
+                if self.recording_plan is not None and key.endswith('cross'):
+                    # only the token columns of cross attention are selected by the plan
+                    step_attention = self.recording_plan.expand_tokens(step_attention)
+                if i == len(attention_list):
+                    attention_list.append(None)
+                if step_attention is None or (key.endswith('self') and self.self_attention_rank is not None):
+                    # not recorded at this step, the sum only has the recorded steps
+                    # the low-rank factors of self-attention do not add up, the sum keeps only the cross attention
+                    continue
+                if attention_list[i] is None:
+                    # the step store is kept in attention_store_all_step, do not alias it
+                    attention_list[i] = step_attention.clone()
+                    continue
+                # the tiered store may have placed this step in another tier
+                step_attention = step_attention.to(attention_list[i].device)
+                if attention_list[i].shape == step_attention.shape:
+                    attention_list[i] += step_attention
+                else:
+                    # a shared frame was broadcast to the full clip during this step
+                    attention_list[i] = attention_list[i] + step_attention
         
         if self.disk_store:
-            path = self.store_dir + f'/{self.cur_step:03d}.pt'
-            torch.save(copy.deepcopy(self.step_store), path)
-            self.attention_store_all_step.append(path)
+            self.attention_store_all_step.append(self.step_store)
         else:
-            self.attention_store_all_step.append(copy.deepcopy(self.step_store))
+            # the layers not recorded by the plan keep their positions
+            self.attention_store_all_step.end_step({key: len(layers) for key, layers in self.step_store.items()})
+        self.step_store = self.get_empty_store()
+
+    def reserve_steps(self, num_steps: int):
+        "Preallocate the attention buffers for num_steps denoising steps"
+        if isinstance(self.attention_store_all_step, AttentionStepBuffer):
+            if self.step_subset is not None and self.step_subset.threshold is not None:
+                # the kept steps are only known while recording, grow the buffers instead
+                return
+            self.attention_store_all_step.num_steps = num_steps
+            self.attention_store_all_step.recording_plan = self.recording_plan
+            if self.step_subset is not None:
+                self.attention_store_all_step.step_every = self.step_subset.every
+
+    def get_empty_all_step_store(self):
+        previous_path = getattr(getattr(self, 'attention_store_all_step', None), 'path', None)
+        if previous_path is not None:
+            self.cache_manager.release(previous_path)
+        if self.tier_budget is not None:
+            return AttentionTieredStore(self.tier_budget, self.cache_manager)
+        if self.disk_store:
+            # maps of all steps go to one file in the cache directory, older files are evicted by quota
+            return AttentionFileStore(self.cache_manager.new_path())
+        return AttentionStepBuffer()
+
+    def get_inverted_state(self):
+        "State besides the maps of all steps, saved in the inversion cache"
+        return {'cur_step': self.cur_step,
+                'latents_store': self.latents_store,
+                'attention_store': {key: [item.cpu() for item in self.attention_store[key] if item is not None]
+                                    for key in self.attention_store},
+                'step_subset': self.step_subset.get_state() if self.step_subset is not None else None}
+
+    def load_inverted_state(self, state, file_store: AttentionFileStore, device=None):
+        "Restore a store saved by `get_inverted_state' and the maps of all steps in file_store"
+        def get_device(attn):
+            # the same placement as `forward'
+            if device is None or (attn.shape[-2] >= 32**2 and self.tier_budget is None):
+                return torch.device('cpu')
+            return device
+        self.cur_step = state['cur_step']
+        self.cur_att_layer = 0
+        self.latents_store = state['latents_store']
+        self.attention_store = {key: [item.to(get_device(item)) for item in state['attention_store'][key]]
+                                for key in state['attention_store']}
         self.step_store = self.get_empty_store()
+        if self.step_subset is not None:
+            self.step_subset.load_state(state['step_subset'])
+        if self.disk_store:
+            # read the cached file in place
+            if isinstance(self.attention_store_all_step, AttentionFileStore):
+                self.cache_manager.release(self.attention_store_all_step.path)
+            self.attention_store_all_step = file_store
+        else:
+            self.attention_store_all_step = self.get_empty_all_step_store()
+            self.reserve_steps(len(file_store))
+            for step in range(len(file_store)):
+                step_store = file_store[step]
+                for key in step_store.keys():
+                    for layer, attn in enumerate(step_store[key]):
+                        if attn is not None:
+                            self.attention_store_all_step.write(key, layer, attn, get_device(attn))
+                self.attention_store_all_step.end_step({key: len(step_store[key]) for key in step_store.keys()})
 
     def get_average_attention(self):
         "divide the attention map value in attention store by denoising steps"
-        average_attention = {key: [item / self.cur_step for item in self.attention_store[key]] for key in self.attention_store}
+        average_attention = {key: [item / self.cur_step for item in self.attention_store[key] if item is not None]
+                             for key in self.attention_store}
         return average_attention
 
 
     def reset(self):
         super(AttentionStore, self).reset()
         self.step_store = self.get_empty_store()
-        self.attention_store_all_step = []
+        self.attention_store_all_step = self.get_empty_all_step_store()
         self.attention_store = {}
+        if self.step_subset is not None:
+            self.step_subset.reset()
 
-    def __init__(self, save_self_attention:bool=True, disk_store=False):
+    def __init__(self, save_self_attention:bool=True, disk_store=False, disk_quota_gb: float=20,
+                 tier_budget=None, attention_codec: str='none', codec_report: bool=False,
+                 self_attention_rank: int=None, step_subset: dict=None, max_query: int=32**2):
+        """
+        Args:
+            disk_store (bool, optional): append the maps of each step to a file in ./trash. Defaults to False.
+            disk_quota_gb (float, optional): byte budget of the attention cache in ./trash. Defaults to 20.
+            tier_budget (Union[str, dict], optional): keep the maps in AttentionTieredStore with the
+                `auto' budget or {device_gb, host_gb}, overrides disk_store. Defaults to None.
+            attention_codec (str, optional): storage codec of the maps, one of `none', `fp16', `bf16', `uint8',
+                see attention_codec.py. Defaults to 'none'.
+            codec_report (bool, optional): measure the reconstruction error of every codec on the recorded maps.
+                Defaults to False.
+            self_attention_rank (int, optional): store the self-attention maps as their rank-r randomized SVD,
+                consumed as U (V^T value) by AttentionControlEdit. Defaults to None, the dense maps.
+            step_subset (dict, optional): keep the maps of only a subset of steps, with the arguments of
+                StepSubset, e.g. {every: 5} or {threshold: 0.05, interpolation: linear}. Defaults to None, all steps.
+            max_query (int, optional): maps with more queries are not recorded, 64**2 records the 64x64 layers
+                by blocks of query rows. The recording plan has its own max_query. Defaults to 32**2.
+        """
         super(AttentionStore, self).__init__()
-        self.disk_store = disk_store
-        if self.disk_store:
-            time_string = get_time_string()
-            path = f'./trash/attention_cache_{time_string}'
-            os.makedirs(path, exist_ok=True)
-            self.store_dir = path
+        self.tier_budget = tier_budget
+        self.disk_store = disk_store and tier_budget is None
+        if disk_store or tier_budget is not None:
+            self.cache_manager = AttentionCacheManager('./trash', quota_gb=disk_quota_gb)
         else:
-            self.store_dir =None
+            self.cache_manager = None
+        # set by `P2pDDIMSpatioTemporalPipeline.prepare_latents_ddim_inverted' to record only the consumed maps
+        self.recording_plan = None
+        self.attention_codec = attention_codec if attention_codec is not None else 'none'
+        self.codec_report = CodecErrorReport() if codec_report else None
+        self.self_attention_rank = self_attention_rank
+        self.step_subset = StepSubset(**step_subset) if step_subset is not None else None
+        self.max_query = max_query
+        # encoded blocks of query rows of the chunked layer being recorded, see `record_rows'
+        self.row_blocks = []
         self.step_store = self.get_empty_store()
         self.attention_store = {}
         self.save_self_attention = save_self_attention
         self.latents_store = []
-        self.attention_store_all_step = []
+        self.attention_store_all_step = self.get_empty_all_step_store()
+
+
+class AttentionStepBuffer:
+    """Attention maps of all steps in preallocated contiguous buffers, written in place.
+    Each layer of each key has a buffer of shape [steps, *attention_shape], allocated at its first write.
+    With a RecordingPlan, a layer only has rows for its recorded steps.
+    `len()' and step indexing behave like the list of step_store dicts it replaces,
+    `buffer[step]' returns {key: [views of each layer at this step, None if not recorded]}.
+    """
+    def get_capacity(self, key: str, layer: int) -> int:
+        if self.recording_plan is not None:
+            steps = [step for step in range(self.recording_plan.num_steps)
+                     if self.recording_plan.records(step, key, layer)]
+        elif self.num_steps is not None:
+            steps = range(self.num_steps)
+        else:
+            return 1
+        if self.step_every == 1:
+            return len(steps)
+        # every k-th step, and the first recorded step is always kept
+        return sum(step % self.step_every == 0 for step in steps) + int(len(steps) > 0 and steps[0] % self.step_every != 0)
+
+    def write(self, key: str, layer: int, attn: torch.Tensor, device=None):
+        "Copy attn into the buffer of (key, layer) at the current step and return the stored view"
+        step = self.length
+        buffers, rows = self.buffers[key], self.rows[key]
+        while len(buffers) <= layer:
+            buffers.append(None)
+            rows.append({})
+        row = len(rows[layer])
+        if buffers[layer] is None:
+            buffers[layer] = torch.empty((max(self.get_capacity(key, layer), row + 1), *attn.shape), dtype=attn.dtype,
+                                         device=device if device is not None else attn.device)
+        buffer = buffers[layer]
+        if row >= buffer.shape[0] or buffer.shape[1:] != attn.shape:
+            # grow the steps, or broadcast the previous steps when a shared frame is expanded to the full clip
+            capacity = buffer.shape[0] if row < buffer.shape[0] else max(2 * buffer.shape[0], row + 1)
+            shape = torch.broadcast_shapes(buffer.shape[1:], attn.shape)
+            new_buffer = torch.empty((capacity, *shape), dtype=buffer.dtype, device=buffer.device)
+            new_buffer[:row] = buffer[:row]
+            buffer = buffers[layer] = new_buffer
+        buffer[row].copy_(attn)
+        rows[layer][step] = row
+        return buffer[row]
+
+    def end_step(self, layer_num: dict = None):
+        "layer_num is {key: number of layers} of the step, the layers never written read as None"
+        for key, num in (layer_num or {}).items():
+            while len(self.buffers[key]) < num:
+                self.buffers[key].append(None)
+                self.rows[key].append({})
+        self.length += 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, step: int):
+        if step < 0:
+            step += self.length
+        if not 0 <= step < self.length:
+            raise IndexError(f"step {step} out of range of {self.length} stored steps")
+        return {key: [buffer[layer_rows[step]] if step in layer_rows else None
+                      for buffer, layer_rows in zip(buffers, self.rows[key])]
+                for key, buffers in self.buffers.items()}
+
+    def __init__(self, num_steps: int = None, recording_plan=None):
+        self.num_steps = num_steps
+        self.recording_plan = recording_plan
+        # only every k-th step is written, see StepSubset
+        self.step_every = 1
+        self.buffers = AttentionStore.get_empty_store()
+        # step -> row in the buffer of each layer
+        self.rows = AttentionStore.get_empty_store()
+        self.length = 0
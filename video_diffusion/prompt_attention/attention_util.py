@@ -6,7 +6,6 @@ Provide a API `make_controller' to return an initialized AttentionControlEdit cl
 from typing import Optional, Union, Tuple, List, Dict
 import abc
 import numpy as np
-import copy
 from einops import rearrange
 
 import torch
@@ -16,8 +15,9 @@ import video_diffusion.prompt_attention.ptp_utils as ptp_utils
 import video_diffusion.prompt_attention.seq_aligner as seq_aligner
 from video_diffusion.prompt_attention.spatial_blend import SpatialBlender
 from video_diffusion.prompt_attention.visualization import show_cross_attention, show_self_attention_comp
-from video_diffusion.prompt_attention.attention_store import AttentionStore, AttentionControl
-from video_diffusion.prompt_attention.attention_register import register_attention_control
+from video_diffusion.prompt_attention.attention_store import AttentionStore, AttentionControl, LayerPlan
+from video_diffusion.prompt_attention.attention_codec import decode_attention, decode_low_rank, slice_attention_rows
+from video_diffusion.prompt_attention.attention_register import register_attention_control, detach_attention_control
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
 
@@ -32,9 +32,14 @@ class EmptyControl:
     def between_steps(self):
         return
     
-    def __call__(self, attn, is_cross: bool, place_in_unet: str):
+    def __call__(self, attn, is_cross: bool, place_in_unet: str, layer_id: int = None,
+                 row_offset: int = 0, num_query: int = None):
         return attn
 
+    def bypass_attention(self, is_cross: bool, place_in_unet: str, num_query: int, layer_id: int = None) -> bool:
+        "no probabilities are needed, every layer uses the fused kernels"
+        return True
+
 
 class AttentionControlEdit(AttentionStore, abc.ABC):
     """Decide self or cross-attention. Call the reweighting cross attention module
@@ -58,30 +63,32 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
             inverted_latents = inverted_latents.to(device =x_t_device, dtype=x_t_dtype)
             # [prompt, channel, clip, res, res] = [1, 4, 2, 64, 64]
             
-            blend_dict = self.get_empty_cross_store()
             # each element in blend_dict have (prompt head) clip_length (res res) words, 
             # to better align with  (b c f h w)
-            
-            step_in_store_atten_dict = self.additional_attention_store.attention_store_all_step[step_in_store]
-            if isinstance(step_in_store_atten_dict, str): 
-                step_in_store_atten_dict = torch.load(step_in_store_atten_dict)
-            
-            for key in blend_dict.keys():
-                place_in_unet_cross_atten_list = step_in_store_atten_dict[key]
-                for i, attention in enumerate(place_in_unet_cross_atten_list):
-
-                    concate_attention = torch.cat([attention[None, ...], self.attention_store[key][i][None, ...]], dim=0)
-                    blend_dict[key].append(copy.deepcopy(concate_attention))
-            x_t = self.latent_blend(x_t = copy.deepcopy(torch.cat([inverted_latents, x_t], dim=0)), attention_store = copy.deepcopy(blend_dict))
+            # only the layers read by the blender are built, the others stay None
+            blend_dict = self.get_empty_cross_store()
+            step_in_store_atten_dict = self.additional_attention_store.get_step_attention(step_in_store)
+            for key, layers in SpatialBlender.BLEND_LAYERS.items():
+                for i in range(max(layers) + 1):
+                    if i not in layers:
+                        blend_dict[key].append(None)
+                        continue
+                    current_attention = self.attention_store[key][i]
+                    attention = decode_attention(step_in_store_atten_dict[key][i],
+                                                 current_attention.device, current_attention.dtype)
+                    # the blender does not write its inputs, no copy besides the concatenation
+                    blend_dict[key].append(torch.stack([attention, current_attention], dim=0))
+            x_t = self.latent_blend(x_t = torch.cat([inverted_latents, x_t], dim=0), attention_store = blend_dict)
             return x_t[1:, ...]
         else:
             return x_t
         
     def replace_self_attention(self, attn_base, att_replace, reshaped_mask=None):
-        if att_replace.shape[-2] <= 32 ** 2:
+        if att_replace.shape[-2] <= self.get_inverted_max_query():
             target_device = att_replace.device
             target_dtype  = att_replace.dtype
-            attn_base = attn_base.to(target_device, dtype=target_dtype)
+            # the blend mask needs the dense map, also of a low-rank stored one
+            attn_base = decode_low_rank(attn_base, att_replace.shape[-2], target_device, target_dtype)
             attn_base = attn_base.unsqueeze(0).expand(att_replace.shape[0], *attn_base.shape)
             if reshaped_mask is not None:
                 return_attention = reshaped_mask*att_replace + (1-reshaped_mask)*attn_base
@@ -94,32 +101,107 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
     @abc.abstractmethod
     def replace_cross_attention(self, attn_base, att_replace):
         raise NotImplementedError
-    
-    def update_attention_position_dict(self, current_attention_key):
-        self.attention_position_counter_dict[current_attention_key] +=1
 
+    def get_cross_attention_value_map(self):
+        """Linear form of `replace_cross_attention`: attn_base @ mapper + att_replace * scale
 
-    def forward(self, attn, is_cross: bool, place_in_unet: str):
-        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
-        if attn.shape[-2] <= 32 ** 2:
-            key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-            current_pos = self.attention_position_counter_dict[key]
+        Returns:
+            mapper [prompt, words, words], scale [prompt, words]
+        """
+        raise NotImplementedError
 
-            if self.use_inversion_attention:
-                step_in_store = len(self.additional_attention_store.attention_store_all_step) - self.cur_step -1
-            else:
-                step_in_store = self.cur_step
-                
-            step_in_store_atten_dict = self.additional_attention_store.attention_store_all_step[step_in_store]
+    def get_cross_attention_value_edit(self, attn_base, alpha_words):
+        """Fold the cross attention edit into value. With alpha blending of `forward',
+        edited attention @ value = attn_base @ (mapper * alpha @ value) + att_replace @ ((scale * alpha + 1 - alpha) * value)
+        so the remapped [frames, heads, pixels, words] attention map is never materialized.
+        """
+        value_mapper, value_scale = self.get_cross_attention_value_map()
+        alpha_words = alpha_words.reshape(alpha_words.shape[0], -1)
+        value_mapper = value_mapper * alpha_words[:, None, :]
+        value_scale = value_scale * alpha_words + 1 - alpha_words
+        return attn_base, value_mapper[0], value_scale[0]
+
+    def pop_cross_value_edit(self):
+        "Called by the registered attention after `__call__', return the value-side edit of this layer if any"
+        cross_value_edit = self.cross_value_edit
+        self.cross_value_edit = None
+        return cross_value_edit
+    
+    def get_position_max_query(self) -> int:
+        return self.get_inverted_max_query()
+
+    def get_step_in_store_attention(self):
+        "Return the step index and the attention dict of the inverted store aligned with current editing step"
+        if self.step_in_store_cache is not None and self.step_in_store_cache[0] == self.cur_step:
+            # looked up once per step, shared by all layers
+            return self.step_in_store_cache[1:]
+        if self.use_inversion_attention:
+            step_in_store = len(self.additional_attention_store.attention_store_all_step) - self.cur_step -1
+        else:
+            step_in_store = self.cur_step
             
-            if isinstance(step_in_store_atten_dict, str): 
-                step_in_store_atten_dict = torch.load(step_in_store_atten_dict)
+        attention_store_all_step = self.additional_attention_store.attention_store_all_step
+        step_in_store_atten_dict = self.additional_attention_store.get_step_attention(step_in_store)
+        if hasattr(attention_store_all_step, 'prefetch'):
+            # the disk store loads the step of the next denoising step while this one computes
+            attention_store_all_step.prefetch(step_in_store - 1 if self.use_inversion_attention else step_in_store + 1)
+        self.step_in_store_cache = (self.cur_step, step_in_store, step_in_store_atten_dict)
+        return step_in_store, step_in_store_atten_dict
+
+    def get_replaced_self_attention(self, is_cross: bool, place_in_unet: str, num_query: int, layer_id: int = None):
+        """Called by the registered attention before computing QK^T.
+        If the self-attention of this layer will be fully replaced by the inverted map (no blend mask, 
+        not recorded), return the inverted map in [temporal, head, res, res*k] and advance the layer counter 
+        as `__call__` does, so that the target attention probabilities are never computed.
+        Otherwise return None and the layer goes through `__call__` as usual.
+        """
+        if is_cross or self.save_self_attention or self.attention_blend is not None:
+            return None
+        if not (self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]):
+            return None
+        if self.cur_att_layer < self.num_uncond_att_layers:
+            return None
+        layer_plan = self.get_layer_plan(layer_id, is_cross, place_in_unet, num_query)
+        if layer_plan.position is None:
+            return None
+        _, step_in_store_atten_dict = self.get_step_in_store_attention()
+        attn_base = step_in_store_atten_dict[layer_plan.key][layer_plan.position]
+        if attn_base is None:
+            return None
+        self.cur_att_layer += 1
+        return attn_base
+
+    def needs_attention_probs(self, layer_plan: LayerPlan) -> bool:
+        if super().needs_attention_probs(layer_plan):
+            return True
+        if layer_plan.position is None:
+            return False
+        if layer_plan.is_cross:
+            return self.cross_replace_steps[self.cur_step]
+        return self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]
+
+    def get_inverted_max_query(self) -> int:
+        "layers with more queries are not recorded in the inverted store, and not edited"
+        return self.additional_attention_store.get_max_query()
+
+    def forward(self, attn, is_cross: bool, place_in_unet: str, layer_plan: LayerPlan = None, row_offset: int = 0):
+        """attn is the block of query rows from row_offset of the layer, the same rows of the inverted map are used"""
+        if layer_plan is None:
+            layer_plan = self.get_layer_plan(None, is_cross, place_in_unet, attn.shape[-2])
+        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet, layer_plan, row_offset)
+        if layer_plan.position is not None:
+            step_in_store, step_in_store_atten_dict = self.get_step_in_store_attention()
             
             # Note that attn is append to step_store, 
             # if attn is get through clean -> noisy, we should inverse it
-            attn_base = step_in_store_atten_dict[key][current_pos]          
+            attn_base = step_in_store_atten_dict[layer_plan.key][layer_plan.position]
             
-            self.update_attention_position_dict(key)
+            if attn_base is None:
+                # not consumed at this step by the recording plan of the inverted store
+                return attn
+            row_end = row_offset + attn.shape[-2]
+            if attn.shape[-2] < layer_plan.num_query:
+                attn_base = slice_attention_rows(attn_base, row_offset, row_end, layer_plan.num_query)
             # save in format of [temporal, head, resolution, text_embedding]
             if is_cross or (self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]):
                 clip_length = attn.shape[0] // (self.batch_size)
@@ -128,19 +210,25 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
                 attn_base, attn_repalce = attn_base, attn[0:]
                 if is_cross:
                     alpha_words = self.cross_replace_alpha[self.cur_step]
-                    attn_repalce_new = self.replace_cross_attention(attn_base, attn_repalce) * alpha_words + (1 - alpha_words) * attn_repalce
-                    attn[0:] = attn_repalce_new # b t h p n = [1, 1, 8, 1024, 77]
+                    if self.cross_attention_value_edit:
+                        # keep attn unchanged, the edit is applied on value by the registered attention
+                        self.cross_value_edit = self.get_cross_attention_value_edit(attn_base, alpha_words)
+                    else:
+                        attn_repalce_new = self.replace_cross_attention(attn_base, attn_repalce) * alpha_words + (1 - alpha_words) * attn_repalce
+                        attn[0:] = attn_repalce_new # b t h p n = [1, 1, 8, 1024, 77]
                 else:
                     
                     # start of masked self-attention
-                    if self.attention_blend is not None and attn_repalce.shape[-2] <= 32 ** 2:
+                    if self.attention_blend is not None:
                         # ca_this_step = step_in_store_atten_dict
                         # query 1024, key 2048
-                        h = int(np.sqrt(attn_repalce.shape[-2]))
+                        h = int(np.sqrt(layer_plan.num_query))
                         w = h
                         mask = self.attention_blend(target_h = h, target_w =w, attention_store= step_in_store_atten_dict, step_in_store=step_in_store)
                         # reshape from ([ 1, 2, 32, 32]) -> [2, 1, 1024, 1]
                         reshaped_mask = rearrange(mask, "d c h w -> c d (h w)")[..., None]
+                        # the rows of the current block
+                        reshaped_mask = reshaped_mask[..., row_offset:row_end, :]
                         
                         # input has shape  (h) c res words
                         # one meens using target self-attention, zero is using source
@@ -160,16 +248,23 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
 
         super().between_steps()
         self.step_store = self.get_empty_store()
-        
-        self.attention_position_counter_dict = {
-            'down_cross': 0,
-            'mid_cross': 0,
-            'up_cross': 0,
-            'down_self': 0,
-            'mid_self': 0,
-            'up_self': 0,
-        }        
-        return 
+        self.step_in_store_cache = None
+        return
+
+    def flush_masks(self):
+        "Wait until the blend masks are saved, at the end of the edit"
+        for blender in [self.latent_blend, self.attention_blend]:
+            if blender is not None:
+                blender.flush()
+
+    def reset(self):
+        # restart the step counters of blenders, e.g., for a new stage of long video generation
+        super().reset()
+        self.step_in_store_cache = None
+        for blender in [self.latent_blend, self.attention_blend]:
+            if blender is not None:
+                blender.reset()
+
     def __init__(self, prompts, num_steps: int,
                  cross_replace_steps: Union[float, Tuple[float, float], Dict[str, Tuple[float, float]]],
                  self_replace_steps: Union[float, Tuple[float, float]],
@@ -178,7 +273,8 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
                  use_inversion_attention: bool=False,
                  attention_blend: SpatialBlender= None,
                  save_self_attention: bool=True,
-                 disk_store=False
+                 disk_store=False,
+                 cross_attention_value_edit: bool=False
                  ):
         super(AttentionControlEdit, self).__init__(
             save_self_attention=save_self_attention,
@@ -192,21 +288,17 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
             assert self.batch_size==1, 'Only support single video editing with additional attention_store'
 
         self.cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(prompts, num_steps, cross_replace_steps, tokenizer).to(device)
+        # steps where some word of the cross attention is replaced, on cpu to avoid a sync per layer
+        self.cross_replace_steps = (self.cross_replace_alpha.reshape(num_steps + 1, -1) > 0).any(-1).tolist()
         if type(self_replace_steps) is float:
             self_replace_steps = 0, self_replace_steps
         self.num_self_replace = int(num_steps * self_replace_steps[0]), int(num_steps * self_replace_steps[1])
         self.latent_blend = latent_blend
-        # We need to know the current position in attention
-        self.prev_attention_key_name = 0
+        self.cross_attention_value_edit = cross_attention_value_edit and self.batch_size == 1
+        self.cross_value_edit = None
         self.use_inversion_attention = use_inversion_attention
-        self.attention_position_counter_dict = {
-            'down_cross': 0,
-            'mid_cross': 0,
-            'up_cross': 0,
-            'down_self': 0,
-            'mid_self': 0,
-            'up_self': 0,
-        }
+        # (cur_step, step_in_store, attention dict) of `get_step_in_store_attention'
+        self.step_in_store_cache = None
 
 class AttentionReplace(AttentionControlEdit):
 
@@ -215,12 +307,15 @@ class AttentionReplace(AttentionControlEdit):
         # Can be extend to temporal, use temporal as batch size
         target_device = att_replace.device
         target_dtype  = att_replace.dtype
-        attn_base = attn_base.to(target_device, dtype=target_dtype)
+        attn_base = decode_attention(attn_base, target_device, target_dtype)
         
         if attn_base.dim()==3:
             return torch.einsum('hpw,bwn->bhpn', attn_base, self.mapper)
         elif attn_base.dim()==4:
             return torch.einsum('thpw,bwn->bthpn', attn_base, self.mapper)
+
+    def get_cross_attention_value_map(self):
+        return self.mapper, torch.zeros_like(self.mapper[:, 0])
       
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
                  latent_blend: Optional[SpatialBlender] = None, tokenizer=None,
@@ -228,13 +323,15 @@ class AttentionReplace(AttentionControlEdit):
                  use_inversion_attention = False,
                  attention_blend: SpatialBlender=None,
                  save_self_attention: bool = True,
-                 disk_store=False):
+                 disk_store=False,
+                 cross_attention_value_edit: bool=False):
         super(AttentionReplace, self).__init__(
             prompts, num_steps, cross_replace_steps, self_replace_steps, latent_blend, tokenizer=tokenizer,
             additional_attention_store=additional_attention_store, use_inversion_attention = use_inversion_attention,
             attention_blend=attention_blend,
             save_self_attention = save_self_attention,
-            disk_store=disk_store
+            disk_store=disk_store,
+            cross_attention_value_edit=cross_attention_value_edit
             )
         self.mapper = seq_aligner.get_replacement_mapper(prompts, tokenizer).to(device)
 
@@ -244,7 +341,7 @@ class AttentionRefine(AttentionControlEdit):
         
         target_device = att_replace.device
         target_dtype  = att_replace.dtype
-        attn_base = attn_base.to(target_device, dtype=target_dtype)
+        attn_base = decode_attention(attn_base, target_device, target_dtype)
         if attn_base.dim()==3:
             attn_base_replace = attn_base[:, :, self.mapper].permute(2, 0, 1, 3)
         elif attn_base.dim()==4:
@@ -252,20 +349,29 @@ class AttentionRefine(AttentionControlEdit):
         attn_replace = attn_base_replace * self.alphas + att_replace * (1 - self.alphas)
         return attn_replace
 
+    def get_cross_attention_value_map(self):
+        # gathering column mapper[n] of attn_base is a matmul with a one-hot [words, words] matrix
+        # mapper is -1 for unaligned words, whose alphas are zero
+        alphas = self.alphas.reshape(self.alphas.shape[0], -1)
+        one_hot = F.one_hot(self.mapper.clamp(min=0), alphas.shape[-1]).transpose(1, 2).to(alphas.dtype)
+        return one_hot * alphas[:, None, :], 1 - alphas
+
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
                  latent_blend: Optional[SpatialBlender] = None, tokenizer=None,
                  additional_attention_store=None,
                  use_inversion_attention = False,
                  attention_blend: SpatialBlender=None,
                  save_self_attention : bool=True,
-                 disk_store = False
+                 disk_store = False,
+                 cross_attention_value_edit: bool=False
                  ):
         super(AttentionRefine, self).__init__(
             prompts, num_steps, cross_replace_steps, self_replace_steps, latent_blend, tokenizer=tokenizer,
             additional_attention_store=additional_attention_store, use_inversion_attention = use_inversion_attention,
             attention_blend=attention_blend,
             save_self_attention = save_self_attention,
-            disk_store = disk_store
+            disk_store = disk_store,
+            cross_attention_value_edit=cross_attention_value_edit
             )
         self.mapper, alphas = seq_aligner.get_refinement_mapper(prompts, tokenizer)
         self.mapper, alphas = self.mapper.to(device), alphas.to(device)
@@ -282,16 +388,27 @@ class AttentionReweight(AttentionControlEdit):
     def replace_cross_attention(self, attn_base, att_replace):
         if self.prev_controller is not None:
             attn_base = self.prev_controller.replace_cross_attention(attn_base, att_replace)
+        attn_base = decode_attention(attn_base, self.equalizer.device)
         attn_replace = attn_base[None, :, :, :] * self.equalizer[:, None, None, :]
         return attn_replace
 
+    def get_cross_attention_value_map(self):
+        if self.prev_controller is not None:
+            value_mapper, value_scale = self.prev_controller.get_cross_attention_value_map()
+        else:
+            num_words = self.equalizer.shape[-1]
+            value_mapper = torch.eye(num_words, device=self.equalizer.device)[None]
+            value_scale = torch.zeros(1, num_words, device=self.equalizer.device)
+        return value_mapper * self.equalizer[:, None, :], value_scale * self.equalizer
+
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float, equalizer,
                 latent_blend: Optional[SpatialBlender] = None, controller: Optional[AttentionControlEdit] = None, tokenizer=None,
                 additional_attention_store=None,
                 use_inversion_attention = False,
                 attention_blend: SpatialBlender=None,
                 save_self_attention:bool = True,
-                disk_store = False
+                disk_store = False,
+                cross_attention_value_edit: bool=False
                 ):
         super(AttentionReweight, self).__init__(
             prompts, num_steps, cross_replace_steps, self_replace_steps, latent_blend, tokenizer=tokenizer,
@@ -299,7 +416,8 @@ class AttentionReweight(AttentionControlEdit):
             use_inversion_attention = use_inversion_attention,
             attention_blend=attention_blend,
             save_self_attention=save_self_attention,
-            disk_store = disk_store
+            disk_store = disk_store,
+            cross_attention_value_edit=cross_attention_value_edit
             )
         self.equalizer = equalizer.to(device)
         self.prev_controller = controller
@@ -326,7 +444,9 @@ def make_controller(tokenizer, prompts: List[str], is_replace_controller: bool,
                     blend_self_attention=False,
                     save_path = None,
                     save_self_attention = True,
-                    disk_store = False
+                    disk_store = False,
+                    cross_attention_value_edit = False,
+                    save_blend_mask = True
                     ) -> AttentionControlEdit:
     if (blend_words is None) or (blend_words == 'None'):
         latent_blend = None
@@ -336,7 +456,7 @@ def make_controller(tokenizer, prompts: List[str], is_replace_controller: bool,
             latent_blend = SpatialBlender( prompts, blend_words, 
                                        start_blend = 0.2, end_blend=0.8,
                                        tokenizer=tokenizer, th=blend_th, NUM_DDIM_STEPS=NUM_DDIM_STEPS,
-                            save_path=save_path+f'/latent_blend_mask',
+                            save_path=save_path+f'/latent_blend_mask' if save_blend_mask else None,
                             prompt_choose='both')
             print(f'Blend latent mask with threshold {blend_th}')
         else:
@@ -345,7 +465,7 @@ def make_controller(tokenizer, prompts: List[str], is_replace_controller: bool,
             attention_blend = SpatialBlender( prompts, blend_words, 
                                                     start_blend = 0.0, end_blend=2,
                                                   tokenizer=tokenizer, th=blend_th, NUM_DDIM_STEPS=NUM_DDIM_STEPS,
-                           save_path=save_path+f'/attention_blend_mask',
+                           save_path=save_path+f'/attention_blend_mask' if save_blend_mask else None,
                            prompt_choose='source')
             print(f'Blend self attention mask with threshold {blend_th}')
         else:
@@ -359,7 +479,8 @@ def make_controller(tokenizer, prompts: List[str], is_replace_controller: bool,
                                       use_inversion_attention = use_inversion_attention,
                                       attention_blend=attention_blend,
                                       save_self_attention = save_self_attention,
-                                      disk_store=disk_store
+                                      disk_store=disk_store,
+                                      cross_attention_value_edit=cross_attention_value_edit
                                       )
     else:
         print('use refine controller')
@@ -370,7 +491,8 @@ def make_controller(tokenizer, prompts: List[str], is_replace_controller: bool,
                                      use_inversion_attention = use_inversion_attention,
                                      attention_blend=attention_blend,
                                      save_self_attention = save_self_attention,
-                                     disk_store=disk_store
+                                     disk_store=disk_store,
+                                     cross_attention_value_edit=cross_attention_value_edit
                                      )
     if equilizer_params is not None:
         eq = get_equalizer(prompts[1], equilizer_params["words"], equilizer_params["values"], tokenizer=tokenizer)
@@ -382,7 +504,8 @@ def make_controller(tokenizer, prompts: List[str], is_replace_controller: bool,
                                         use_inversion_attention = use_inversion_attention,
                                         attention_blend=attention_blend,
                                         save_self_attention = save_self_attention,
-                                        disk_store=disk_store
+                                        disk_store=disk_store,
+                                        cross_attention_value_edit=cross_attention_value_edit
                                        )
     return controller
 
@@ -0,0 +1,171 @@
+"""
+Recording plan of the inverted AttentionStore.
+Compiled from the editing config before the inversion, it keeps only the (step, key, layer, token) slices of attention
+that the AttentionControlEdit and SpatialBlender of the later edits consume.
+Provide a API `make_recording_plan' to build it from `editing_config' of fatezero.
+"""
+
+import copy
+from collections.abc import Sequence
+from typing import Dict, List, Optional
+
+import torch
+
+from video_diffusion.prompt_attention.attention_codec import decode_attention
+from video_diffusion.prompt_attention.spatial_blend import SpatialBlender
+import video_diffusion.prompt_attention.ptp_utils as ptp_utils
+import video_diffusion.prompt_attention.seq_aligner as seq_aligner
+
+
+class TokenExpandedLayers(Sequence):
+    "Cross attention layers of a step, expanded back to all tokens when read"
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.recording_plan.expand_tokens(attn) for attn in self.layers[index]]
+        return self.recording_plan.expand_tokens(self.layers[index])
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __init__(self, layers, recording_plan):
+        self.layers = layers
+        self.recording_plan = recording_plan
+
+
+class RecordingPlan:
+    """Which attention maps of each inversion step are stored.
+    Steps are indexed in the inversion order, layers by their position among the recorded layers of a key,
+    unrecorded maps are None in the store.
+
+    Args:
+        num_steps (int): number of inversion steps
+        max_query (int, optional): maps with more queries are never recorded. Defaults to 32**2.
+        self_steps (List[int], optional): steps whose self-attention is consumed, None for all.
+        cross_steps (List[int], optional): steps whose cross attention of all layers is consumed, None for all.
+        blend_steps (List[int], optional): steps whose cross attention of the SpatialBlender layers is consumed.
+        tokens (List[int], optional): token columns of the cross attention consumed, None for all.
+        num_tokens (int, optional): Defaults to 77.
+    """
+    BLEND_LAYERS = SpatialBlender.BLEND_LAYERS
+
+    def records(self, step: int, key: str, layer: int) -> bool:
+        if key.endswith('self'):
+            return self.self_steps is None or step in self.self_steps
+        if self.cross_steps is None or step in self.cross_steps:
+            return True
+        return step in self.blend_steps and layer in self.BLEND_LAYERS.get(key, [])
+
+    def get_step_num(self, key: str, layer: int) -> int:
+        "number of recorded steps of a layer"
+        return sum(self.records(step, key, layer) for step in range(self.num_steps))
+
+    def select_tokens(self, attn: torch.Tensor) -> torch.Tensor:
+        if self.tokens is None or attn.shape[-1] != self.num_tokens:
+            return attn
+        return attn[..., self.tokens.to(attn.device)]
+
+    def expand_tokens(self, attn: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        "scatter the recorded token columns back, unrecorded tokens are zero"
+        if attn is None or self.tokens is None:
+            return attn
+        attn = decode_attention(attn)
+        if attn.shape[-1] == self.num_tokens:
+            return attn
+        expanded = attn.new_zeros(*attn.shape[:-1], self.num_tokens)
+        expanded[..., self.tokens.to(attn.device)] = attn
+        return expanded
+
+    def wrap_step(self, step_store):
+        "{key: [maps of each layer]} of a stored step, with cross attention expanded to all tokens"
+        if self.tokens is None:
+            return step_store
+        return {key: TokenExpandedLayers(step_store[key], self) if key.endswith('cross') else step_store[key]
+                for key in step_store.keys()}
+
+    def with_all_cross_attention(self) -> 'RecordingPlan':
+        "a copy that records the cross attention of every step and token, e.g. for its visualized average"
+        plan = copy.copy(self)
+        plan.cross_steps = None
+        plan.tokens = None
+        return plan
+
+    def get_signature(self) -> str:
+        "identify the recorded content, e.g. in the inversion cache key"
+        def to_list(steps):
+            return None if steps is None else sorted(steps)
+        return str((self.num_steps, self.max_query, to_list(self.self_steps), to_list(self.cross_steps),
+                    to_list(self.blend_steps), None if self.tokens is None else self.tokens.tolist()))
+
+    def __init__(self, num_steps: int, max_query: int = 32 ** 2,
+                 self_steps: Optional[List[int]] = None,
+                 cross_steps: Optional[List[int]] = None,
+                 blend_steps: Optional[List[int]] = None,
+                 tokens: Optional[List[int]] = None,
+                 num_tokens: int = 77):
+        self.num_steps = num_steps
+        self.max_query = max_query
+        self.self_steps = None if self_steps is None else set(self_steps)
+        self.cross_steps = None if cross_steps is None else set(cross_steps)
+        self.blend_steps = set() if blend_steps is None else set(blend_steps)
+        self.num_tokens = num_tokens
+        if tokens is not None and len(set(tokens)) < num_tokens:
+            self.tokens = torch.tensor(sorted(set(tokens)), dtype=torch.long)
+        else:
+            self.tokens = None
+
+
+def make_recording_plan(tokenizer, editing_config: Dict, source_prompt: str,
+                        max_query: int = 32 ** 2) -> RecordingPlan:
+    """Compile the p2p edits of `editing_config' (as run by P2pSampleLogger with inverted attention)
+    into the RecordingPlan of the inversion.
+    Editing step c reads inversion step num_steps - 1 - c.
+    """
+    num_steps = editing_config['num_inference_steps']
+    self_steps, cross_steps, blend_steps, tokens = set(), set(), set(), set()
+    if not editing_config.get('prompt2prompt_edit', False):
+        return RecordingPlan(num_steps, max_query, self_steps, cross_steps, blend_steps, [])
+
+    for idx, prompt in enumerate(editing_config['editing_prompts']):
+        p2p_config = copy.deepcopy(editing_config['p2p_config'][idx])
+        prompts = [source_prompt, prompt]
+        equal_length = len(source_prompt.split(' ')) == len(prompt.split(' '))
+
+        # the same schedules as AttentionControlEdit
+        cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(
+            prompts, num_steps, p2p_config['cross_replace_steps'], tokenizer).reshape(num_steps + 1, -1)
+        self_replace_steps = p2p_config['self_replace_steps']
+        if type(self_replace_steps) is float:
+            self_replace_steps = 0, self_replace_steps
+        num_self_replace = int(num_steps * self_replace_steps[0]), int(num_steps * self_replace_steps[1])
+
+        # [source words, target words] weight of the source cross attention in the edited one
+        if p2p_config.get('is_replace_controller', True) and equal_length:
+            source_to_target = seq_aligner.get_replacement_mapper(prompts, tokenizer)[0] != 0
+        else:
+            mapper, alphas = seq_aligner.get_refinement_mapper(prompts, tokenizer)
+            mapper, alphas = mapper[0], alphas[0]
+            source_to_target = torch.zeros(len(mapper), len(mapper), dtype=torch.bool)
+            aligned = (mapper >= 0) & (alphas > 0)
+            source_to_target[mapper[aligned], torch.arange(len(mapper))[aligned]] = True
+
+        blend_words = p2p_config.get('blend_words', None)
+        use_blend = blend_words is not None and blend_words != 'None'
+        if use_blend:
+            source_words = blend_words[0]
+            for word in [source_words] if type(source_words) is str else source_words:
+                tokens.update(int(i) for i in ptp_utils.get_word_inds(source_prompt, word, tokenizer))
+
+        for step in range(num_steps):
+            step_in_store = num_steps - 1 - step
+            if num_self_replace[0] <= step < num_self_replace[1]:
+                self_steps.add(step_in_store)
+                if use_blend and p2p_config.get('blend_self_attention', False):
+                    blend_steps.add(step_in_store)
+            target_words = cross_replace_alpha[step] > 0
+            if target_words.any():
+                cross_steps.add(step_in_store)
+                tokens.update(source_to_target[:, target_words].any(-1).nonzero()[:, 0].tolist())
+            if use_blend and p2p_config.get('blend_latents', False):
+                # the latent blend in `step_callback' reads all cross attention layers at every step
+                cross_steps.add(step_in_store)
+    return RecordingPlan(num_steps, max_query, self_steps, cross_steps, blend_steps, tokens)
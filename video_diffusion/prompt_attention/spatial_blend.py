@@ -5,6 +5,8 @@ Code of spatial blending module for latents and self-attention
 from typing import List
 import os
 import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torchvision.utils as tvu
 from einops import rearrange
@@ -13,14 +15,51 @@ import torch
 import torch.nn.functional as F
 
 import video_diffusion.prompt_attention.ptp_utils as ptp_utils
+from video_diffusion.prompt_attention.attention_codec import decode_attention
 
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
+
+class MaskWriter:
+    """Save the blending masks to png in a background thread, off the denoising loop
+
+    Args:
+        max_pending_writes (int, optional): masks queued before `write' blocks. Defaults to 8.
+    """
+    def write(self, mask: torch.Tensor, save_path: str):
+        while len(self.pending_writes) >= self.max_pending_writes:
+            self.pending_writes.popleft().result()
+        self.pending_writes.append(self.executor.submit(self.save, mask, save_path))
+
+    @staticmethod
+    def save(mask: torch.Tensor, save_path: str):
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        tvu.save_image(rearrange(mask.float().cpu(), "c p h w -> p c h w"), save_path, normalize=True)
+
+    def flush(self):
+        "Wait for all queued masks, then raise the first error of the writer thread if any"
+        error = None
+        while len(self.pending_writes) > 0:
+            pending_error = self.pending_writes.popleft().exception()
+            if error is None:
+                error = pending_error
+        if error is not None:
+            raise error
+
+    def __init__(self, max_pending_writes: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = deque()
+        self.max_pending_writes = max_pending_writes
+
+
 class SpatialBlender:
     """
     Return a blending mask using the cross attention produced by both source during the inversion and target prompt during editing.
     Called in make_controller
     """
+    # cross attention layers of the attention_store read by `__call__'
+    BLEND_LAYERS = {'down_cross': [2, 3], 'up_cross': [0, 1, 2]}
+
     def get_mask(self, maps, alpha, use_pool, h=None, w=None, x_t=None, step_in_store: int=None):
         """
         ([1, 40, 2, 16, 16, 77]) * ([1, 1, 1, 1, 1, 77]) -> [2, 1, 16, 16]
@@ -46,12 +85,11 @@ class SpatialBlender:
             if step_in_store is not None:
                 save_path += f'step_in_store_{step_in_store:04d}'
             save_path +=f'/mask_{now}_{self.count:02d}.png'
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
             if mask.shape[0] == 2:
                 save_mask = mask[1:]
             else:
                 save_mask = mask
-            tvu.save_image(rearrange(save_mask.float(), "c p h w -> p c h w"), save_path,normalize=True)
+            self.mask_writer.write(save_mask, save_path)
             self.count +=1
         return mask
 
@@ -74,12 +112,23 @@ class SpatialBlender:
         
         self.counter += 1
         # if (self.counter > self.start_blend) and (self.counter < self.end_blend):
-            
-        maps = attention_store["down_cross"][2:4] + attention_store["up_cross"][:3]
+
+        # the self-attention mask only depends on the source maps of step_in_store and the resolution,
+        # it is computed once and shared by all layers of the step
+        use_cache = x_t is None and step_in_store is not None and self.prompt_choose == 'source'
+        if use_cache:
+            if step_in_store != self.cache_step:
+                self.cache_step, self.maps_cache, self.mask_cache = step_in_store, None, {}
+            if (target_h, target_w) in self.mask_cache:
+                return self.mask_cache[(target_h, target_w)]
+            if self.maps_cache is not None:
+                return self.blend(self.maps_cache, step_in_store, target_h, target_w, x_t, use_cache)
+
+        maps = [attention_store[key][layer] for key, layers in self.BLEND_LAYERS.items() for layer in layers]
         # breakpoint()
-        assert len(attention_store["down_cross"][0].shape) in [5, 4], \
+        assert len(maps[0].shape) in [5, 4], \
             (f"the maps in attention_store must have shape [p c h (res_h res_w) w], or [c h (res_h res_w) w] \
-            not {attention_store['down_cross'][0].shape} ")
+            not {maps[0].shape} ")
         # maps = attention_store # [2,8,1024, 77] = [frames, head, (res, res), word_embedding]
         # a list of len(5), elements has shape [16, 256, 77]
         target_device = self.alpha_layers.device
@@ -89,6 +138,7 @@ class SpatialBlender:
                             # for item in maps]
         rearranged_maps = []
         for item in maps:
+            item = decode_attention(item, target_device, target_dtype)
             if len(item.shape) == 4: item = item[None, ...]
             ( p, c, heads, r, w)= item.shape
             res_h = int(np.sqrt(r))
@@ -97,7 +147,12 @@ class SpatialBlender:
                             h=heads, res_h=res_h, res_w=res_h)
             rearranged_maps.append(rearranged_item.to(target_device, dtype=target_dtype))
         maps = torch.cat(rearranged_maps, dim=1)
+        if use_cache:
+            self.maps_cache = maps
+        return self.blend(maps, step_in_store, target_h, target_w, x_t, use_cache)
 
+    def blend(self, maps, step_in_store, target_h, target_w, x_t=None, use_cache=False):
+        "Mask of the rearranged maps at the target resolution, applied on x_t if given"
         if self.prompt_choose == 'source':
             # We support self-attention blending using only source prompt
             masked_alpah_layers = self.alpha_layers[0:1]
@@ -113,6 +168,8 @@ class SpatialBlender:
         # mask is one: use generated information
         # mask is zero: use inverted information
         self.mask_list.append(mask[0][:, None, :, :].float().cpu().detach())
+        if use_cache:
+            self.mask_cache[(target_h, target_w)] = mask
         if x_t is not None:
             if x_t.dim()==5: 
                 mask = mask[:, None, ...]
@@ -122,7 +179,18 @@ class SpatialBlender:
             return x_t
         else:
             return mask
-       
+
+    def flush(self):
+        "Wait for the masks queued to the background writer"
+        if self.mask_writer is not None:
+            self.mask_writer.flush()
+
+    def reset(self):
+        "restart the step counter and drop the cached masks, e.g., for a new stage of long video generation"
+        self.flush()
+        self.counter = 0
+        self.cache_step, self.maps_cache, self.mask_cache = None, None, {}
+
     def __init__(self, prompts: List[str], words: [List[List[str]]], substruct_words=None, 
                  start_blend=0.2, end_blend=0.8,
                  th=(0.9, 0.9), tokenizer=None, NUM_DDIM_STEPS =None,
@@ -138,8 +206,10 @@ class SpatialBlender:
         if save_path is not None:
             self.save_path = save_path
             os.makedirs(self.save_path, exist_ok=True)
+            self.mask_writer = MaskWriter()
         else:
             self.save_path = None
+            self.mask_writer = None
         assert prompt_choose in ['source', 'both'], "choose to generate the mask by only source prompt or both the source and target"
         self.prompt_choose = prompt_choose
         alpha_layers = torch.zeros(len(prompts),  1, 1, 1, 1, self.MAX_NUM_WORDS)
@@ -173,4 +243,6 @@ class SpatialBlender:
         self.counter = 0 
         self.th=th
         self.mask_list = []
+        # rearranged source maps and masks of each resolution at cache_step
+        self.cache_step, self.maps_cache, self.mask_cache = None, None, {}
 
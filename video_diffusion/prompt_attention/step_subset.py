@@ -0,0 +1,158 @@
+"""
+Subset of the inversion steps whose attention is stored by AttentionStore.
+Adjacent DDIM steps have very similar maps, so a map is kept every k-th step, or only when it changed
+beyond a threshold since the last kept step of the same layer.
+`AttentionStore.get_step_attention' holds or interpolates the kept steps at the other steps.
+"""
+
+import bisect
+from collections.abc import Sequence
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+
+class SubsetLayers(Sequence):
+    "Layers of a key at a step, the maps not kept at this step are filled from the kept steps when read"
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[layer] for layer in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        attn = self.layers[index] if index < len(self.layers) else None
+        if attn is not None:
+            return attn
+        return self.attention_store.get_skipped_attention(self.step, self.key, index)
+
+    def __len__(self):
+        return max(len(self.layers), len(self.attention_store.step_subset.kept_steps.get(self.key, [])))
+
+    def __init__(self, layers, attention_store, step: int, key: str):
+        self.layers = layers
+        self.attention_store = attention_store
+        self.step = step
+        self.key = key
+
+
+class StepSubset:
+    """Which steps of each (key, layer) map are kept.
+    The first step of a map is always kept.
+
+    Args:
+        every (int, optional): only every k-th step can be kept. Defaults to 1.
+        threshold (float, optional): keep a step only when the relative Frobenius change of the map
+            from the last kept step exceeds threshold. Defaults to None, keep every k-th step.
+        interpolation (str, optional): `hold' the nearest kept step, or `linear' between the kept steps around.
+            Defaults to 'hold'.
+        report (bool, optional): measure the memory and the error of holding the last kept step. Defaults to False.
+    """
+    INTERPOLATIONS = ['hold', 'linear']
+
+    def get_kept_steps(self, key: str, layer: int) -> List[int]:
+        layers = self.kept_steps.setdefault(key, [])
+        while len(layers) <= layer:
+            layers.append([])
+        return layers[layer]
+
+    def keeps(self, step: int, key: str, layer: int, numel: int,
+              get_change: Callable[[int], float]) -> bool:
+        """Decide whether the map of (key, layer) is kept at step,
+        get_change(last_kept_step) computes the relative change from a kept step only when needed
+        """
+        kept_steps = self.get_kept_steps(key, layer)
+        change = None
+        if len(kept_steps) == 0:
+            kept = True
+        elif step % self.every != 0:
+            kept = False
+        elif self.threshold is None:
+            kept = True
+        else:
+            change = get_change(kept_steps[-1])
+            kept = change > self.threshold
+        if self.report is not None:
+            if not kept and change is None:
+                change = get_change(kept_steps[-1])
+            self.report.update(kept, numel, change)
+        if kept:
+            kept_steps.append(step)
+        return kept
+
+    def get_neighbours(self, step: int, key: str, layer: int) -> Tuple[Optional[int], Optional[int]]:
+        "The kept steps of (key, layer) just before and after step"
+        kept_steps = self.get_kept_steps(key, layer)
+        index = bisect.bisect_left(kept_steps, step)
+        previous = kept_steps[index - 1] if index > 0 else None
+        following = kept_steps[index] if index < len(kept_steps) else None
+        return previous, following
+
+    def get_signature(self) -> str:
+        "identify the kept steps, e.g. in the inversion cache key"
+        return str((self.every, self.threshold))
+
+    def get_state(self) -> Dict:
+        return {'kept_steps': self.kept_steps}
+
+    def load_state(self, state: Dict):
+        self.kept_steps = state['kept_steps']
+
+    def reset(self):
+        self.kept_steps = {}
+
+    def __init__(self, every: int = 1, threshold: Optional[float] = None, interpolation: str = 'hold',
+                 report: bool = False):
+        if interpolation not in self.INTERPOLATIONS:
+            raise ValueError(f"interpolation must be one of {self.INTERPOLATIONS}, not {interpolation}")
+        self.every = every
+        self.threshold = threshold
+        self.interpolation = interpolation
+        self.report = StepSubsetReport() if report else None
+        # key -> [sorted kept steps of each layer]
+        self.kept_steps = {}
+
+
+def get_relative_change(attn: torch.Tensor, kept_attn: torch.Tensor) -> float:
+    "Relative Frobenius distance of attn from the map of a kept step"
+    attn, kept_attn = attn.float(), kept_attn.float()
+    return ((attn - kept_attn).norm() / kept_attn.norm().clamp(min=1e-12)).item()
+
+
+def interpolate_attention(previous: torch.Tensor, following: torch.Tensor, weight: float,
+                          low_rank: bool = False) -> torch.Tensor:
+    """(1 - weight) * previous + weight * following.
+    Low-rank factors packed by `encode_low_rank' are concatenated along the rank,
+    sqrt of the weights on both U * S and V keeps the product linear.
+    """
+    if low_rank:
+        return torch.cat([previous.float() * (1 - weight) ** 0.5, following.float() * weight ** 0.5], dim=-1)
+    return previous.float() * (1 - weight) + following.float() * weight
+
+
+class StepSubsetReport:
+    """Memory of the kept maps against all steps, and the relative error of holding the last kept step
+    at the skipped ones. `linear' interpolation between the kept steps is usually closer.
+    """
+    def update(self, kept: bool, numel: int, change: Optional[float]):
+        self.stats['maps'] += 1
+        self.stats['numel'] += numel
+        if kept:
+            self.stats['kept_maps'] += 1
+            self.stats['kept_numel'] += numel
+        elif change is not None:
+            self.stats['max_hold_error'] = max(self.stats['max_hold_error'], change)
+            self.stats['hold_error_sum'] += change
+            self.stats['skipped_maps'] += 1
+
+    def summary(self) -> Dict[str, float]:
+        stats = self.stats
+        return {
+            'kept_maps': stats['kept_maps'],
+            'maps': stats['maps'],
+            'memory_ratio': stats['kept_numel'] / max(stats['numel'], 1),
+            'max_hold_error': stats['max_hold_error'],
+            'mean_hold_error': stats['hold_error_sum'] / max(stats['skipped_maps'], 1),
+        }
+
+    def __init__(self):
+        self.stats = {'maps': 0, 'kept_maps': 0, 'skipped_maps': 0, 'numel': 0, 'kept_numel': 0,
+                      'max_hold_error': 0.0, 'hold_error_sum': 0.0}